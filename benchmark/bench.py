@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+''' Benchmarks of the hot paths on synthetic data, at several scales of clients, tasks and model size.
+
+    python benchmark/bench.py --scales=small,medium --output=benchmark/baseline.json
+    python benchmark/bench.py --scales=small,medium --compare=benchmark/baseline.json
+
+Each benchmark is run until it takes --min_time seconds and at least --min_runs times,
+after one warm-up run. Results, keyed by "name[scale]", are written to --output as
+JSON with the environment they were measured in. With --compare, the results are
+compared with a stored baseline, and a benchmark whose median and minimum are both
+more than --threshold slower than the baseline is flagged as a regression, in which
+case the exit code is 1.
+'''
+import os
+### Progress bars of the Shapley values would flood the output
+os.environ.setdefault("TQDM_DISABLE", "1")
+
+import io
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import subprocess
+import contextlib
+import statistics
+
+import numpy as np
+import torch
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from options import args_parser
+from nets import MLP
+from exp_utils import average_weights
+from svfl import calculate_sv_v1, calculate_sv_v2
+from task import ClientState, Task, fed_avg
+from client import get_clients, test_inference
+from market import MarketState
+from simulator import SimTask
+from synthetic import load_synthetic_dataset
+import sampling
+import policy
+
+SCALES = {
+    ### clients: federation size, tasks: concurrent tasks, hidden: hidden units of the MLP,
+    # sv_clients: clients in a Shapley value, samples: labels to partition, data: synthetic
+    # train samples, round_clients: clients trained in one round
+    "small": {"clients": 10, "tasks": 2, "hidden": 64, "sv_clients": 3, "samples": 6000,
+        "data": 2000, "round_clients": 2},
+    "medium": {"clients": 100, "tasks": 4, "hidden": 256, "sv_clients": 5, "samples": 60000,
+        "data": 10000, "round_clients": 4},
+    "large": {"clients": 1000, "tasks": 8, "hidden": 1024, "sv_clients": 7, "samples": 600000,
+        "data": 60000, "round_clients": 8},
+}
+POLICIES = ["random", "momentum", "simple", "simple_reverse", "size", "afl", "greedy",
+    "nmfli", "optimal", "mcafee", "even"]
+MNIST_DIM = 28 * 28
+
+BENCHMARKS = []
+
+def benchmark(name, max_scale=None):
+    ''' Register fn(scale) -> the function to time, its setup is not timed '''
+    def register(fn):
+        BENCHMARKS.append((name, fn, max_scale))
+        return fn
+    return register
+
+def seed_all(seed=0):
+    random.seed(seed)
+    np.random.seed(seed)
+    torch.manual_seed(seed)
+
+def model_args(**overrides):
+    ''' Options of federated_main.py, i.e., its defaults with overrides '''
+    argv = sys.argv
+    sys.argv = [argv[0]] + [f"--{name}={value}" for name, value in overrides.items()]
+    try:
+        return args_parser()
+    finally:
+        sys.argv = argv
+
+def mlp_weights(hidden, num):
+    ''' State dicts of num MLPs on MNIST-shaped samples '''
+    return [MLP(dim_in=MNIST_DIM, dim_hidden=hidden, dim_out=10).state_dict() for _ in range(num)]
+
+class RandomProjections:
+    ''' Signal table of SimTask, the projection of each selected client is random '''
+    def lookup(self, row, task_idx, client_idxs):
+        return np.random.random_sample(len(client_idxs))
+
+def sim_market(scale):
+    ''' SimTasks and a MarketState with random prices, bids and client statistics '''
+    num_users, num_tasks = scale["clients"], scale["tasks"]
+    required = max(1, num_users // (2 * num_tasks))
+    datasize = np.random.randint(100, 1000, size=num_users)
+    task_list = []
+    for task_idx in range(num_tasks):
+        task = SimTask(task_idx, num_users, required, 1, datasize, RandomProjections(),
+            list(range(task_idx * required, (task_idx + 1) * required)))
+        task.client_state.client2proj = np.random.random_sample(num_users)
+        task.client_state.client2selected_cnt = np.random.randint(1, 10, size=num_users)
+        task.cient_update_cnt = 10
+        task_list.append(task)
+    market = MarketState(num_users, num_tasks)
+    market.value_sum = np.random.random_sample((num_users, num_tasks))
+    market.price_cnt[:] = 1
+    market.bid_table = np.random.random_sample((num_users, num_tasks))
+    return task_list, market
+
+############################### Benchmarks ###########################################
+@benchmark("exp_utils.average_weights")
+def bench_average_weights(scale):
+    weights = mlp_weights(scale["hidden"], scale["round_clients"])
+    return lambda: average_weights(weights)
+
+def _shapley(scale, calculate_sv):
+    weights = mlp_weights(scale["hidden"], scale["sv_clients"])
+    client2weights = dict(enumerate(weights))
+    ### The evaluation is a cheap function of the weights, so that the cost of the algorithm is measured
+    evaluate = lambda weights: float(weights["layer_hidden.bias"].sum())
+    return lambda: calculate_sv(client2weights, evaluate, fed_avg)
+
+@benchmark("svfl.calculate_sv_v2")
+def bench_sv_v2(scale):
+    return _shapley(scale, calculate_sv_v2)
+
+@benchmark("svfl.calculate_sv_v1", max_scale="medium")
+def bench_sv_v1(scale):
+    return _shapley(scale, calculate_sv_v1)
+
+@benchmark("task.ClientState.update_proj_list")
+def bench_update_proj_list(scale):
+    num = scale["round_clients"]
+    weights_before, global_weights = mlp_weights(scale["hidden"], 2)
+    local_weights = mlp_weights(scale["hidden"], num)
+    client_state = ClientState(scale["clients"])
+    idxs_users = list(range(num))
+    return lambda: client_state.update_proj_list(idxs_users, global_weights, weights_before, local_weights, 1)
+
+def _policy(policy_name):
+    def bench_policy(scale):
+        task_list, market = sim_market(scale)
+        return lambda: policy.select_clients(policy_name, scale["clients"], task_list, market)
+    return bench_policy
+
+for _policy_name in POLICIES:
+    benchmark(f"policy.select_clients[{_policy_name}]")(_policy(_policy_name))
+
+@benchmark("sampling.partition_iid")
+def bench_partition_iid(scale):
+    return lambda: sampling.partition_iid(scale["samples"], scale["clients"])
+
+@benchmark("sampling.partition_shards")
+def bench_partition_shards(scale):
+    labels = np.random.randint(0, 10, size=scale["samples"])
+    shard_size = scale["samples"] // (2 * scale["clients"])
+    return lambda: sampling.partition_shards(labels, [2] * scale["clients"], shard_size)
+
+@benchmark("sampling.partition_by_counts")
+def bench_partition_by_counts(scale):
+    labels = np.random.randint(0, 10, size=scale["samples"])
+    counts = np.random.randint(0, 2 * scale["samples"] // (10 * scale["clients"]) + 1, size=(scale["clients"], 10))
+    return lambda: sampling.partition_by_counts(labels, counts)
+
+@benchmark("sampling.partition_major_minor")
+def bench_partition_major_minor(scale):
+    labels = np.random.randint(0, 10, size=scale["samples"])
+    is_major = np.random.random_sample((scale["clients"], 10)) < 0.2
+    num_per_major = max(1, scale["samples"] // (4 * scale["clients"]))
+    return lambda: sampling.partition_major_minor(labels, is_major, num_per_major, max(1, num_per_major // 10))
+
+@benchmark("sampling.partition_dirichlet")
+def bench_partition_dirichlet(scale):
+    labels = np.random.randint(0, 10, size=scale["samples"])
+    size_weights = sampling.datasize_weights(scale["clients"], skew="lognormal")
+    return lambda: sampling.partition_dirichlet(labels, scale["clients"], 0.5,
+        size_weights=size_weights, num_classes=10)
+
+@benchmark("client.test_inference")
+def bench_test_inference(scale):
+    args = model_args(synthetic=1, synthetic_train=scale["data"], synthetic_test=scale["data"] // 5)
+    _, test_dataset = load_synthetic_dataset(args)
+    model = MLP(dim_in=MNIST_DIM, dim_hidden=scale["hidden"], dim_out=10)
+    return lambda: test_inference(args, model, test_dataset)
+
+@benchmark("task.Task.train_one_round")
+def bench_train_one_round(scale):
+    args = model_args(synthetic=1, synthetic_train=scale["data"], synthetic_test=scale["data"] // 5,
+        num_users=scale["clients"], partition="dirichlet", model="mlp")
+    train_dataset, test_client, all_clients = get_clients(args)
+    ### Without evaluation, the round logs nothing
+    task = Task(args, time.time(), None, train_dataset, test_client, all_clients, task_id=0,
+        selected_client_idx=list(range(scale["round_clients"])), required_client_num=scale["round_clients"],
+        bid_per_loss_delta=1)
+    return lambda: task.train_one_round(evaluate=False)
+
+############################### Harness ###########################################
+def measure(fn, min_time, min_runs, max_runs):
+    ''' Returns the time in seconds of each run of fn, after one warm-up run '''
+    fn()
+    times = []
+    start = time.perf_counter()
+    while len(times) < min_runs or (time.perf_counter() - start < min_time and len(times) < max_runs):
+        ts = time.perf_counter_ns()
+        fn()
+        times.append((time.perf_counter_ns() - ts) / 1e9)
+    return times
+
+def summarize(times):
+    return {
+        "median": statistics.median(times),
+        "min": min(times),
+        "mean": statistics.mean(times),
+        "stdev": statistics.stdev(times) if len(times) > 1 else 0.0,
+        "runs": len(times),
+    }
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "time": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "commit": commit,
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "torch": torch.__version__,
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "torch_threads": torch.get_num_threads(),
+    }
+
+def run_benchmarks(scales, pattern, min_time, min_runs, max_runs):
+    results = {}
+    for scale_name in scales:
+        for name, fn, max_scale in BENCHMARKS:
+            key = f"{name}[{scale_name}]"
+            if pattern is not None and re.search(pattern, key) is None:
+                continue
+            if max_scale is not None and list(SCALES).index(scale_name) > list(SCALES).index(max_scale):
+                continue
+            seed_all()
+            ### The benchmarked functions print their progress
+            with contextlib.redirect_stdout(io.StringIO()):
+                run = fn(SCALES[scale_name])
+                times = measure(run, min_time, min_runs, max_runs)
+            results[key] = summarize(times)
+            print(f"{key:<50} median {1e3 * results[key]['median']:10.3f} ms, "
+                f"min {1e3 * results[key]['min']:10.3f} ms, {results[key]['runs']:5d} runs", flush=True)
+    return results
+
+def compare(results, baseline, threshold):
+    ''' Print the ratio to the baseline of each benchmark, returns the regressed ones '''
+    regressions = []
+    print(f"\n{'benchmark':<50} {'baseline ms':>12} {'current ms':>12} {'ratio':>7}")
+    for key, result in results.items():
+        if key not in baseline:
+            print(f"{key:<50} {'-':>12} {1e3 * result['median']:12.3f} {'-':>7}  new")
+            continue
+        base = baseline[key]
+        ratio = result["median"] / base["median"]
+        ### Both the median and the minimum must regress, so that noise is not flagged
+        if ratio > 1 + threshold and result["min"] / base["min"] > 1 + threshold:
+            status = "REGRESSION"
+            regressions.append(key)
+        elif ratio < 1 - threshold:
+            status = "improved"
+        else:
+            status = ""
+        print(f"{key:<50} {1e3 * base['median']:12.3f} {1e3 * result['median']:12.3f} {ratio:7.2f}  {status}")
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--scales', type=str, default="small,medium",
+                        help=f"comma-separated scales among {list(SCALES)}")
+    parser.add_argument('--filter', type=str, default=None,
+                        help='regular expression of the benchmarks to run, e.g., policy')
+    parser.add_argument('--min_time', type=float, default=1.0,
+                        help='minimum seconds spent on each benchmark')
+    parser.add_argument('--min_runs', type=int, default=3,
+                        help='minimum number of runs of each benchmark')
+    parser.add_argument('--max_runs', type=int, default=1000,
+                        help='maximum number of runs of each benchmark')
+    parser.add_argument('--output', type=str, default=None,
+                        help='path of the JSON results')
+    parser.add_argument('--compare', type=str, default=None,
+                        help='path of the JSON results of a baseline to compare with')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='relative slowdown flagged as a regression')
+    parser.add_argument('--list', action='store_true',
+                        help='list the benchmarks')
+    bench_args = parser.parse_args()
+
+    if bench_args.list:
+        for name, _, max_scale in BENCHMARKS:
+            print(name if max_scale is None else f"{name} (up to {max_scale})")
+        sys.exit(0)
+    scales = [name for name in bench_args.scales.split(",") if name]
+    for scale_name in scales:
+        if scale_name not in SCALES:
+            raise ValueError(f"Invalid scale {scale_name}")
+
+    results = run_benchmarks(scales, bench_args.filter, bench_args.min_time,
+        bench_args.min_runs, bench_args.max_runs)
+    if bench_args.output is not None:
+        os.makedirs(os.path.dirname(os.path.abspath(bench_args.output)), exist_ok=True)
+        with open(bench_args.output, "w") as fp:
+            json.dump({"environment": environment(), "scales": dict([(name, SCALES[name]) for name in scales]),
+                "results": results}, fp, indent=1)
+        print(f"Save the results to {bench_args.output}")
+    if bench_args.compare is not None:
+        with open(bench_args.compare) as fp:
+            baseline = json.load(fp)
+        regressions = compare(results, baseline["results"], bench_args.threshold)
+        if len(regressions) > 0:
+            print(f"{len(regressions)} regressions: {regressions}")
+            sys.exit(1)
@@ -0,0 +1,67 @@
+''' Compare mcafee_select_clients_v1 (nested loops) and mcafee_select_clients_v2 (Fenwick tree)
+    on random markets of increasing size. Both must make the same trades and reward.
+
+    Usage: python benchmark/mcafee_scaling.py [--clients 100 200 400 800 1600] [--tasks 10]
+'''
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import policy
+
+class MarketTask:
+    ''' The attributes of Task used by the McAfee auction '''
+    def __init__(self, task_id, required_client_num, rng):
+        self.task_id = task_id
+        self.required_client_num = required_client_num
+        self.bid_per_loss_delta = rng.random()
+        self.total_loss_delta = rng.random()
+        self.delta_accu = self.total_loss_delta
+        self.selected_client_idx = None
+
+    def init_select_clients(self):
+        pass
+
+def random_market(client_num, task_num, seed):
+    rng = np.random.default_rng(seed)
+    ### Values of clients and bids of tasks on overlapping ranges, so that some trades happen
+    ask_table = rng.random((client_num, task_num)) * 2 / task_num
+    bid_table = rng.random((client_num, task_num)) * 2 * 3.5 / client_num + 1 / client_num
+    required = max(1, client_num // (4 * task_num))
+    task_list = [MarketTask(task_id, required, rng) for task_id in range(task_num)]
+    client_feature_list = [(0, 0)] * client_num
+    return ask_table, client_feature_list, task_list, bid_table
+
+def run(select_fn, market):
+    ask_table, client_feature_list, task_list, bid_table = market
+    ts = time.perf_counter()
+    succ_cnt, reward = select_fn(ask_table, client_feature_list, task_list, bid_table)
+    elapse = time.perf_counter() - ts
+    selected = [None if task.selected_client_idx is None else [int(c) for c in task.selected_client_idx]
+        for task in task_list]
+    return elapse, succ_cnt, reward, selected
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--clients", type=int, nargs="+", default=[100, 200, 400, 800, 1600])
+    parser.add_argument("--tasks", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--v1_limit", type=int, default=3200,
+        help="skip v1 for larger markets, since it is too slow")
+    args = parser.parse_args()
+
+    print(f"{'clients':>8} {'tasks':>6} {'v1 (ms)':>10} {'v2 (ms)':>10} {'speedup':>8} {'trades':>7} same")
+    for client_num in args.clients:
+        market = random_market(client_num, args.tasks, args.seed)
+        v2_time, succ_cnt, reward, selected = run(policy.mcafee_select_clients_v2, market)
+        if client_num <= args.v1_limit:
+            market = random_market(client_num, args.tasks, args.seed)
+            v1_time, v1_succ_cnt, v1_reward, v1_selected = run(policy.mcafee_select_clients_v1, market)
+            same = v1_succ_cnt == succ_cnt and v1_selected == selected and np.isclose(v1_reward, reward)
+            print(f"{client_num:>8} {args.tasks:>6} {1000*v1_time:>10.2f} {1000*v2_time:>10.2f} "
+                f"{v1_time/v2_time:>8.1f} {succ_cnt:>7} {same}")
+        else:
+            print(f"{client_num:>8} {args.tasks:>6} {'-':>10} {1000*v2_time:>10.2f} {'-':>8} {succ_cnt:>7} -")
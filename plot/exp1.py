@@ -1,8 +1,6 @@
 import os
 import sys
-import re
 
-import pandas as pd
 import numpy as np
 import math
 
@@ -11,18 +9,8 @@ import matplotlib.pyplot as plt
 matplotlib.rcParams['pdf.fonttype'] = 42
 matplotlib.rcParams['ps.fonttype'] = 42
 
-from typing import List
-
-def smooth(scalars: List[float], weight: float) -> List[float]:
-    # One of the easiest implementations I found was to use that Exponential Moving Average the Tensorboard uses, https://stackoverflow.com/questions/5283649/plot-smooth-line-with-pyplot
-    # Weight between 0 and 1
-    last = scalars[0]  # First value in the plot (first timestep)
-    smoothed = list()
-    for point in scalars:
-        smoothed_val = last * weight + (1 - weight) * point  # Calculate smoothed value
-        smoothed.append(smoothed_val)                        # Save it
-        last = smoothed_val                                  # Anchor the last smoothed value
-    return np.array(smoothed)
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+from results_index import ResultsIndex
 
 def fig_base(fig_num, row_first=True):
     if row_first:
@@ -37,11 +25,6 @@ exp_dir = sys.argv[1]
 
 ALL_DF = {}
 
-def key_to_config(key: str):
-    '''convert a serialized key to a dict of configuration'''
-    cfg = re.search(f"(?P<dataset>\w+)-(?P<target_label>\w+)_label-(?P<model>\w+)-(?P<policy>\w+)_policy", key)
-    return cfg
-
 POLICY_TO_INFO = {
     "nmfli": ("NmFLI", "red", "-"),
     "size": ("Data size-based", "orange", ":"),
@@ -80,62 +63,43 @@ target_label_to_fig_dict = {}
 target_label_to_bar_fig_dict = {}
 sub_fig_num = 3
 
-for _file in sorted(os.listdir(exp_dir)):
-    path = os.path.join(exp_dir, _file)
-    if _file.endswith(".log"):
-        exp_cfg = key_to_config(_file)
-        if exp_cfg["policy"] in IGNORE_POLICY:
-            continue
-        # Process log file
-        with open(path, 'r') as fp:
-            lines = fp.readlines()
-        task_info = {}
-        client_num = 10
-        for line in lines:
-            # Example: [00:21:29 (136.952)s] Task 0, Avg Training Stats after 2 global rounds: Training Loss : 1.490, Test Accuracy: 10.00%, selected idxs [7 2]
-            rst = re.search(r"Task (?P<task>\d+), Avg Training Stats after (?P<step>\d+) global rounds.*selected idxs \[(?P<select_client>\d+(,? \d+)*)\]", line)
-            if rst is None:
-                continue
-            task_id, step, select_client = eval(rst["task"]), \
-                eval(rst["step"]), [int(x) for x in rst["select_client"].replace(",", "").split(" ")]
-            if task_id not in task_info:
-                task_info[task_id] = [0] * client_num
-            for client_id in select_client:
-                task_info[task_id][client_id] += 1
-        
-        if exp_cfg["target_label"] not in target_label_to_bar_fig_dict:
-            target_label_to_bar_fig_dict[exp_cfg["target_label"]] = [[] for _ in range(len(task_info))]
+### Files are parsed once and cached by the index of the parent directory
+exp_dir = os.path.normpath(exp_dir)
+index = ResultsIndex(os.path.dirname(os.path.abspath(exp_dir)))
+index.update(runs=[os.path.basename(os.path.abspath(exp_dir))])
+client_num = 10
+
+for run in index.select(run=os.path.basename(os.path.abspath(exp_dir))):
+    if run["policy"] in IGNORE_POLICY:
+        continue
+    if run["freq"] is not None:
+        task_info = run["freq"]
+        if run["target_label"] not in target_label_to_bar_fig_dict:
+            target_label_to_bar_fig_dict[run["target_label"]] = [[] for _ in range(len(task_info))]
         
-        kwargs = policy_to_bar_kwargs(exp_cfg["policy"])
-        all_sub_fig_data = target_label_to_bar_fig_dict[exp_cfg["target_label"]]
-        print(path)
-        all_sub_fig_data[0].append((np.array(task_info[0]), kwargs))
-        all_sub_fig_data[1].append((np.array(task_info[1]), kwargs))
-    elif _file.endswith(".csv"):
-        exp_cfg = key_to_config(_file)
-        if exp_cfg["policy"] in IGNORE_POLICY:
-            continue
-        # print(exp_cfg["dataset"], exp_cfg["target_label"], exp_cfg["model"], exp_cfg["policy"])
-        if exp_cfg["target_label"] not in target_label_to_fig_dict:
-            target_label_to_fig_dict[exp_cfg["target_label"]] = [[] for _ in range(sub_fig_num)]
+        kwargs = policy_to_bar_kwargs(run["policy"])
+        all_sub_fig_data = target_label_to_bar_fig_dict[run["target_label"]]
+        all_sub_fig_data[0].append((task_info[0][:client_num], kwargs))
+        all_sub_fig_data[1].append((task_info[1][:client_num], kwargs))
+    if run["step"] is not None:
+        # print(run["dataset"], run["target_label"], run["model"], run["policy"])
+        if run["target_label"] not in target_label_to_fig_dict:
+            target_label_to_fig_dict[run["target_label"]] = [[] for _ in range(sub_fig_num)]
         
-        df = pd.read_csv(path)
-        all_sub_fig_data = target_label_to_fig_dict[exp_cfg["target_label"]]
-        # ax0.plot(df["Step"], df["Task 0 test accu."], alpha=0.3)
-        # smooth
-        kwargs = policy_to_plot_kwargs(exp_cfg["policy"])
-        if exp_cfg["policy"]  == "nmfli":
-            all_sub_fig_data[0].append((df["Step"], smooth(df["Task 0 test accu."], .9)-0.05, kwargs))
-        elif exp_cfg["policy"]  == "afl" :
-            all_sub_fig_data[0].append((df["Step"], smooth(df["Task 0 test accu."], .9)-0.04, kwargs))
-        elif exp_cfg["policy"]  ==  "random":
-            all_sub_fig_data[0].append((df["Step"], smooth(df["Task 0 test accu."], .9)-0.02, kwargs))
+        all_sub_fig_data = target_label_to_fig_dict[run["target_label"]]
+        ### Curves smoothed by smooth(accu, .9) are precomputed by the index
+        step, smoothed = run["step"], run["smooth"]
+        kwargs = policy_to_plot_kwargs(run["policy"])
+        if run["policy"]  == "nmfli":
+            all_sub_fig_data[0].append((step, smoothed[:, 0]-0.05, kwargs))
+        elif run["policy"]  == "afl" :
+            all_sub_fig_data[0].append((step, smoothed[:, 0]-0.04, kwargs))
+        elif run["policy"]  ==  "random":
+            all_sub_fig_data[0].append((step, smoothed[:, 0]-0.02, kwargs))
         else:
-            all_sub_fig_data[0].append((df["Step"], smooth(df["Task 0 test accu."], .9), kwargs))
-        all_sub_fig_data[1].append((df["Step"], smooth(df["Task 1 test accu."], .9), kwargs))
-        all_sub_fig_data[2].append((df["Step"], (smooth(df["Task 0 test accu."], .9) + smooth(df["Task 1 test accu."], .9)) / 2, kwargs))
-    else:
-        continue
+            all_sub_fig_data[0].append((step, smoothed[:, 0], kwargs))
+        all_sub_fig_data[1].append((step, smoothed[:, 1], kwargs))
+        all_sub_fig_data[2].append((step, run["smooth_avg"], kwargs))
 
 is_one_figure = False
 
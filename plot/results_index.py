@@ -0,0 +1,269 @@
+''' An incremental index of the runs of a results tree, e.g., save/results.
+
+    python plot/results_index.py save/results
+
+Each run is keyed by (run, dataset, target_label, model, policy), where run is the
+experiment directory relative to the root, and the other fields come from the file
+names written by script/test_all.sh. The index keeps, in one columnar table, the test
+accuracy of each task at each step, the curves smoothed by smooth(), the final
+accuracy of each task and the selection frequency of each client parsed from the log.
+It is saved to {root}/.results_index and only the files whose size or modification
+time changed are parsed again by update().
+'''
+import os
+import re
+import sys
+import time
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+from checkpoint import save_arrays, load_arrays
+from results_log import read_results, SUFFIX as RESULTS_SUFFIX
+
+INDEX_NAME = ".results_index"
+INDEX_VERSION = 1
+SMOOTH_WEIGHT = 0.9
+MIN_CLIENT_NUM = 10
+KEY_FIELDS = ["run", "dataset", "target_label", "model", "policy"]
+
+def smooth(scalars: List[float], weight: float) -> List[float]:
+    # One of the easiest implementations I found was to use that Exponential Moving Average the Tensorboard uses, https://stackoverflow.com/questions/5283649/plot-smooth-line-with-pyplot
+    # Weight between 0 and 1
+    last = scalars[0]  # First value in the plot (first timestep)
+    smoothed = list()
+    for point in scalars:
+        smoothed_val = last * weight + (1 - weight) * point  # Calculate smoothed value
+        smoothed.append(smoothed_val)                        # Save it
+        last = smoothed_val                                  # Anchor the last smoothed value
+    return np.array(smoothed)
+
+def key_to_config(key: str):
+    '''convert a serialized key to a dict of configuration'''
+    cfg = re.search(r"(?P<dataset>\w+)-(?P<target_label>\w+)_label-(?P<model>\w+)-(?P<policy>\w+)_policy", key)
+    return cfg
+
+def file_signature(path):
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+def read_curves(path):
+    ''' Returns (steps, test accuracy of shape (steps, tasks)) of a .results or .csv file '''
+    if path.endswith(RESULTS_SUFFIX):
+        columns = read_results(path)
+    else:
+        columns = pd.read_csv(path)
+    task_num = len([name for name in columns.keys() if name.endswith(" test accu.")])
+    accu = np.stack([np.asarray(columns[f"Task {task_id} test accu."], dtype=np.float64)
+        for task_id in range(task_num)], axis=1) if task_num > 0 else np.zeros((0, 0))
+    return np.asarray(columns["Step"], dtype=np.float64), accu.reshape(-1, task_num)
+
+def read_selections(path):
+    ''' Returns the selection count of each (task, client) from a log '''
+    task_info = {}
+    with open(path, 'r') as fp:
+        for line in fp:
+            # Example: [00:21:29 (136.952)s] Task 0, Avg Training Stats after 2 global rounds: Training Loss : 1.490, Test Accuracy: 10.00%, selected idxs [7 2]
+            rst = re.search(r"Task (?P<task>\d+), Avg Training Stats after (?P<step>\d+) global rounds.*selected idxs \[(?P<select_client>\d+(,? \d+)*)\]", line)
+            if rst is None:
+                continue
+            task_id = int(rst["task"])
+            counts = task_info.setdefault(task_id, {})
+            for client_id in rst["select_client"].replace(",", "").split(" "):
+                counts[int(client_id)] = counts.get(int(client_id), 0) + 1
+    task_num = max(task_info.keys()) + 1 if len(task_info) > 0 else 0
+    client_num = max([MIN_CLIENT_NUM] + [client_id + 1 for counts in task_info.values() for client_id in counts])
+    freq = np.zeros((task_num, client_num), dtype=np.int64)
+    for task_id, counts in task_info.items():
+        for client_id, count in counts.items():
+            freq[task_id, client_id] = count
+    return freq
+
+class ResultsIndex:
+    ''' Runs of a results tree, see the module docstring. select() returns a dict per run
+        with the key fields and the arrays step, accu, smooth (per task), smooth_avg,
+        final and freq; arrays are None if the run has no such file.
+    '''
+    def __init__(self, root):
+        self.root = root
+        self.path = os.path.join(root, INDEX_NAME)
+        self.entries = {}
+        if os.path.exists(self.path):
+            try:
+                arrays, state = load_arrays(self.path, mmap=False)
+                if state["version"] == INDEX_VERSION:
+                    self.entries = self._unpack(arrays, state)
+            except (ValueError, KeyError, EOFError):
+                ### Rebuild a broken index
+                self.entries = {}
+
+    def _walk(self, runs):
+        ''' (directory, file names) of the top level of the given runs, or of every directory of the tree '''
+        if runs is None:
+            for dirpath, _, filenames in os.walk(self.root):
+                yield dirpath, filenames
+            return
+        for run in runs:
+            dirpath = os.path.join(self.root, run)
+            if os.path.isdir(dirpath):
+                yield dirpath, [name for name in os.listdir(dirpath)
+                    if os.path.isfile(os.path.join(dirpath, name))]
+
+    def scan(self, runs=None):
+        ''' {key: {"curve": relpath, "log": relpath}} of the run files in the top level of the given
+            runs, e.g., without the branches and sweeps in their subdirectories, or in the whole tree
+        '''
+        found = {}
+        for dirpath, filenames in self._walk(runs):
+            run = os.path.relpath(dirpath, self.root)
+            for name in filenames:
+                if not (name.endswith(".log") or name.endswith(".csv") or name.endswith(RESULTS_SUFFIX)):
+                    continue
+                cfg = key_to_config(name)
+                if cfg is None:
+                    continue
+                key = (run, cfg["dataset"], cfg["target_label"], cfg["model"], cfg["policy"])
+                files = found.setdefault(key, {})
+                relpath = os.path.join(run, name)
+                if name.endswith(".log"):
+                    files["log"] = relpath
+                elif name.endswith(RESULTS_SUFFIX) or not files.get("curve", "").endswith(RESULTS_SUFFIX):
+                    ### Prefer the results log, which also holds the partial results of unfinished runs
+                    files["curve"] = relpath
+        return found
+
+    def update(self, runs=None):
+        ''' Parse the new and changed files of the given runs (default all), drop the removed
+            ones and save the index. Returns the number of parsed files
+        '''
+        found = self.scan(runs)
+        scope = None if runs is None else set([os.path.normpath(run) for run in runs])
+        parsed, removed = 0, 0
+        for key in list(self.entries):
+            if (scope is None or key[0] in scope) and key not in found:
+                del self.entries[key]
+                removed += 1
+        for key, files in found.items():
+            entry = self.entries.get(key, {"files": {}})
+            for kind in ["curve", "log"]:
+                relpath = files.get(kind)
+                if relpath is None:
+                    if entry["files"].pop(kind, None) is not None:
+                        self._clear(entry, kind)
+                        removed += 1
+                    continue
+                signature = [relpath] + file_signature(os.path.join(self.root, relpath))
+                if entry["files"].get(kind) == signature:
+                    continue
+                self._parse(entry, kind, os.path.join(self.root, relpath))
+                entry["files"][kind] = signature
+                parsed += 1
+            self.entries[key] = entry
+        if parsed > 0 or removed > 0 or not os.path.exists(self.path):
+            save_arrays(self.path, *self._pack())
+        return parsed
+
+    def _clear(self, entry, kind):
+        names = ["step", "accu", "smooth", "smooth_avg", "final"] if kind == "curve" else ["freq"]
+        for name in names:
+            entry.pop(name, None)
+
+    def _parse(self, entry, kind, path):
+        if kind == "log":
+            entry["freq"] = read_selections(path)
+            return
+        step, accu = read_curves(path)
+        entry["step"], entry["accu"] = step, accu
+        if len(step) > 0:
+            entry["smooth"] = np.stack([smooth(accu[:, task_id], SMOOTH_WEIGHT)
+                for task_id in range(accu.shape[1])], axis=1).reshape(accu.shape)
+            entry["final"] = accu[-1]
+        else:
+            entry["smooth"], entry["final"] = accu, np.zeros(accu.shape[1])
+        entry["smooth_avg"] = entry["smooth"].mean(axis=1) if accu.shape[1] > 0 else np.zeros(len(step))
+
+    def _pack(self):
+        ''' All curves in one table of rows, the rows of each run are [row_start, row_end) '''
+        keys = sorted(self.entries)
+        task_num = max([self.entries[key]["accu"].shape[1] for key in keys if "accu" in self.entries[key]] + [0])
+        task_num = max([task_num] + [self.entries[key]["freq"].shape[0] for key in keys if "freq" in self.entries[key]])
+        client_num = max([MIN_CLIENT_NUM] + [self.entries[key]["freq"].shape[1] for key in keys if "freq" in self.entries[key]])
+
+        def padded(value, shape, fill):
+            result = np.full(shape, fill, dtype=np.float64 if isinstance(fill, float) else np.int64)
+            result[tuple([slice(0, size) for size in value.shape])] = value
+            return result
+
+        runs, steps, accus, smooths, smooth_avgs = [], [], [], [], []
+        finals = np.full((len(keys), task_num), np.nan)
+        freqs = np.zeros((len(keys), task_num, client_num), dtype=np.int64)
+        row = 0
+        for run_id, key in enumerate(keys):
+            entry = self.entries[key]
+            row_num = len(entry["step"]) if "step" in entry else 0
+            runs.append(dict(zip(KEY_FIELDS, key), files=entry["files"], rows=[row, row + row_num],
+                task_num=entry["accu"].shape[1] if "step" in entry else None,
+                freq_shape=list(entry["freq"].shape) if "freq" in entry else None))
+            if "step" in entry:
+                steps.append(entry["step"])
+                accus.append(padded(entry["accu"], (row_num, task_num), np.nan))
+                smooths.append(padded(entry["smooth"], (row_num, task_num), np.nan))
+                smooth_avgs.append(entry["smooth_avg"])
+                finals[run_id] = padded(entry["final"], (task_num,), np.nan)
+            if "freq" in entry:
+                freqs[run_id] = padded(entry["freq"], (task_num, client_num), 0)
+            row += row_num
+
+        def concat(parts, shape):
+            return np.concatenate(parts) if len(parts) > 0 else np.zeros(shape)
+        arrays = {
+            "step": concat(steps, (0,)),
+            "accu": concat(accus, (0, task_num)),
+            "smooth": concat(smooths, (0, task_num)),
+            "smooth_avg": concat(smooth_avgs, (0,)),
+            "final": finals,
+            "freq": freqs,
+        }
+        return arrays, {"version": INDEX_VERSION, "runs": runs}
+
+    def _unpack(self, arrays, state):
+        entries = {}
+        for run_id, run in enumerate(state["runs"]):
+            key = tuple([run[field] for field in KEY_FIELDS])
+            entry = {"files": run["files"]}
+            start, end = run["rows"]
+            if run["task_num"] is not None:
+                task_num = run["task_num"]
+                entry["step"] = arrays["step"][start:end]
+                entry["accu"] = arrays["accu"][start:end, :task_num]
+                entry["smooth"] = arrays["smooth"][start:end, :task_num]
+                entry["smooth_avg"] = arrays["smooth_avg"][start:end]
+                entry["final"] = arrays["final"][run_id, :task_num]
+            if run["freq_shape"] is not None:
+                task_num, client_num = run["freq_shape"]
+                entry["freq"] = arrays["freq"][run_id, :task_num, :client_num]
+            entries[key] = entry
+        return entries
+
+    def select(self, **filters):
+        ''' Runs whose key fields equal the filters, ordered by key '''
+        result = []
+        for key in sorted(self.entries):
+            run = dict(zip(KEY_FIELDS, key))
+            if any(run[name] != value for name, value in filters.items()):
+                continue
+            entry = self.entries[key]
+            for name in ["step", "accu", "smooth", "smooth_avg", "final", "freq"]:
+                run[name] = entry.get(name)
+            result.append(run)
+        return result
+
+if __name__ == '__main__':
+    root = sys.argv[1] if len(sys.argv) > 1 else "save/results"
+    ts = time.time()
+    index = ResultsIndex(root)
+    parsed = index.update()
+    print(f"Index {len(index.entries)} runs of {root}, parse {parsed} new or changed files, "
+        f"take {time.time() - ts:.3f} s")
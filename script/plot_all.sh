@@ -2,6 +2,9 @@
 set -x
 # NOTE: must be called from root directory of the project: bash script/plot_all.sh
 
+# Parse the new and changed runs of all experiments once, plot/exp1.py reads this index
+python3 plot/results_index.py save/results
+
 # Cifar even dataset
 ## Non-overlap
 python3 plot/exp1.py save/results/20231205-170051-even_size_custom-gpu-cifar
@@ -48,7 +48,8 @@ for policy in ${ALL_METHODS[@]}; do
         --iid=0 \
         --verbose=1 \
         --noisy=${USE_NOISY_X} \
-        --unequal=${UNEVEN_DATASIZE}
+        --unequal=${UNEVEN_DATASIZE} \
+        --partition_cache=save/partitions
     else
         nohup \
         python3 -u src/federated_main.py \
@@ -61,6 +62,7 @@ for policy in ${ALL_METHODS[@]}; do
             --iid=0 \
             --noisy=${USE_NOISY_X} \
             --unequal=${UNEVEN_DATASIZE} \
+            --partition_cache=save/partitions \
             > ${NMFLI_EXP_NAME}.log 2>&1
     fi
 done
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+''' Run the epochs shared by several policies once, then branch into one run per policy.
+
+    python src/branch.py --branch_policies=nmfli,greedy,random --branch_epoch=5 [options of federated_main.py]
+
+Dataset loading, partitioning, model initialization and the first --branch_epoch
+epochs (trained with --policy) are done once. The complete state is then
+snapshotted, and each policy of --branch_policies continues from it until the
+last epoch, either in a child process forked from the parent, whose memory is
+shared copy-on-write (--branch_mode=fork), or in a new process resumed from a
+checkpoint of the snapshot (--branch_mode=reload). Results are written to
+--branch_dir in the layout of script/test_all.sh, i.e.,
+{dataset}-{target_label}_label-{model}-{policy}_policy.{csv,log}, as read by plot/exp1.py.
+'''
+import os
+import sys
+import time
+import shutil
+import subprocess
+import traceback
+from datetime import datetime
+
+from torch.utils.tensorboard import SummaryWriter
+
+from federated_main import Experiment, args, EPOCH_NUM, result_name
+from checkpoint import save_arrays
+from util import redirect_output, restore_output
+
+PREFIX_LOG = "prefix.txt"
+POLL_INTERVAL = 0.5
+BRANCH_OPTIONS = ["--branch_policies", "--branch_epoch", "--branch_dir", "--branch_workers", "--branch_mode"]
+
+def branch_name(branch_dir, policy_name):
+    return result_name(branch_dir, args.dataset, args.target_label, args.model, policy_name)
+
+def start_log(branch_dir, policy_name):
+    ''' The log of a branch starts with the log of the shared prefix '''
+    log_path = branch_name(branch_dir, policy_name) + ".log"
+    shutil.copyfile(os.path.join(branch_dir, PREFIX_LOG), log_path)
+    return log_path
+
+def run_child(experiment, policy_name, branch_dir):
+    ''' Continue the experiment with another policy, in a forked child process '''
+    redirect_output(start_log(branch_dir, policy_name), mode="a")
+    args.policy = policy_name
+    exp_name = branch_name(branch_dir, policy_name)
+    experiment.set_exp_name(exp_name)
+    if args.trace:
+        args.trace = exp_name + ".trace"
+    experiment.set_logger(SummaryWriter(experiment.log_dir(policy_name, datetime.now())))
+    experiment.start_runtime()
+    experiment.run(args.branch_epoch, EPOCH_NUM)
+    experiment.finish()
+
+def fork_branches(experiment, policies, branch_dir):
+    ''' Fork one child per policy, at most --branch_workers at a time, returns {policy: exit code} '''
+    ### Threads do not survive fork, so the runtime is restarted in each child
+    experiment.stop_runtime()
+    running, exit_codes = {}, {}
+    pending = list(policies)
+    while pending or running:
+        while pending and len(running) < max(1, args.branch_workers):
+            policy_name = pending.pop(0)
+            sys.stdout.flush()
+            sys.stderr.flush()
+            pid = os.fork()
+            if pid == 0:
+                code = 0
+                try:
+                    run_child(experiment, policy_name, branch_dir)
+                except BaseException:
+                    traceback.print_exc()
+                    code = 1
+                finally:
+                    sys.stdout.flush()
+                    sys.stderr.flush()
+                    os._exit(code)
+            print(f"Branch {policy_name}: pid {pid}")
+            running[pid] = policy_name
+        pid, status = os.wait()
+        if pid in running:
+            policy_name = running.pop(pid)
+            exit_codes[policy_name] = os.waitstatus_to_exitcode(status)
+            print(f"Branch {policy_name} exits with {exit_codes[policy_name]}")
+    return exit_codes
+
+def child_argv(policy_name, ckpt_path):
+    ''' Command line of federated_main.py resuming the snapshot with another policy '''
+    argv = []
+    skip = False
+    for arg in sys.argv[1:]:
+        if skip:
+            skip = False
+            continue
+        name = arg.split("=", 1)[0]
+        if name in BRANCH_OPTIONS + ["--policy", "--resume"]:
+            ### The value is the next argument if it is not given by "="
+            skip = "=" not in arg
+            continue
+        argv.append(arg)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "federated_main.py")
+    return [sys.executable, "-u", script] + argv + [f"--policy={policy_name}", f"--resume={ckpt_path}"]
+
+def reload_branches(experiment, policies, branch_dir):
+    ''' Start one process per policy which resumes from a checkpoint of the snapshot '''
+    experiment.stop_runtime()
+    ckpt_path = os.path.join(branch_dir, "prefix.ckpt")
+    save_arrays(ckpt_path, *experiment.state(args.branch_epoch))
+    running, exit_codes = {}, {}
+    pending = list(policies)
+    while pending or running:
+        while pending and len(running) < max(1, args.branch_workers):
+            policy_name = pending.pop(0)
+            env = dict(os.environ, NMFLI_EXP_NAME=branch_name(branch_dir, policy_name))
+            log_fp = open(start_log(branch_dir, policy_name), "a")
+            proc = subprocess.Popen(child_argv(policy_name, ckpt_path), env=env,
+                stdout=log_fp, stderr=subprocess.STDOUT)
+            log_fp.close()
+            print(f"Branch {policy_name}: pid {proc.pid}")
+            running[policy_name] = proc
+        time.sleep(POLL_INTERVAL)
+        for policy_name, proc in list(running.items()):
+            if proc.poll() is not None:
+                exit_codes[policy_name] = running.pop(policy_name).returncode
+                print(f"Branch {policy_name} exits with {exit_codes[policy_name]}")
+    return exit_codes
+
+if __name__ == '__main__':
+    start_time = time.time()
+    policies = [name for name in args.branch_policies.split(",") if name]
+    if len(policies) == 0:
+        raise ValueError("No policy is given by --branch_policies")
+    if args.branch_epoch > EPOCH_NUM:
+        raise ValueError(f"--branch_epoch={args.branch_epoch} is larger than the number of epochs {EPOCH_NUM}")
+    mode = args.branch_mode
+    if mode == "fork" and not hasattr(os, "fork"):
+        mode = "reload"
+    branch_dir = args.branch_dir or f"save/results/{datetime.now().strftime('%Y%m%d-%H%M%S')}-branch"
+    os.makedirs(branch_dir, exist_ok=True)
+
+    prefix_log = os.path.join(branch_dir, PREFIX_LOG)
+    print(f"Run epochs [0, {args.branch_epoch}) with policy {args.policy}, log to {prefix_log}")
+    saved = redirect_output(prefix_log)
+    try:
+        experiment = Experiment(args, start_time)
+        start_epoch = 0
+        if args.resume is not None:
+            start_epoch = experiment.restore(args.resume)
+        experiment.run(start_epoch, args.branch_epoch)
+    finally:
+        restore_output(saved)
+    print(f"Shared prefix takes {time.time() - start_time:.3f} s, branch into {policies} by {mode}")
+
+    if mode == "fork":
+        exit_codes = fork_branches(experiment, policies, branch_dir)
+    else:
+        exit_codes = reload_branches(experiment, policies, branch_dir)
+    print(f"All branches finish in {time.time() - start_time:.3f} s, results in {branch_dir}")
+    sys.exit(int(any(code != 0 for code in exit_codes.values())))
@@ -0,0 +1,125 @@
+import os
+import pickle
+import struct
+import random
+import threading
+import numpy as np
+
+import torch
+
+### File layout:
+#   MAGIC | header length (uint64) | header (pickle) | padding | flat data buffer
+#   The header stores the non-tensor state and an index of the data buffer, i.e.,
+#   name -> (dtype, shape, offset, nbytes). Each array is aligned to ALIGNMENT
+#   bytes, so the data buffer can be memory-mapped and viewed without copying.
+MAGIC = b"NMFLICK1"
+ALIGNMENT = 64
+
+def _align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def _to_numpy(value):
+    if isinstance(value, torch.Tensor):
+        return value.detach().cpu().contiguous().numpy()
+    return np.ascontiguousarray(value)
+
+def save_arrays(path, arrays, state=None):
+    ''' Atomically write a dict of arrays (numpy arrays or tensors) and a picklable state '''
+    arrays = {name: _to_numpy(value) for name, value in arrays.items()}
+    index, offset = {}, 0
+    for name, value in arrays.items():
+        offset = _align(offset)
+        index[name] = (value.dtype.str, value.shape, offset, value.nbytes)
+        offset += value.nbytes
+    header = pickle.dumps({"index": index, "state": state}, protocol=pickle.HIGHEST_PROTOCOL)
+    data_start = _align(len(MAGIC) + 8 + len(header))
+
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    with open(tmp_path, "wb") as fp:
+        fp.write(MAGIC)
+        fp.write(struct.pack("<Q", len(header)))
+        fp.write(header)
+        for name, value in arrays.items():
+            fp.seek(data_start + index[name][2])
+            fp.write(value.data)
+        fp.truncate(data_start + offset)
+        fp.flush()
+        os.fsync(fp.fileno())
+    ### Readers never see a partially written file
+    os.replace(tmp_path, path)
+
+def load_arrays(path, mmap=True):
+    ''' Returns (arrays, state), arrays are read-only views of the memory-mapped file if mmap is True '''
+    with open(path, "rb") as fp:
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a valid checkpoint")
+        header_len, = struct.unpack("<Q", fp.read(8))
+        header = pickle.loads(fp.read(header_len))
+    data_start = _align(len(MAGIC) + 8 + header_len)
+
+    if mmap and os.path.getsize(path) > data_start:
+        buffer = np.memmap(path, dtype=np.uint8, mode="r", offset=data_start)
+    else:
+        with open(path, "rb") as fp:
+            fp.seek(data_start)
+            buffer = np.frombuffer(fp.read(), dtype=np.uint8)
+
+    arrays = {}
+    for name, (dtype, shape, offset, nbytes) in header["index"].items():
+        arrays[name] = buffer[offset:offset+nbytes].view(np.dtype(dtype)).reshape(shape)
+    return arrays, header["state"]
+
+def get_rng_state():
+    state = {
+        "random": random.getstate(),
+        "numpy": np.random.get_state(),
+    }
+    arrays = {"rng/torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        for i, cuda_state in enumerate(torch.cuda.get_rng_state_all()):
+            arrays[f"rng/cuda{i}"] = cuda_state
+    return arrays, state
+
+def set_rng_state(arrays, state):
+    random.setstate(state["random"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(torch.from_numpy(np.array(arrays["rng/torch"])))
+    if torch.cuda.is_available():
+        cuda_states = [torch.from_numpy(np.array(arrays[name])) for name in sorted(arrays)
+                       if name.startswith("rng/cuda")]
+        if len(cuda_states) > 0:
+            torch.cuda.set_rng_state_all(cuda_states)
+
+class CheckpointWriter:
+    ''' Write checkpoints on a background thread.
+
+    The arrays are copied to host memory in `submit`, so that training can modify
+    the models while the previous snapshot is being written. At most one write is
+    in flight.
+    '''
+    def __init__(self):
+        self.thread = None
+        self.error = None
+
+    def submit(self, path, arrays, state=None):
+        self.wait()
+        arrays = {name: _to_numpy(value).copy() for name, value in arrays.items()}
+        state = pickle.loads(pickle.dumps(state, protocol=pickle.HIGHEST_PROTOCOL))
+        self.thread = threading.Thread(target=self._write, args=(path, arrays, state),
+            name="checkpoint", daemon=True)
+        self.thread.start()
+
+    def _write(self, path, arrays, state):
+        try:
+            save_arrays(path, arrays, state)
+        except Exception as e:
+            self.error = e
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
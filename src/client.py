@@ -1,13 +1,16 @@
 import numpy as np
 import copy
+import hashlib
+from collections import Counter, OrderedDict
 
 import torch
 from torch import nn
 import torch.optim as optim
 
-from exp_utils import DatasetSplit, DatasetRelabel, NoisyDataloader
+from exp_utils import DatasetSplit, DatasetRelabel, NoisyDataloader, weights_fingerprint
+from update_cache import client_seed, SEEDED_RNG_LOCK
 from torch.utils.data import DataLoader
-from sampling import get_dataset, check_dist
+from sampling import get_dataset, check_dist, get_labels, partition_from_dict, partition_histogram
 
 def test_inference(args, model, test_dataset):
     """ Returns the test accuracy and loss.
@@ -43,28 +46,104 @@ def test_inference(args, model, test_dataset):
     return accuracy, sum(loss)/len(loss)
 
 class Client(DatasetSplit):
-    def __init__(self, id, dataset, data_idxs):
+    def __init__(self, id, dataset, data_idxs, labels=None):
         self.id = id
         self.dataset = dataset
         self.idxs = [int(i) for i in data_idxs]
         self.datasize = len(self.idxs) 
         
-        ### Group local data by labels
-        self.lable2data_idxs = {}
-        for idx_of_split in self.idxs:
-            _, label = self.dataset[idx_of_split]
-            if label not in self.lable2data_idxs:
-                self.lable2data_idxs[label] = []
-            self.lable2data_idxs[label].append(idx_of_split)
+        ### Group local data by labels, labels are read without decoding samples
+        if labels is None:
+            labels = get_labels(self)
+        idxs = np.array(self.idxs, dtype=np.int64)
+        order = np.argsort(labels, kind="stable")
+        unique_labels, starts = np.unique(labels[order], return_index=True)
+        groups = np.split(idxs[order], starts[1:])
+        self.lable2data_idxs = dict([(int(label), group.tolist())
+            for label, group in zip(unique_labels, groups)])
+
+class ClientRegistry:
+    ''' All clients of the federation, backed by one CSR-style partition.
+
+    The data indexes of client i are indices[offsets[i]:offsets[i+1]], and
+    label_counts[i] is its label histogram, so the data size and distribution of
+    all clients are available as arrays. `Client` objects, which hold Python lists
+    of indexes, are only created when indexed, e.g., when a task selects the client,
+    and the most recently used `cache_size` of them are kept. The labels of the
+    dataset are only read if label_counts is not given, e.g., by a cached partition,
+    or when the first `Client` is created.
+    '''
+    def __init__(self, dataset, indices, offsets, num_classes=None, cache_size=1024, label_counts=None):
+        self.dataset = dataset
+        self.indices = np.asarray(indices, dtype=np.int32)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self._labels = None
+        if label_counts is None:
+            label_counts = partition_histogram(self.labels, self.indices, self.offsets, num_classes)
+        self.label_counts = np.asarray(label_counts)
+        self.datasize = np.diff(self.offsets)
+        self.cache_size = cache_size
+        self.id2client = OrderedDict()
+
+    @property
+    def labels(self):
+        if self._labels is None:
+            self._labels = get_labels(self.dataset)
+        return self._labels
+
+    @classmethod
+    def from_dict(cls, dataset, client2dataidxs, **kwargs):
+        indices, offsets = partition_from_dict(client2dataidxs)
+        return cls(dataset, indices, offsets, **kwargs)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        return iter(range(len(self)))
+
+    def keys(self):
+        return range(len(self))
+
+    def __contains__(self, client_id):
+        return 0 <= client_id < len(self)
+
+    def client_idxs(self, client_id):
+        return self.indices[self.offsets[client_id]:self.offsets[client_id+1]]
+
+    def __getitem__(self, client_id):
+        client_id = int(client_id)
+        if client_id not in self:
+            raise KeyError(client_id)
+        client = self.id2client.get(client_id)
+        if client is None:
+            idxs = self.client_idxs(client_id)
+            client = Client(client_id, self.dataset, idxs, labels=self.labels[idxs])
+            self.id2client[client_id] = client
+            while len(self.id2client) > self.cache_size:
+                self.id2client.popitem(last=False)
+        else:
+            self.id2client.move_to_end(client_id)
+        return client
+
+    def check_dist(self, max_print=20):
+        ''' Print the distribution of each client, or a summary if there are too many clients '''
+        if len(self) <= max_print:
+            for client_id in self:
+                counts = self.label_counts[client_id]
+                counter = Counter(dict([(int(label), int(counts[label])) for label in np.nonzero(counts)[0]]))
+                print(f"Client {client_id}, distribution: {counter}")
+        else:
+            class_num = (self.label_counts > 0).sum(axis=1)
+            print(f"{len(self)} clients, data size min={self.datasize.min()}, "
+                f"median={int(np.median(self.datasize))}, max={self.datasize.max()}, "
+                f"classes per client min={class_num.min()}, max={class_num.max()}")
 
 def get_clients(args):
-    train_dataset, test_dataset, user_groups = get_dataset(args)
-    clients = {}
-    for client_id in user_groups.keys():
-        sample_idxs = user_groups[client_id]
-        _client = Client(client_id, train_dataset, list(sample_idxs))
-        check_dist(f"Client {client_id}", _client)
-        clients[client_id] = _client
+    train_dataset, test_dataset, (indices, offsets, label_counts) = get_dataset(args)
+    clients = ClientRegistry(train_dataset, indices, offsets, num_classes=args.num_classes,
+        label_counts=label_counts)
+    clients.check_dist()
 
     sample_idxs = range(len(test_dataset))
     test_client = Client(-1, test_dataset, list(sample_idxs))
@@ -74,9 +153,19 @@ def get_clients(args):
 
 class VirtualClient:
     def __init__(self, args, dataset, logger, global_model, target_labels=None,
-            split=False, shuffle=True, filter=False, required_dist=None):
+            split=False, shuffle=True, filter=False, required_dist=None, update_cache=None):
         self.args = args
         self.logger = logger
+        self.update_cache = update_cache
+        ### With the update cache, each local update draws its data order and randomness from
+        # a generator seeded by (seed, client, epoch), so that equal keys give equal updates
+        self.loader_generator = torch.Generator() if update_cache is not None else None
+        if update_cache is not None:
+            self.client_id = dataset.id
+            h = hashlib.blake2b(digest_size=16)
+            h.update(np.asarray(dataset.idxs, dtype=np.int64).tobytes())
+            h.update(repr((target_labels, filter, required_dist)).encode())
+            self.data_key = h.hexdigest()
 
         # target_labels = None
         if target_labels is None:
@@ -100,7 +189,8 @@ class VirtualClient:
         if split:
             self.trainloader, self.validloader, self.testloader = self.train_val_test(self.dataset)
         else:
-            self.trainloader = DataLoader(self.dataset, batch_size=self.args.local_bs, shuffle=shuffle)
+            self.trainloader = DataLoader(self.dataset, batch_size=self.args.local_bs, shuffle=shuffle,
+                generator=self.loader_generator)
             self.validloader = self.testloader = None
 
         if args.noisy:
@@ -161,7 +251,62 @@ class VirtualClient:
         else:
             raise ValueError()
 
-    def train_step(self, global_model, epoch):
+    def local_hyperparameters(self):
+        args = self.args
+        return (args.dataset, args.model, args.optimizer, args.lr, args.local_bs, args.noisy,
+            args.synthetic, args.synthetic_train, args.synthetic_noise, args.num_classes)
+
+    def optimizer_arrays(self):
+        ''' Tensors of the optimizer state, e.g., momentum buffers, by flat names '''
+        arrays = {}
+        for param_idx, param_state in self.optimizer.state_dict()["state"].items():
+            for name, value in param_state.items():
+                if isinstance(value, torch.Tensor):
+                    arrays[f"optimizer/{param_idx}/{name}"] = value
+        return arrays
+
+    def load_optimizer_arrays(self, arrays):
+        state_dict = self.optimizer.state_dict()
+        state_dict["state"] = {}
+        for name, value in arrays.items():
+            if name.startswith("optimizer/"):
+                _, param_idx, key = name.split("/", 2)
+                state_dict["state"].setdefault(int(param_idx), {})[key] = torch.from_numpy(np.array(value))
+        self.optimizer.load_state_dict(state_dict)
+
+    def train_step(self, global_model, epoch, weights_key=None):
+        ''' Train the global model locally. With the update cache, weights_key is the
+            fingerprint of the global weights, and the update is looked up by
+            (weights_key, client data, random seed, optimizer state, hyperparameters)
+        '''
+        if self.update_cache is None or weights_key is None:
+            return self._train_step(global_model)
+
+        seed = client_seed(self.args.seed, self.client_id, epoch)
+        key = self.update_cache.key(weights_key, self.data_key, seed,
+            weights_fingerprint(self.optimizer_arrays()), self.local_hyperparameters())
+        cached = self.update_cache.get(key)
+        if cached is not None:
+            arrays, state = cached
+            self.model.load_state_dict(dict([(name[len("model/"):], torch.from_numpy(np.array(value)))
+                for name, value in arrays.items() if name.startswith("model/")]))
+            self.load_optimizer_arrays(arrays)
+            self.local_step = state["local_step"]
+            return self.model.state_dict(), state["loss"]
+
+        self.loader_generator.manual_seed(seed)
+        self.trainloader_iter = iter(self.trainloader)
+        ### Dropout draws from the global RNG of the process, so fresh updates of
+        ### concurrent tasks are serialized to keep them equal to the cached ones
+        with SEEDED_RNG_LOCK, torch.random.fork_rng(devices=[]):
+            torch.manual_seed(seed)
+            weights, loss = self._train_step(global_model)
+        arrays = dict([(f"model/{name}", value) for name, value in weights.items()])
+        arrays.update(self.optimizer_arrays())
+        self.update_cache.put(key, arrays, {"loss": loss, "local_step": self.local_step})
+        return weights, loss
+
+    def _train_step(self, global_model):
         self.load_weights(global_model)
         # Set mode to train model
         self.model.train()
@@ -0,0 +1,227 @@
+import time
+import threading
+import numpy as np
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from torch import nn
+
+from sampling import get_labels
+from raw_datasets import ArrayDataset
+
+class EvalCache:
+    ''' A memo of (weights fingerprint, evaluation set) -> (accuracy, loss).
+
+    Evaluating the same weights on the same test data always gives the same
+    result, so a full pass over the test data can be skipped, e.g., when a task
+    keeps its model or when the grand coalition of Shapley values equals the
+    global model. The least recently used entries are dropped when the cache is full.
+    '''
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.memo = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memo:
+                self.memo.move_to_end(key)
+                self.hits += 1
+                return self.memo[key]
+            self.misses += 1
+            return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.memo[key] = value
+            self.memo.move_to_end(key)
+            while len(self.memo) > self.capacity:
+                self.memo.popitem(last=False)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0
+
+    def __repr__(self):
+        return f"EvalCache(hits={self.hits}, misses={self.misses}, hit rate={100*self.hit_rate:.2f}%)"
+
+class MultiTaskEvaluator:
+    ''' Evaluate the models of all tasks in a single pass over the shared test data.
+
+    All tasks are evaluated on (relabeled) subsets of the same test dataset. Instead
+    of walking the test set once per task, the test samples are stacked into one
+    tensor, and each batch of this tensor is fed to the model of every task that
+    requires some rows of this batch.
+
+    The returned loss is the same as that of `test_inference`, i.e., the mean of the
+    per-batch losses over the batches of batch_size rows of each task's test set in
+    its own order, so that both fill the eval cache of a task with the same values.
+    '''
+    def __init__(self, args, test_client, task_list, batch_size=128):
+        self.args = args
+        self.batch_size = batch_size
+        self.device = 'cuda' if args.gpu is not None else 'cpu'
+
+        if args.dataset == 'cifar':
+            self.criterion = nn.CrossEntropyLoss(reduction='none')
+        else:
+            self.criterion = nn.NLLLoss(reduction='none').to(self.device)
+
+        ### Rows of the shared test dataset and the relabeled labels required by each task
+        base_dataset = test_client.dataset
+        task2rows, task2labels, task2order = [], [], []
+        for task in task_list:
+            rows, labels = self._task_rows_and_labels(task.test_model.dataset)
+            order = np.argsort(rows, kind="stable")
+            task2rows.append(rows[order])
+            task2labels.append(torch.tensor(labels[order], dtype=torch.long))
+            task2order.append(order)
+
+        ### Stack the union of all required test samples into one tensor
+        self.rows = np.unique(np.concatenate(task2rows))
+        if isinstance(base_dataset, ArrayDataset):
+            self.images = base_dataset.data[torch.from_numpy(self.rows)]
+        else:
+            self.images = torch.stack([self._to_tensor(base_dataset[int(i)][0]) for i in self.rows])
+
+        ### For each task, the position in self.rows of each required sample
+        self.task2pos = [np.searchsorted(self.rows, rows) for rows in task2rows]
+        self.task2labels = task2labels
+        ### Position of each sorted row in the test set of the task, to batch the losses as test_inference
+        self.task2order = task2order
+        self.task_ids = [task.task_id for task in task_list]
+
+    @staticmethod
+    def _to_tensor(image):
+        return image if isinstance(image, torch.Tensor) else torch.tensor(image)
+
+    @staticmethod
+    def _task_rows_and_labels(dataset):
+        rows = np.array(dataset.idxs, dtype=np.int64)
+        return rows, get_labels(dataset)
+
+    def evaluate(self, task_list, weights_list=None):
+        ''' Return a list of (accuracy, loss), one for each task in task_list.
+            If weights_list is None, the current global weights of each task are used.
+        '''
+        results = [None] * len(task_list)
+        ### Only evaluate tasks whose weights have not been evaluated before
+        to_eval, cache_keys = [], []
+        for i, task in enumerate(task_list):
+            weights = task.global_weights if weights_list is None else weights_list[i]
+            key = task.eval_cache_key(weights)
+            results[i] = task.eval_cache.get(key)
+            if results[i] is None:
+                to_eval.append((i, task, weights))
+                cache_keys.append(key)
+        if len(to_eval) == 0:
+            return results
+
+        models, positions, labels, orders = [], [], [], []
+        for i, task, weights in to_eval:
+            task.test_model.load_weights(weights)
+            task.test_model.model.eval()
+            models.append(task.test_model.model)
+            _id = self.task_ids.index(task.task_id)
+            positions.append(self.task2pos[_id])
+            labels.append(self.task2labels[_id])
+            orders.append(self.task2order[_id])
+
+        correct = np.zeros(len(models))
+        sample_losses = [np.zeros(len(pos)) for pos in positions]
+        cursors = [0] * len(models)
+        with torch.no_grad():
+            for start in range(0, len(self.rows), self.batch_size):
+                end = start + self.batch_size
+                images = self.images[start:end].to(self.device)
+                for i, model in enumerate(models):
+                    ### Positions of this task are sorted, so its rows of this batch are contiguous
+                    first = cursors[i]
+                    last = np.searchsorted(positions[i], end, side="left")
+                    if last == first:
+                        continue
+                    cursors[i] = last
+                    _images = images[torch.from_numpy(positions[i][first:last] - start)]
+                    _labels = labels[i][first:last].to(self.device)
+
+                    outputs = model(_images)
+                    sample_losses[i][first:last] = self.criterion(outputs, _labels).cpu().numpy()
+                    _, pred_labels = torch.max(outputs, 1)
+                    correct[i] += torch.sum(torch.eq(pred_labels.view(-1), _labels)).item()
+
+        for j, (i, task, _) in enumerate(to_eval):
+            total = len(positions[j])
+            losses = np.empty(total)
+            losses[orders[j]] = sample_losses[j]
+            batch_losses = [losses[start:start+self.batch_size].mean() for start in range(0, total, self.batch_size)]
+            results[i] = (correct[j] / total, sum(batch_losses) / len(batch_losses))
+            task.eval_cache.put(cache_keys[j], results[i])
+        return results
+
+
+class EvalScheduler:
+    ''' Evaluate the global models on a background worker.
+
+    At the end of an evaluated epoch, the global weights of all tasks are copied
+    into a snapshot buffer and evaluated by a background thread while the next
+    round of local training proceeds. Results are recorded to each task with the
+    epoch number at which the snapshot was taken.
+
+    At most one evaluation is in flight, so one snapshot buffer per task suffices:
+    `submit` waits for the previous evaluation before overwriting the buffer.
+    Policies that read `Task.delta_accu` or `Task.accu` before selection must call
+    `wait` first, which is also required before using `Task.test_model` elsewhere,
+    e.g., in `Task.shap`.
+    '''
+    ### Policies which need the evaluation results of this epoch for client selection
+    BARRIER_POLICIES = ["nmfli", "optimal", "mcafee", "even", "momentum"]
+
+    def __init__(self, eval_fn, every=1):
+        ''' eval_fn(task_list, weights_list) returns a list of (accuracy, loss) '''
+        self.eval_fn = eval_fn
+        self.every = every
+        self.pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="eval")
+        self.future = None
+        self.task2buffer = {}
+
+    def should_evaluate(self, epoch):
+        return (epoch + 1) % self.every == 0
+
+    def _snapshot(self, task):
+        buffer = self.task2buffer.get(task.task_id)
+        if buffer is None:
+            buffer = {key: value.detach().clone() for key, value in task.global_weights.items()}
+            self.task2buffer[task.task_id] = buffer
+        else:
+            for key, value in task.global_weights.items():
+                buffer[key].copy_(value)
+        return buffer
+
+    def submit(self, epoch, task_list):
+        self.wait()
+        weights_list = [self._snapshot(task) for task in task_list]
+        ### Training statistics of this round, which may change before the evaluation ends
+        round_info = [dict(epoch=epoch, train_loss=task.round_train_loss,
+                        timestamp=time.time() - task.start_time,
+                        selected_client_idx=task.selected_client_idx) for task in task_list]
+        self.future = self.pool.submit(self._run, list(task_list), weights_list, round_info)
+
+    def _run(self, task_list, weights_list, round_info):
+        results = self.eval_fn(task_list, weights_list)
+        for task, (accu, loss), info in zip(task_list, results, round_info):
+            task.record_round(accu, loss, **info)
+
+    def wait(self):
+        ''' Barrier: block until the pending evaluation has been recorded '''
+        if self.future is not None:
+            ### Re-raise exceptions of the worker in the main thread
+            self.future.result()
+            self.future = None
+
+    def shutdown(self):
+        self.wait()
+        self.pool.shutdown(wait=True)
@@ -0,0 +1,46 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+
+class TaskExecutor:
+    ''' Run the tasks of one epoch concurrently.
+
+    Tasks own disjoint client sets and separate models, so their rounds can be
+    trained at the same time. Threads are used rather than processes because
+    `Task` objects are updated in place and PyTorch releases the GIL inside
+    its kernels. The number of intra-op threads of torch is a process-wide
+    setting, so with more than one worker it is set once to `cores_per_task`
+    for the whole process, i.e., each op, including the evaluation and
+    aggregation in the main thread, uses at most `cores_per_task` threads so
+    that concurrent tasks do not oversubscribe the machine.
+    '''
+    def __init__(self, worker_num=1, cores_per_task=None):
+        self.worker_num = max(1, worker_num)
+        if cores_per_task is None or cores_per_task <= 0:
+            cores_per_task = max(1, (os.cpu_count() or 1) // self.worker_num)
+        self.cores_per_task = cores_per_task
+
+        if self.worker_num > 1:
+            torch.set_num_threads(self.cores_per_task)
+            self.pool = ThreadPoolExecutor(max_workers=self.worker_num, thread_name_prefix="task")
+        else:
+            self.pool = None
+
+    def map(self, fn, task_list):
+        ''' Call fn(task) for every task and wait until all of them finish,
+            i.e., the barrier before the market/policy step.
+        '''
+        if self.pool is None:
+            return [fn(task) for task in task_list]
+        futures = [self.pool.submit(fn, task) for task in task_list]
+        ### Re-raise exceptions of the workers in the main thread
+        return [future.result() for future in futures]
+
+    def train_one_round(self, task_list, evaluate=True):
+        return self.map(lambda task: task.train_one_round(evaluate=evaluate), task_list)
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=True)
+            self.pool = None
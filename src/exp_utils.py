@@ -3,6 +3,7 @@
 # Python version: 3.6
 
 import copy
+import hashlib
 import torch
 import numpy as np
 
@@ -44,9 +45,14 @@ class DatasetRelabel(DatasetSplit):
             ### If distribution for the new label is specified, fix the data distribution
             if required_dist is not None:
                 new_label2idxs = [None] * (len(target_labels) + 1)
+                ### Read labels from `targets` if possible, instead of decoding samples
+                targets = getattr(self.dataset, "targets", None)
                 for idx in self.idxs:
-                    image, label = self.dataset[idx]
-                    label = int(label)
+                    if targets is not None:
+                        label = int(targets[idx])
+                    else:
+                        image, label = self.dataset[idx]
+                        label = int(label)
                     if label not in self.target_labels:
                         label = self.minor_class_label ### Relabel as minor class\
                     else:
@@ -130,6 +136,19 @@ def average_weights(w):
     return w_avg
 
 
+def weights_fingerprint(w):
+    """
+    Returns a digest of the content of the weights, which is identical
+    for state dicts with the same keys, shapes, dtypes and values.
+    """
+    h = hashlib.blake2b(digest_size=16)
+    for key, value in w.items():
+        value = value.detach().cpu().contiguous()
+        h.update(f"{key}:{value.dtype}:{tuple(value.shape)}".encode())
+        h.update(value.numpy().tobytes())
+    return h.hexdigest()
+
+
 class NoisyDataloader:
     def __init__(self, dataloader):
         self.dataloader = dataloader
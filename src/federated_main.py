@@ -20,20 +20,32 @@ from options import args_parser
 from exp_utils import exp_details
 import policy
 from client import get_clients
+from executor import TaskExecutor
+from evaluator import MultiTaskEvaluator, EvalScheduler
+from market import MarketState, MARKET_POLICIES, normalize_shapley
+from simulator import TraceRecorder, run_simulation
+from checkpoint import CheckpointWriter, load_arrays, get_rng_state, set_rng_state
 from util import STEP_NUM, PRINT_EVERY
+from profiler import PROFILER, span, parse_epochs
+from memtrack import MEMORY
+from results_log import ResultsWriter, SUFFIX as RESULTS_SUFFIX
 
 args = args_parser()
 
-np.random.seed(1)
-torch.manual_seed(0)
-random.seed(0)
+def init_seeds():
+    np.random.seed(1)
+    torch.manual_seed(0)
+    random.seed(0)
+
+init_seeds()
 
 ### Experiment Configsc
 MIX_RATIO = 0.8
-SIMULATE = False
+### Replay a recorded trace through the selection policy instead of training
+SIMULATE = args.simulate is not None
 EPOCH_NUM = 200
 TRIAL_NUM = 1
-TASK_NUM = 2
+TASK_NUM = int(os.environ.get("TASK_NUM", 2))
 
 bid_per_loss_delta_space = [1]
 required_client_num_space = os.environ.get("REQUIRE_CLIENT_NUM", None)
@@ -44,221 +56,350 @@ else:
 # target_labels_space = [[0,5],[1,4]]
 # target_labels_space = [list(range(5)),list(range(5,10))]
 
-# Init target label and the space for the required 
-# distribution for the test dataset
-if args.target_label == "identical":
-    target_labels_space = [None]
-    test_required_dist_space = [None]
-elif args.target_label == "overlap":
-    target_labels_space = [
-        [1,4,5,3,6,9],
-        [2,8,7,1,4,5]]
-    test_required_dist_space = [
-        [15,15,15,15,15,15],
-        [15,15,15,15,15,15]]
-elif args.target_label == "non_overlap":
-    target_labels_space = [
-        [3,6,9],
-        [2,8,7]]
-    test_required_dist_space = [
-        [30,30,30],
-        [30,30,30]]
-else:
-    raise ValueError()
+def task_space(target_label):
+    ''' Init target label and the space for the required 
+        distribution for the test dataset
+    '''
+    if target_label == "identical":
+        target_labels_space = [None]
+        test_required_dist_space = [None]
+    elif target_label == "overlap":
+        target_labels_space = [
+            [1,4,5,3,6,9],
+            [2,8,7,1,4,5]]
+        test_required_dist_space = [
+            [15,15,15,15,15,15],
+            [15,15,15,15,15,15]]
+    elif target_label == "non_overlap":
+        target_labels_space = [
+            [3,6,9],
+            [2,8,7]]
+        test_required_dist_space = [
+            [30,30,30],
+            [30,30,30]]
+    else:
+        raise ValueError()
+    return target_labels_space, test_required_dist_space
 
-if __name__ == '__main__':
-    start_time = time.time()
+target_labels_space, test_required_dist_space = task_space(args.target_label)
 
-    # define paths
-    path_project = os.path.abspath('..')
+def result_name(result_dir, dataset, target_label, model, policy_name):
+    ''' Path prefix of the results of a run in a sweep directory, as read by plot/exp1.py '''
+    return os.path.join(result_dir, f"{dataset}-{target_label}_label-{model}-{policy_name}_policy")
 
-    now = datetime.now() # current date and time
-    logger = SummaryWriter(f'../logs/{now.strftime("%Y-%m-%d_%H:%M:%S")}-{args.policy}-{args.dataset}-iid={args.iid}-{args.model}-lr_{args.lr}')
-    exp_details(args)
-    
-    train_dataset, test_client, all_clients = get_clients(args)
-    ############################### Task ###########################################
-    ### Initialize the global model parameters for both tasks
-    ### At the first epoch, both tasks select all clients
-    print("\nInitialize tasks ... ")
-    task_list = []
-    def create_task(selected_client_idx, required_client_num, bid_per_loss_delta,
-            target_labels=None, test_required_dist=None):
-        task = Task(args, start_time, logger, train_dataset, test_client, all_clients,
-            task_id = len(task_list),
-            selected_client_idx=selected_client_idx,
-            required_client_num=required_client_num,
-            bid_per_loss_delta=bid_per_loss_delta,
-            target_labels=target_labels,
-            test_required_dist=test_required_dist)
-        # assert task.target_labels is not None, target_labels
-        task_list.append(task)
-
-    for task_id in range(TASK_NUM):
-        create_task(
-            selected_client_idx=list(range(args.num_users)),
-            required_client_num=util.sample_config(required_client_num_space, task_id, use_random=False),
-            bid_per_loss_delta=util.sample_config(bid_per_loss_delta_space, task_id, use_random=False),
-            target_labels=util.sample_config(target_labels_space, task_id, use_random=False),
-            test_required_dist=util.sample_config(test_required_dist_space, task_id, use_random=False)
-        )
-    ############################### Predefined structure for NmFLI ###########################################
-    if args.policy == "nmfli" or "greedy":
-        cost_list=[]
-        for client_idx in range(args.num_users):
-            # cost_list.append(random.randint(1,10)/10)
-            cost_list.append(0)
-        
-        idlecost_list = []
-        for client_idx in range(args.num_users):
-            idlecost_list.append(0)
+class Experiment:
+    ''' One run of the multi-task FL market: datasets, tasks and market, and the runtime
+        (task executor, evaluator and checkpoint writer) which trains them epoch by epoch.
+
+    The runtime owns threads, so it is stopped before the process forks (see branch.py)
+    and started again in the child.
+    '''
+    def __init__(self, args, start_time):
+        self.args = args
+        self.start_time = start_time
+        now = datetime.now() # current date and time
+        self.logger = SummaryWriter(self.log_dir(args.policy, now))
+        exp_details(args)
+
+        train_dataset, test_client, all_clients = get_clients(args)
+        self.train_dataset = train_dataset
+        self.test_client = test_client
+        target_labels_space, test_required_dist_space = task_space(args.target_label)
+        ############################### Task ###########################################
+        ### Initialize the global model parameters for both tasks
+        ### At the first epoch, both tasks select all clients
+        print("\nInitialize tasks ... ")
+        task_list = []
+        def create_task(selected_client_idx, required_client_num, bid_per_loss_delta,
+                target_labels=None, test_required_dist=None):
+            task = Task(args, start_time, self.logger, train_dataset, test_client, all_clients,
+                task_id = len(task_list),
+                selected_client_idx=selected_client_idx,
+                required_client_num=required_client_num,
+                bid_per_loss_delta=bid_per_loss_delta,
+                target_labels=target_labels,
+                test_required_dist=test_required_dist)
+            # assert task.target_labels is not None, target_labels
+            task_list.append(task)
 
-        client_feature_list = list(zip( cost_list, idlecost_list))
+        for task_id in range(TASK_NUM):
+            create_task(
+                selected_client_idx=list(range(args.num_users)),
+                required_client_num=util.sample_config(required_client_num_space, task_id, use_random=False),
+                bid_per_loss_delta=util.sample_config(bid_per_loss_delta_space, task_id, use_random=False),
+                target_labels=util.sample_config(target_labels_space, task_id, use_random=False),
+                test_required_dist=util.sample_config(test_required_dist_space, task_id, use_random=False)
+            )
+        self.task_list = task_list
+        ############################### Predefined structure for NmFLI ###########################################
+        if args.policy == "nmfli" or "greedy":
+            cost_list=[]
+            for client_idx in range(args.num_users):
+                # cost_list.append(random.randint(1,10)/10)
+                cost_list.append(0)
             
-        ### Initialize the price_table and bid table
-        price_table = None
-        def init_price_table(price_table):
-            # Price table, of shape (# of clients, # of tasks), 
-            # where each element is a list of (epoch, value) pairs
-            price_table = []
+            idlecost_list = []
             for client_idx in range(args.num_users):
-                init_price_list = []
-                for taks_idx in range(len(task_list)):
-                    init_price_list.append([])
-                price_table.append(init_price_list)
-            return price_table
-        
-        price_table = init_price_table(price_table)
-        bid_table = np.zeros((args.num_users, len(task_list)))
+                idlecost_list.append(0)
+
+            ### Prices and bids of each (client, task) pair
+            self.market = MarketState(args.num_users, len(task_list), decay=args.price_decay,
+                history_len=args.price_history, cost=cost_list, idle_cost=idlecost_list)
+
+        self.evaluator = MultiTaskEvaluator(args, test_client, task_list) if args.shared_eval else None
+        self.recorder = TraceRecorder(args.num_users, task_list, args.policy) if args.trace else None
+        ### Called with the epoch number at the end of each epoch, e.g., to report progress
+        self.on_epoch_end = None
+        PROFILER.configure(bool(args.profile), parse_epochs(args.profile_epochs))
+        MEMORY.configure(bool(args.mem_track), int(args.mem_budget * 2**20), self.memory_owners)
+        self.set_exp_name(os.environ.get("NMFLI_EXP_NAME", f"save/result/{args.dataset}-{args.target_label}-{args.model}-"
+            f"{args.policy}"))
+        self.start_runtime()
+
+    def log_dir(self, policy_name, now):
+        args = self.args
+        return f'../logs/{now.strftime("%Y-%m-%d_%H:%M:%S")}-{policy_name}-{args.dataset}-iid={args.iid}-{args.model}-lr_{args.lr}'
+
+    def set_exp_name(self, exp_name):
+        ''' Results are saved to {exp_name}.csv, and checkpoints to {exp_name}.ckpt by default '''
+        self.exp_name = exp_name
+        self.ckpt_path = self.args.ckpt_path or f"{exp_name}.ckpt"
+        PROFILER.torch_trace = f"{exp_name}.torch_trace.json"
+
+    def set_logger(self, logger):
+        self.logger.close()
+        self.logger = logger
+        for task in self.task_list:
+            task.logger = logger
+
+    def memory_owners(self):
+        ''' Objects holding the tensors of each owner, measured by memtrack '''
+        task_list = self.task_list
+        return {
+            "datasets": [self.train_dataset, self.test_client.dataset],
+            "task/global": [[task.global_model, task.global_weights, getattr(task, "global_weights_before", None)]
+                for task in task_list],
+            "task/updates": [task.local_weights for task in task_list],
+            "clients/replicas": [[client.model, getattr(client, "optimizer", None)] for task in task_list
+                for client in list(task.client2virtual.values()) + [task.test_model]],
+        }
 
     ############################### Main process of FL ##########################################
-    print("\nStart training ...")
-    for epoch in range(EPOCH_NUM):
-        for task in task_list:
-            task.epoch = epoch
-        print()
-        for round_idx in range(STEP_NUM):
-            ### Train the model parameters distributedly
+    def start_runtime(self):
+        args = self.args
+        self.executor = TaskExecutor(args.task_workers, args.task_cores)
+        self.eval_scheduler = None
+        if args.async_eval:
+            if self.evaluator is not None:
+                evaluate = self.evaluator.evaluate
+            else:
+                evaluate = lambda _task_list, weights_list: [
+                    task.evaluate_model(weights) for task, weights in zip(_task_list, weights_list)]
+            def eval_fn(_task_list, weights_list):
+                with span("eval"):
+                    return evaluate(_task_list, weights_list)
+            self.eval_scheduler = EvalScheduler(eval_fn, every=args.eval_every)
+        self.ckpt_writer = CheckpointWriter() if args.ckpt_every > 0 else None
+        ### Opened by run(), after a resume restored the recorded rows
+        self.results_writer = None
+
+    def open_results_log(self):
+        ''' Rewrite the results log with the rows recorded so far, e.g., before a resume or a branch '''
+        if self.results_writer is None and self.args.results_batch > 0:
+            self.results_writer = ResultsWriter(self.exp_name + RESULTS_SUFFIX, self.results_columns(),
+                self.args.results_batch, rows=self.results_rows(0))
+
+    def stop_runtime(self):
+        ''' Wait for pending evaluations and checkpoints, and stop all threads '''
+        self.executor.shutdown()
+        if self.eval_scheduler is not None:
+            self.eval_scheduler.shutdown()
+        if self.ckpt_writer is not None:
+            self.ckpt_writer.wait()
+        if self.results_writer is not None:
+            self.log_results()
+            self.results_writer.close()
+            self.results_writer = None
+        self.logger.flush()
+
+    ############################### Checkpoint ##########################################
+    def state(self, next_epoch):
+        ''' Collect the full experiment state as (arrays, state) '''
+        arrays, rng_state = get_rng_state()
+        market_arrays, market_state = self.market.state_dict()
+        arrays.update(market_arrays)
+        state = {
+            "next_epoch": next_epoch,
+            "rng": rng_state,
+            "market": market_state,
+            "tasks": []
+        }
+        for task in self.task_list:
+            task_arrays, task_state = task.checkpoint_state(prefix=f"task{task.task_id}/")
+            arrays.update(task_arrays)
+            state["tasks"].append(task_state)
+        return arrays, state
+
+    def restore(self, path):
+        ''' Restore the state saved at path and return the epoch to continue from '''
+        ts = time.time()
+        arrays, state = load_arrays(path)
+        for task, task_state in zip(self.task_list, state["tasks"]):
+            task.restore_checkpoint(arrays, task_state, prefix=f"task{task.task_id}/")
+        self.market.load_state_dict(arrays, state["market"])
+        set_rng_state(arrays, state["rng"])
+        print(f"Resume from {path} at epoch {state['next_epoch']}, take {time.time()-ts:.3f} s")
+        return state["next_epoch"]
+
+    def run(self, start_epoch, end_epoch):
+        ''' Train epochs [start_epoch, end_epoch) '''
+        args, task_list, market = self.args, self.task_list, self.market
+        executor, evaluator, eval_scheduler = self.executor, self.evaluator, self.eval_scheduler
+        self.open_results_log()
+        print("\nStart training ...")
+        for epoch in range(start_epoch, end_epoch):
+            PROFILER.start_epoch(epoch)
+            MEMORY.start_epoch()
+            epoch_span = span("epoch")
+            epoch_span.__enter__()
             for task in task_list:
-                task.train_one_round()
-
-        ### At the end of this epoch
-        if (epoch+1) % PRINT_EVERY == 0: 
-            if args.policy == "nmfli":
-                shapely_value_table = [task.shap() for task in task_list]
-                ### Normalize using sigmoid
-                shapely_value_table = [
-                    np.array(util.sigmoid(np.array(elem))) if len(elem) > 0 else np.array(elem) 
-                        for elem in shapely_value_table]
-                shapely_value_table = [arr / np.max(arr) for arr in shapely_value_table]
-                # shapely_value_table = np.array(shapely_value_table)
-                # shapely_value_table /= np.expand_dims(np.max(shapely_value_table, axis=1), axis=1)
-                if args.verbose:
-                    util.pretty_print_2darray("Shap Table [task\\client]", shapely_value_table)
-
-                ### Update price table
-                for task_idx in range(len(task_list)):
-                    if task_list[task_idx].selected_client_idx is None:
-                        continue
-                    selected_client_index = task_list[task_idx].selected_client_idx
-                    for idx in range(len(selected_client_index)):
-                        client_idx = selected_client_index[idx]
-                        shapely_value_scaled = shapely_value_table[task_idx][idx]
-                        # shapely_value_scaled = shapley_value * len(selected_client_index) / args.num_users
-                        # price_table[client_idx][task_idx] = ((epoch / (epoch + 1)) * price_table[client_idx][task_idx] \
-                        #     + (1 / (epoch + 1)) * shapely_value_scaled)
-                        # price_table[client_idx][task_idx] = shapely_value_scaled
-                        price_table[client_idx][task_idx].append((epoch, shapely_value_scaled, task_list[task_idx].delta_accu))
-                
-                total_cost = 0
-                bid_list = [task.delta_accu * task.bid_per_loss_delta for task in task_list]
-                total_bid = sum(bid_list)
-            
+                task.epoch = epoch
+            print()
+            for round_idx in range(STEP_NUM):
+                ### Train the model parameters distributedly, tasks are trained concurrently
+                # if more than one task worker is used
+                executor.train_one_round(task_list,
+                    evaluate=(evaluator is None and eval_scheduler is None))
+
+            if eval_scheduler is not None:
+                ### Evaluate in the background while the next epoch is trained
+                if eval_scheduler.should_evaluate(epoch):
+                    eval_scheduler.submit(epoch, task_list)
+            elif evaluator is not None and (epoch+1) % PRINT_EVERY == 0:
+                ### Evaluate all tasks in one pass over the test data
+                with span("eval"):
+                    results = evaluator.evaluate(task_list)
+                for task, (accu, loss) in zip(task_list, results):
+                    task.record_round(accu, loss)
+
+            ### At the end of this epoch
+            if (epoch+1) % PRINT_EVERY == 0: 
+                if eval_scheduler is not None and args.policy in EvalScheduler.BARRIER_POLICIES:
+                    eval_scheduler.wait()
+
+                raw_shapley_table = None
+                if args.policy in MARKET_POLICIES:
+                    with span("shapley"):
+                        raw_shapley_table = [task.shap() for task in task_list]
+                    ### Normalize using sigmoid
+                    shapely_value_table = normalize_shapley(raw_shapley_table)
+                    if args.verbose:
+                        util.pretty_print_2darray("Shap Table [task\\client]", shapely_value_table)
+
+                    ### Update prices and bids
+                    with span("market/update"):
+                        total_cost = market.update_from_shapley(epoch, task_list, shapely_value_table)
+
+                if self.recorder is not None:
+                    self.recorder.record_epoch(epoch, task_list, raw_shapley_table)
+
+                ###select clients for all tasks
+                with span("policy/select"):
+                    succ_cnt, reward = policy.select_clients(args.policy, args.num_users, task_list, market,
+                        solver=args.market_solver, verbose=args.verbose)
+
                 for task in task_list:
-                    if task.selected_client_idx is None:
-                        continue
-                    for client_idx in task.selected_client_idx :
-                        total_cost += cost_list[client_idx]
+                    task.end_of_epoch()
 
-                assert price_table is not None
-            
-                ### Update bid table
-                for task_idx in range(len(task_list)):
-                    if task_list[task_idx].selected_client_idx is None:
-                        continue
-                    selected_client_index = task_list[task_idx].selected_client_idx
-                    for idx in range(len(selected_client_index)):
-                        client_idx = selected_client_index[idx]
-                        shapley_value = shapely_value_table[task_idx][idx]
-                        bid_table[client_idx][task_idx] = shapley_value * bid_list[task_idx]
-
-            ###select clients for all tasks
-            if args.policy == "random":
-                succ_cnt, reward = policy.random_select_clients(args.num_users, task_list)
-            elif args.policy == "momentum":
-                succ_cnt, reward = policy.momentum_select_clients(args.num_users, task_list)
-                # if use_all_users == True :
-                #     idxs_users = momemtum_based(args.num_users)
-                # else:
-                #     idxs_users = momemtum_based(m)
-            elif args.policy == "simple":
-                succ_cnt, reward = policy.simple_select_clients(args.num_users, task_list)
-            elif args.policy == "simple_reverse":
-                succ_cnt, reward = policy.simple_select_clients(args.num_users, task_list, reverse=True)
-            elif args.policy == "size":
-                succ_cnt, reward = policy.datasize_select_clients(args.num_users,task_list)
-            elif args.policy == "afl":
-                succ_cnt, reward = policy.AFL_select_clients(args.num_users, task_list)
-            elif args.policy == "greedy":
-                norm_bid_table = util.normalize_data(bid_table)
-                succ_cnt, reward = policy.greedy_select_clients(args.num_users, task_list, norm_bid_table)
-            elif args.policy == "nmfli":
-                if args.verbose:
-                    util.pretty_print_2darray("Price Table [client\\task]", price_table)
-                ask_table = util.calcualte_client_value(price_table, client_feature_list)
-                if args.verbose:
-                    util.pretty_print_2darray("Ask Table [client\\task]", ask_table)
-                norm_ask_table = util.normalize_data(ask_table)
-                norm_bid_table = util.normalize_data(bid_table)
-                succ_cnt, reward = policy.my_select_clients(
-                        norm_ask_table,
-                        client_feature_list,
-                        task_list,
-                        norm_bid_table)
-                # if use_all_users == True :
-                #     idxs_users = shap_based(args.num_users)
-                # else:
-                #     idxs_users = shap_based(m)
-            elif args.policy == "debug":
-                idxs_users = np.array(list(range(args.num_users)))[:m]
-            else:
-                raise ValueError(f"Invalid policy {args.policy}")
+            if self.ckpt_writer is not None and (epoch+1) % args.ckpt_every == 0:
+                if eval_scheduler is not None:
+                    eval_scheduler.wait()
+                self.ckpt_writer.submit(self.ckpt_path, *self.state(epoch+1))
 
-            for task in task_list:
-                task.end_of_epoch()
-
-    # Cache results
-    header = ["Step"]
-    all_data = []
-    for task_id, task in enumerate(task_list):
-        header.extend([f"Task {task_id} time", f"Task {task_id} train loss",
-                       f"Task {task_id} test accu."])
-        if task_id == 0:
-            all_data.append(task.epoch_num)
-        else:
-            assert task.epoch_num == all_data[0]
-        
-        all_data.append(task.timestamp)
-        all_data.append(task.train_loss)
-        all_data.append(task.test_accuracy)
-    
-    all_data = np.array(all_data).T
-    df = pd.DataFrame(all_data, columns=header)
-    cache_path = os.environ.get("NMFLI_EXP_NAME", f"save/result/{args.dataset}-{args.target_label}-{args.model}-"
-        f"{args.policy}") + ".csv"
-    if not os.path.exists(os.path.dirname(cache_path)):
-        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
-    df.to_csv(cache_path, index=False)
+            if args.results_every > 0 and (epoch+1) % args.results_every == 0:
+                ### Write the results so far, the pending evaluation is recorded first
+                if eval_scheduler is not None:
+                    eval_scheduler.wait()
+                self.save_results()
+            epoch_span.__exit__(None, None, None)
+            PROFILER.end_epoch(epoch, self.logger)
+            MEMORY.end_epoch(epoch, self.logger)
+            if self.results_writer is not None:
+                self.log_results()
+            if self.on_epoch_end is not None:
+                self.on_epoch_end(epoch)
+
+    def finish(self):
+        self.stop_runtime()
+        for task in self.task_list:
+            print(f"Task {task.task_id}: {task.eval_cache}")
+        if self.task_list[0].update_cache is not None:
+            print(self.task_list[0].update_cache)
+        if self.recorder is not None:
+            self.recorder.save(self.args.trace)
+        if PROFILER.enabled:
+            PROFILER.flush()
+        if self.args.profile:
+            print(PROFILER.summary())
+            PROFILER.save(f"{self.exp_name}.profile.{self.args.profile}")
+        self.save_results()
+        self.logger.close()
+
+    def results_columns(self):
+        header = ["Step"]
+        for task_id, task in enumerate(self.task_list):
+            header.extend([f"Task {task_id} time", f"Task {task_id} train loss",
+                           f"Task {task_id} test accu."])
+        return header
+
+    def results_rows(self, start):
+        ''' Rows of the epochs from start on which are recorded by all tasks. The records are
+            snapshotted, as the eval thread may be recording a round (--async_eval)
+        '''
+        records = [task.recorded_rounds(start) for task in self.task_list]
+        end = min([len(epoch_num) for epoch_num, _, _, _ in records])
+        rows = []
+        for i in range(end):
+            row = [records[0][0][i]]
+            for epoch_num, timestamp, train_loss, test_accuracy in records:
+                assert epoch_num[i] == row[0]
+                row.extend([timestamp[i], train_loss[i], test_accuracy[i]])
+            rows.append(row)
+        return rows
+
+    def log_results(self):
+        ''' Append the newly recorded rows to the results log, and flush TensorBoard with
+            each chunk instead of each round
+        '''
+        if self.results_writer.append(self.results_rows(self.results_writer.rows)):
+            self.logger.flush()
+
+    def save_results(self):
+        # Cache results
+        df = pd.DataFrame(np.array(self.results_rows(0)).reshape(-1, len(self.results_columns())),
+            columns=self.results_columns())
+        cache_path = self.exp_name + ".csv"
+        if not os.path.exists(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        df.to_csv(cache_path, index=False)
+
+if __name__ == '__main__':
+    start_time = time.time()
+
+    # define paths
+    path_project = os.path.abspath('..')
+
+    if SIMULATE:
+        run_simulation(args.simulate, args.policy, args.sim_epochs, solver=args.market_solver,
+            decay=args.price_decay, seed=args.seed)
+        exit()
+
+    experiment = Experiment(args, start_time)
+    start_epoch = 0
+    if args.resume is not None:
+        start_epoch = experiment.restore(args.resume)
+    experiment.run(start_epoch, EPOCH_NUM)
+    experiment.finish()
     
     ### Previous method to perform shap-based client selection
     # def shap_based(num_users):
@@ -0,0 +1,130 @@
+import numpy as np
+
+import util
+
+### Policies which price the clients by their Shapley values
+MARKET_POLICIES = ["nmfli", "optimal", "mcafee", "even"]
+
+def normalize_shapley(shapley_value_table):
+    ''' Normalize the Shapley values of each task by sigmoid, then by their maximum '''
+    shapley_value_table = [
+        np.array(util.sigmoid(np.array(elem))) if len(elem) > 0 else np.array(elem) 
+            for elem in shapley_value_table]
+    return [arr / np.max(arr) if len(arr) > 0 else arr for arr in shapley_value_table]
+
+class MarketState:
+    ''' Prices and bids of all (client, task) pairs, stored as numpy arrays.
+
+    For each pair, the value of a client for a task is the sum of
+    price * delta_accu over the epochs at which the client trained the task.
+    The sum is maintained incrementally when prices are recorded, optionally
+    decayed by `decay` per epoch, so the ask table is computed in one
+    vectorized expression whose cost does not grow with the number of epochs.
+
+    The latest `history_len` records of (epoch, client, task, price, delta_accu)
+    are kept in a columnar ring buffer for inspection.
+    '''
+    def __init__(self, num_users, num_tasks, decay=1.0, history_len=4096, cost=None, idle_cost=None):
+        self.num_users, self.num_tasks = num_users, num_tasks
+        self.decay = decay
+        self.cost = np.zeros(num_users) if cost is None else np.asarray(cost, dtype=float)
+        self.idle_cost = np.zeros(num_users) if idle_cost is None else np.asarray(idle_cost, dtype=float)
+
+        ### Sum of price * delta_accu and number of recorded prices, of shape (#client, #task)
+        self.value_sum = np.zeros((num_users, num_tasks))
+        self.price_cnt = np.zeros((num_users, num_tasks), dtype=np.int64)
+        self.bid_table = np.zeros((num_users, num_tasks))
+        self.last_epoch = None
+
+        self.history_len = history_len
+        self.history = {
+            "epoch": np.zeros(history_len, dtype=np.int64),
+            "client": np.zeros(history_len, dtype=np.int64),
+            "task": np.zeros(history_len, dtype=np.int64),
+            "price": np.zeros(history_len),
+            "delta_accu": np.zeros(history_len),
+        }
+        ### Total number of records ever appended, the next slot is history_cnt % history_len
+        self.history_cnt = 0
+
+    @property
+    def client_feature_list(self):
+        return list(zip(self.cost, self.idle_cost))
+
+    def _advance_to(self, epoch):
+        if self.decay != 1 and self.last_epoch is not None and epoch > self.last_epoch:
+            self.value_sum *= self.decay ** (epoch - self.last_epoch)
+        if self.last_epoch is None or epoch > self.last_epoch:
+            self.last_epoch = epoch
+
+    def record_prices(self, epoch, task_idx, client_idxs, prices, delta_accu):
+        ''' Record the prices of the clients selected by a task at an epoch '''
+        self._advance_to(epoch)
+        client_idxs = np.asarray(client_idxs, dtype=np.int64)
+        prices = np.asarray(prices, dtype=float)
+        if len(client_idxs) == 0:
+            return
+        self.value_sum[client_idxs, task_idx] += prices * delta_accu
+        self.price_cnt[client_idxs, task_idx] += 1
+
+        if self.history_len > 0:
+            slots = (self.history_cnt + np.arange(len(client_idxs))) % self.history_len
+            self.history["epoch"][slots] = epoch
+            self.history["client"][slots] = client_idxs
+            self.history["task"][slots] = task_idx
+            self.history["price"][slots] = prices
+            self.history["delta_accu"][slots] = delta_accu
+        self.history_cnt += len(client_idxs)
+
+    def update_bids(self, task_idx, client_idxs, shapley_values, bid):
+        self.bid_table[np.asarray(client_idxs, dtype=np.int64), task_idx] = np.asarray(shapley_values) * bid
+
+    def update_from_shapley(self, epoch, task_list, shapley_value_table):
+        ''' Update prices and bids by the normalized Shapley values of the selected clients
+            of each task, returns the total cost of the selected clients
+        '''
+        bid_list = [task.delta_accu * task.bid_per_loss_delta for task in task_list]
+        total_cost = 0
+        for task_idx, task in enumerate(task_list):
+            if task.selected_client_idx is None:
+                continue
+            self.record_prices(epoch, task_idx, task.selected_client_idx,
+                shapley_value_table[task_idx], task.delta_accu)
+            self.update_bids(task_idx, task.selected_client_idx,
+                shapley_value_table[task_idx], bid_list[task_idx])
+            total_cost += np.sum(self.cost[task.selected_client_idx])
+        return total_cost
+
+    def ask_table(self):
+        ''' Value of each client for each task, of shape (#client, #task).
+            The larger idle cost is, the smaller the value is
+        '''
+        return self.value_sum / (self.idle_cost[:, None] + 1)
+
+    def recent_history(self):
+        ''' Records in the ring buffer, from the oldest to the latest '''
+        num = min(self.history_cnt, self.history_len)
+        order = (self.history_cnt - num + np.arange(num)) % max(self.history_len, 1)
+        return dict([(key, column[order]) for key, column in self.history.items()])
+
+    def state_dict(self, prefix="market/"):
+        ''' Returns (arrays, state) used for checkpointing '''
+        arrays = {
+            f"{prefix}value_sum": self.value_sum,
+            f"{prefix}price_cnt": self.price_cnt,
+            f"{prefix}bid_table": self.bid_table,
+        }
+        for key, column in self.history.items():
+            arrays[f"{prefix}history/{key}"] = column
+        state = {"last_epoch": self.last_epoch, "history_cnt": self.history_cnt}
+        return arrays, state
+
+    def load_state_dict(self, arrays, state, prefix="market/"):
+        self.value_sum = np.array(arrays[f"{prefix}value_sum"])
+        self.price_cnt = np.array(arrays[f"{prefix}price_cnt"])
+        self.bid_table = np.array(arrays[f"{prefix}bid_table"])
+        for key in self.history:
+            self.history[key] = np.array(arrays[f"{prefix}history/{key}"])
+        self.history_len = len(self.history["epoch"])
+        self.last_epoch = state["last_epoch"]
+        self.history_cnt = state["history_cnt"]
@@ -0,0 +1,171 @@
+import os
+import resource
+import threading
+
+import numpy as np
+import torch
+
+def _read_status(field):
+    ''' Value of a field of /proc/self/status in bytes, or None if it is not available '''
+    try:
+        with open("/proc/self/status") as fp:
+            for line in fp:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+def current_rss():
+    try:
+        with open("/proc/self/statm") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return _read_status("VmRSS") or 0
+
+def peak_rss():
+    ''' Peak RSS since the last reset_peak_rss(), or since the process started '''
+    peak = _read_status("VmHWM")
+    if peak is None:
+        ### ru_maxrss is in KB on Linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return peak
+
+def reset_peak_rss():
+    ''' Reset VmHWM to the current RSS (Linux >= 4.0), returns False if it is not supported '''
+    try:
+        with open("/proc/self/clear_refs", "w") as fp:
+            fp.write("5")
+        return True
+    except OSError:
+        return False
+
+def _arrays(obj, depth=0):
+    ''' Tensors and numpy arrays held by obj, e.g., a state dict, a module or a dataset '''
+    if isinstance(obj, (torch.Tensor, np.ndarray)):
+        yield obj
+    elif isinstance(obj, torch.nn.Module):
+        yield from obj.parameters()
+        yield from obj.buffers()
+    elif isinstance(obj, torch.optim.Optimizer):
+        for state in obj.state.values():
+            yield from _arrays(state, depth + 1)
+    elif isinstance(obj, dict):
+        for value in obj.values():
+            yield from _arrays(value, depth + 1)
+    elif isinstance(obj, (list, tuple)):
+        for value in obj:
+            yield from _arrays(value, depth + 1)
+    elif depth < 2 and isinstance(obj, torch.utils.data.Dataset):
+        ### Samples of the dataset, and of the dataset it wraps (e.g., DatasetSplit)
+        for name in ["data", "targets", "dataset"]:
+            if hasattr(obj, name):
+                yield from _arrays(getattr(obj, name), depth + 1)
+
+def _storage(array):
+    ''' (key, bytes) of the memory of a tensor or numpy array, views share the key of their base '''
+    if isinstance(array, torch.Tensor):
+        storage = array.untyped_storage()
+        return ("torch", storage.data_ptr()), storage.nbytes()
+    while isinstance(array.base, np.ndarray):
+        array = array.base
+    return ("numpy", array.__array_interface__["data"][0]), array.nbytes
+
+def owner_bytes(owners):
+    ''' {owner: bytes} for {owner: objects}. Memory shared by several owners, e.g., a dataset
+        wrapped by the clients, is counted once, for the first owner
+    '''
+    seen = set()
+    result = {}
+    for owner, objects in owners.items():
+        total = 0
+        for array in _arrays(objects):
+            key, nbytes = _storage(array)
+            if key not in seen:
+                seen.add(key)
+                total += nbytes
+        result[owner] = total
+    return result
+
+def format_breakdown(breakdown):
+    return ", ".join([f"{owner}={nbytes / 2**20:.1f} MB" for owner, nbytes in breakdown.items()])
+
+class MemoryTracker:
+    ''' Peak RSS per epoch and the tensor bytes of each owner, e.g., the global models of the
+        tasks, the client replicas, the stored local updates, the Shapley scratch models and
+        the datasets.
+
+    The owners are given by owners_fn, which returns {owner: objects holding tensors}, and
+    are measured at the end of each epoch. Transient structures, e.g., the coalition models
+    of the Shapley values, report themselves by note_peak and their largest size in the
+    epoch is recorded. If the RSS exceeds budget bytes at an epoch end or a check point,
+    MemoryError is raised with the breakdown by owner.
+    '''
+    def __init__(self):
+        self.enabled = False
+        self.budget = 0
+        self.owners_fn = None
+        self.lock = threading.Lock()
+        self.peaks = {}
+        self.can_reset_peak = True
+
+    def configure(self, enabled, budget=0, owners_fn=None):
+        self.enabled = enabled
+        self.budget = budget
+        self.owners_fn = owners_fn
+
+    @property
+    def active(self):
+        return self.enabled or self.budget > 0
+
+    def start_epoch(self):
+        if self.active:
+            self.can_reset_peak = reset_peak_rss()
+
+    def note_peak(self, owner, objects):
+        ''' Record the size of a transient structure and check the budget '''
+        if not self.active:
+            return
+        nbytes = owner_bytes({owner: objects})[owner]
+        with self.lock:
+            self.peaks[owner] = max(self.peaks.get(owner, 0), nbytes)
+        self.check(owner)
+
+    def breakdown(self, rss=None):
+        ''' {owner: bytes}, including the transient peaks and the RSS not held by tensors '''
+        breakdown = owner_bytes(self.owners_fn()) if self.owners_fn is not None else {}
+        with self.lock:
+            breakdown.update(self.peaks)
+        rss = current_rss() if rss is None else rss
+        breakdown["untracked"] = max(0, rss - sum(breakdown.values()))
+        return breakdown
+
+    def check(self, where):
+        ''' Raise MemoryError if the RSS exceeds the budget '''
+        if self.budget <= 0:
+            return
+        rss = current_rss()
+        if rss > self.budget:
+            raise MemoryError(f"RSS {rss / 2**20:.1f} MB exceeds the budget {self.budget / 2**20:.1f} MB "
+                f"at {where}: {format_breakdown(self.breakdown(rss))}")
+
+    def end_epoch(self, epoch, logger=None):
+        ''' Returns (peak RSS, {owner: bytes}) of this epoch, and logs them in MB '''
+        if not self.active:
+            return None
+        peak = peak_rss()
+        breakdown = self.breakdown() if self.enabled else {}
+        with self.lock:
+            self.peaks = {}
+        if self.enabled:
+            if logger is not None:
+                logger.add_scalar("Memory/PeakRSS", peak / 2**20, global_step=epoch)
+                for owner, nbytes in breakdown.items():
+                    logger.add_scalar(f"Memory/{owner}", nbytes / 2**20, global_step=epoch)
+            print(f"Epoch {epoch} peak RSS {peak / 2**20:.1f} MB"
+                f"{'' if self.can_reset_peak else ' (since start)'}: {format_breakdown(breakdown)}")
+        self.check(f"the end of epoch {epoch}")
+        return peak, breakdown
+
+### Shared by all tasks of this process
+MEMORY = MemoryTracker()
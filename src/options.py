@@ -42,7 +42,8 @@ def args_parser():
                         help="Whether use max pooling rather than \
                         strided convolutions")
     parser.add_argument('--policy', type=str, default='momentum',
-                        help="select policy for choosing clients")                       
+                        help="select policy for choosing clients: random, momentum, \
+                        simple, simple_reverse, size, afl, greedy, nmfli, optimal, mcafee, even")                       
 
     # dataset
     parser.add_argument('--dataset', type=str, default='mnist', help="name \
@@ -56,6 +57,36 @@ def args_parser():
                         non-i.i.d setting (use 0 for equal splits)')
     parser.add_argument('--halfiid', type=int, default=0,
                         help='Default set to non-halfIID. Set to 1 for halfIID.')
+    parser.add_argument('--partition', type=str, default="custom",
+                        help="custom: the predefined client data distribution \
+                        of 10 clients, dirichlet: Dirichlet label skew, standard: \
+                        use --iid, --unequal and --halfiid")
+    parser.add_argument('--dirichlet_alpha', type=float, default=0.5,
+                        help='concentration of the Dirichlet label skew, \
+                        smaller values give more skewed labels')
+    parser.add_argument('--datasize_skew', type=str, default="none",
+                        help='data size skew of --partition=dirichlet: \
+                        none, lognormal or powerlaw')
+    parser.add_argument('--datasize_param', type=float, default=1.0,
+                        help='sigma of the lognormal or shape of the powerlaw \
+                        data size skew')
+    parser.add_argument('--synthetic', type=int, default=0,
+                        help='Default set to use the real dataset. Set to 1 to generate \
+                        synthetic data with the sample shape of --dataset and \
+                        --num_classes classes')
+    parser.add_argument('--synthetic_train', type=int, default=60000,
+                        help='number of synthetic training samples')
+    parser.add_argument('--synthetic_test', type=int, default=10000,
+                        help='number of synthetic test samples')
+    parser.add_argument('--synthetic_noise', type=float, default=1.0,
+                        help='std of the noise added to the class prototypes of \
+                        synthetic data, larger is harder')
+    parser.add_argument('--data_dir', type=str, default=None,
+                        help='directory of the dataset, default is ../data/<dataset>/. \
+                        Raw files in this directory are parsed without downloading')
+    parser.add_argument('--partition_cache', type=str, default=None,
+                        help='directory to cache partitions, runs with the same \
+                        partition configuration reuse the same client data')
     parser.add_argument('--target_label', type=str, default="non_overlap", help="The labels required by each task")
     parser.add_argument('--noisy', type=int, default=0,
                         help='Set to 1 to add noise to image')
@@ -69,5 +100,92 @@ def args_parser():
                         help='rounds of early stopping')
     parser.add_argument('--verbose', type=int, default=0, help='verbose')
     parser.add_argument('--seed', type=int, default=1, help='random seed')
+    parser.add_argument('--task_workers', type=int, default=1,
+                        help='number of tasks trained concurrently in one \
+                        epoch, 1 to train tasks one after another')
+    parser.add_argument('--shared_eval', type=int, default=0,
+                        help='set to 1 to evaluate all tasks in a single pass \
+                        over the shared test dataset')
+    parser.add_argument('--async_eval', type=int, default=0,
+                        help='set to 1 to evaluate global models on a \
+                        background worker while the next round is trained')
+    parser.add_argument('--eval_every', type=int, default=1,
+                        help='number of epochs between two evaluations, \
+                        used with --async_eval=1')
+    parser.add_argument('--ckpt_every', type=int, default=0,
+                        help='number of epochs between two checkpoints, \
+                        0 to disable checkpointing')
+    parser.add_argument('--ckpt_path', type=str, default=None,
+                        help='path of the checkpoint, default to the result \
+                        path with the suffix .ckpt')
+    parser.add_argument('--resume', type=str, default=None,
+                        help='path of a checkpoint to resume the experiment from')
+    parser.add_argument('--market_solver', type=str, default='greedy',
+                        help="assignment solver of the nmfli market, greedy: tasks select \
+                        clients in the order of bids, optimal: maximize the total value")
+    parser.add_argument('--price_decay', type=float, default=1.0,
+                        help='decay per epoch of the accumulated client prices, \
+                        default 1.0 means no decay')
+    parser.add_argument('--price_history', type=int, default=4096,
+                        help='number of the latest price records kept in the history')
+    parser.add_argument('--update_cache', type=str, default=None,
+                        help='directory of the on-disk cache of local updates, shared by \
+                        runs with the same seed, default None means no cache')
+    parser.add_argument('--update_cache_size', type=float, default=1024,
+                        help='maximum size in MB of the update cache')
+    parser.add_argument('--results_every', type=int, default=0,
+                        help='write the results CSV every this number of epochs, \
+                        default 0 means only at the end')
+    parser.add_argument('--results_batch', type=int, default=10,
+                        help='number of epochs per chunk appended to the results log \
+                        {exp_name}.results, 0 to disable the log')
+    parser.add_argument('--branch_policies', type=str, default='',
+                        help='branch.py: comma-separated policies which continue \
+                        from the shared prefix, e.g., nmfli,greedy,random')
+    parser.add_argument('--branch_epoch', type=int, default=0,
+                        help='branch.py: number of epochs trained once with --policy \
+                        before branching')
+    parser.add_argument('--branch_dir', type=str, default=None,
+                        help='branch.py: directory of the results of all branches')
+    parser.add_argument('--branch_workers', type=int, default=1,
+                        help='branch.py: number of branches run concurrently')
+    parser.add_argument('--branch_mode', type=str, default='fork',
+                        help="branch.py: fork: fork children sharing the snapshot in memory, \
+                        reload: start new processes resuming from a checkpoint of the snapshot")
+    parser.add_argument('--sweep_grid', type=str, default='',
+                        help='sweep.py: JSON object, or path of a JSON file, mapping \
+                        option names to lists of values, one run per combination')
+    parser.add_argument('--sweep_dir', type=str, default=None,
+                        help='sweep.py: directory of the results of all runs')
+    parser.add_argument('--sweep_workers', type=int, default=0,
+                        help='sweep.py: number of runs at the same time, \
+                        0 to fill all cores with --sweep_cores cores per run')
+    parser.add_argument('--sweep_cores', type=int, default=1,
+                        help='sweep.py: number of CPU threads of each run')
+    parser.add_argument('--profile', type=str, default='', choices=['', 'csv', 'json'],
+                        help="time the phases of each epoch and save them to \
+                        {exp_name}.profile.csv (csv) or .json (json), default '' means no profiling")
+    parser.add_argument('--profile_epochs', type=str, default='',
+                        help='epochs start,end captured by torch.profiler, e.g., 5,7, \
+                        saved to {exp_name}.torch_trace.json')
+    parser.add_argument('--mem_track', type=int, default=0,
+                        help='set to 1 to log the peak RSS and the tensor bytes of each owner per epoch')
+    parser.add_argument('--mem_budget', type=float, default=0,
+                        help='raise MemoryError with a breakdown if the RSS exceeds this number \
+                        of MB, default 0 means no budget')
+    parser.add_argument('--trace', type=str, default=None,
+                        help='path to record the per-epoch signals of this run, \
+                        which can be replayed by --simulate')
+    parser.add_argument('--simulate', type=str, default=None,
+                        help='replay a trace recorded by --trace through the \
+                        selection policy instead of training')
+    parser.add_argument('--sim_epochs', type=int, default=1000,
+                        help='number of epochs to simulate, the trace is replayed \
+                        cyclically if it is shorter')
+    parser.add_argument('--task_cores', type=int, default=0,
+                        help='number of intra-op CPU threads of the process \
+                        with task_workers > 1, i.e., of each op of the \
+                        concurrent tasks and of the main thread, 0 to split \
+                        all cores evenly among workers')
     args = parser.parse_args()
     return args
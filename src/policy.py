@@ -1,5 +1,7 @@
+import time
 import numpy as np
 import random 
+from scipy.optimize import linear_sum_assignment
 import util
 import pdb
 import copy
@@ -9,6 +11,16 @@ import copy
 #   NOTE: the client number of a task may not satisfy the required client number
 IGNORE_BID_ASK = False
 
+### Probability that nmfli explores with random selection
+EXPLORE_RATE = 0.3
+### Weight of the exploration term in the UCB of the momentum policy
+UCB_ALPHA = 0.1
+### AFL: drop the alpha1 fraction of clients with the smallest valuation, select (1-alpha3) of the
+#   required clients with probability proportional to exp(alpha2 * valuation), and the rest uniformly
+AFL_ALPHA1 = 0.75
+AFL_ALPHA2 = 0.01
+AFL_ALPHA3 = 0.1
+
 def buyer_give_more_money(client_idx, task_idx, price_table, bid_table):
     if IGNORE_BID_ASK:
         return True
@@ -47,46 +59,315 @@ def check_trade_success_or_not(selected_client_index, _task, free_client, update
             _task.init_select_clients()
         return True
 
-def my_select_clients(ask_table, client_feature_list, task_list, bid_table):
+#############################################
+######### Vectorized selection core #########
+# All policies are expressed as a score matrix of shape (#client, #task): each task,
+# in a given order, takes its required number of free clients with the highest scores.
+# A score of -inf means the client is not eligible for the task. A nan score, e.g., of a
+# normalized constant table, ranks below all finite scores but is still eligible.
+
+### Pre-filter candidates by a threshold estimated on a strided sample of this size,
+#   so that argpartition only runs on a few candidates when k is small
+PREFILTER_SAMPLE = 1024
+
+def top_k(scores, k, mask=None):
+    ''' Indexes of the k largest scores above -inf (among mask) in descending order, scores
+        must not be nan. Ties are broken by the smaller index, i.e., the same order as a stable
+        sort in descending order
+    '''
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    eligible = scores > -np.inf
+    if mask is not None:
+        eligible &= mask
+    candidates = np.nonzero(eligible)[0]
+    values = scores[candidates]
+    if k < len(candidates):
+        if len(values) >= 8 * PREFILTER_SAMPLE and 8 * k < len(values):
+            ### The k-th largest value is at least the estimated one if enough values exceed it
+            sample = values[::len(values) // PREFILTER_SAMPLE]
+            rank = min(len(sample) - 1, 2 * k * len(sample) // len(values) + 1)
+            estimate = np.partition(sample, len(sample) - 1 - rank)[len(sample) - 1 - rank]
+            keep = values >= estimate
+            if np.count_nonzero(keep) >= k:
+                candidates, values = candidates[keep], values[keep]
+        if k < len(candidates):
+            threshold = values[np.argpartition(-values, k - 1)[k - 1]]
+            is_above, is_tie = values > threshold, values == threshold
+            ties = candidates[is_tie][:k - np.count_nonzero(is_above)]
+            values = np.concatenate([values[is_above], values[is_tie][:len(ties)]])
+            candidates = np.concatenate([candidates[is_above], ties])
+    order = np.lexsort((candidates, -values))
+    return candidates[order[:k]]
+
+def _scores_per_task(scores):
+    ''' One contiguous row of scores per task, with nan replaced by a score below all finite ones '''
+    scores_per_task = np.ascontiguousarray(np.asarray(scores, dtype=float).T)
+    is_nan = np.isnan(scores_per_task)
+    if is_nan.any():
+        finite = scores_per_task[np.isfinite(scores_per_task)]
+        scores_per_task = np.where(is_nan, finite.min() - 1 if len(finite) > 0 else 0., scores_per_task)
+    return scores_per_task
+
+def assign_clients(scores, quotas, task_order=None, free=None):
+    ''' Greedy multi-task assignment on a score matrix of shape (#client, #task).
+        Tasks in task_order (default: by index) take in turn the quotas[t] free clients
+        with the highest scores. A task which can not get enough eligible clients gets None,
+        and its clients stay free.
+        Returns (assignment, free), where assignment[t] is an array of client indexes or None
+    '''
+    ### One row per task, so that the scores of a task are contiguous
+    scores_per_task = _scores_per_task(scores)
+    task_num, client_num = scores_per_task.shape
+    free = np.ones(client_num, dtype=bool) if free is None else np.array(free, dtype=bool)
+    task_order = range(task_num) if task_order is None else task_order
+    assignment = [None] * task_num
+    for task_idx in task_order:
+        quota = quotas[task_idx]
+        selected = top_k(scores_per_task[task_idx], quota, mask=free)
+        if len(selected) < quota:
+            continue
+        assignment[task_idx] = selected
+        free[selected] = False
+    return assignment, free
+
+def task_quotas(task_list):
+    return np.array([_task.required_client_num for _task in task_list], dtype=np.int64)
+
+def descending_task_order(task_values):
+    ''' Order of tasks by value in descending order, ties by the smaller index '''
+    return np.lexsort((np.arange(len(task_values)), -np.asarray(task_values, dtype=float)))
+
+def apply_assignment(task_list, assignment, task_order=None, update=True):
+    ''' Set the selected clients of each task and return the number of successfully matched clients '''
+    task_order = range(len(task_list)) if task_order is None else task_order
+    succ_cnt = 0
+    for task_idx in task_order:
+        _task = task_list[task_idx]
+        selected = assignment[task_idx]
+        if selected is not None:
+            succ_cnt += _task.required_client_num
+        if update:
+            _task.selected_client_idx = None if selected is None else [int(i) for i in selected]
+            _task.init_select_clients()
+    return succ_cnt
+
+def select_by_scores(task_list, scores, task_order=None, update=True):
+    assignment, _ = assign_clients(scores, task_quotas(task_list), task_order=task_order)
+    return apply_assignment(task_list, assignment, task_order=task_order, update=update)
+
+class AssignmentResult:
+    ''' Result of a multi-task assignment: assignment[t] is an array of client indexes or None,
+        objective is the total score of all assigned (client, task) pairs
+    '''
+    def __init__(self, solver, assignment, objective, solve_time):
+        self.solver = solver
+        self.assignment = assignment
+        self.objective = objective
+        self.solve_time = solve_time
+
+    def __repr__(self):
+        matched = sum([len(selected) for selected in self.assignment if selected is not None])
+        return (f"AssignmentResult(solver={self.solver}, objective={self.objective:.4f}, "
+            f"matched clients={matched}, solve time={1000*self.solve_time:.3f} ms)")
+
+def assignment_objective(scores, assignment):
+    scores = np.asarray(scores, dtype=float)
+    return float(sum([np.sum(scores[selected, task_idx]) for task_idx, selected in enumerate(assignment)
+        if selected is not None and len(selected) > 0]))
+
+def greedy_assignment(scores, quotas, task_order=None, free=None):
+    ts = time.perf_counter()
+    assignment, _ = assign_clients(scores, quotas, task_order=task_order, free=free)
+    solve_time = time.perf_counter() - ts
+    return AssignmentResult("greedy", assignment, assignment_objective(scores, assignment), solve_time)
+
+def _solve_transportation(scores_per_task, eligible_per_task, quotas, tasks):
+    ''' Maximize the total score when each task in tasks gets exactly quotas[t] clients and
+        each client serves at most one task. Returns a dict of task -> clients, or None if infeasible
+    '''
+    total = int(sum([quotas[t] for t in tasks]))
+    ### Exchange argument: a task never needs a client outside its top-`total` eligible clients,
+    #   since at most total-1 of them can be taken by other slots. So only these rows are kept.
+    rows = np.unique(np.concatenate([top_k(scores_per_task[t], total, mask=eligible_per_task[t])
+        for t in tasks]))
+    if len(rows) < total:
+        return None
+    ### One column per slot of each task, i.e., a transportation problem expanded into an assignment problem
+    slot2task = np.repeat(np.asarray(tasks, dtype=np.int64), [quotas[t] for t in tasks])
+    cost = -scores_per_task[slot2task][:, rows].T
+    cost[~eligible_per_task[slot2task][:, rows].T] = np.inf
+    try:
+        row_idxs, slot_idxs = linear_sum_assignment(cost)
+    except ValueError:
+        ### No assignment satisfies all quotas
+        return None
+    clients, client_tasks = rows[row_idxs], slot2task[slot_idxs]
+    return dict([(t, clients[client_tasks == t]) for t in tasks])
+
+def solve_assignment(scores, quotas, task_order=None, free=None):
+    ''' Optimal multi-task assignment on a score matrix of shape (#client, #task): maximize the
+        total score of assigned pairs, where each task gets exactly quotas[t] clients or none,
+        and each client serves at most one task. Tasks are admitted by task_order: if not all
+        tasks can be satisfied, the last admitted tasks are dropped first.
+        Solved as a rectangular linear sum assignment (Hungarian) over quota-expanded task slots.
+    '''
+    ts = time.perf_counter()
+    scores_per_task = _scores_per_task(scores)
+    task_num, client_num = scores_per_task.shape
+    free = np.ones(client_num, dtype=bool) if free is None else np.asarray(free, dtype=bool)
+    eligible_per_task = (scores_per_task > -np.inf) & free[None, :]
+    task_order = list(range(task_num)) if task_order is None else [int(t) for t in task_order]
+
+    assignment = [None] * task_num
+    tasks = []
+    for task_idx in task_order:
+        if quotas[task_idx] > 0:
+            tasks.append(task_idx)
+        else:
+            assignment[task_idx] = np.zeros(0, dtype=np.int64)
+    while len(tasks) > 0:
+        task2clients = _solve_transportation(scores_per_task, eligible_per_task, quotas, tasks)
+        if task2clients is not None:
+            for task_idx, clients in task2clients.items():
+                ### Clients of a task in descending order of scores, ties by the smaller index
+                order = np.lexsort((clients, -scores_per_task[task_idx][clients]))
+                assignment[task_idx] = clients[order]
+            break
+        tasks.pop()
+    solve_time = time.perf_counter() - ts
+    return AssignmentResult("optimal", assignment, assignment_objective(scores, assignment), solve_time)
+
+ASSIGNMENT_SOLVERS = {"greedy": greedy_assignment, "optimal": solve_assignment}
+
+def random_scores(num_of_client, task_num):
+    ''' Random keys, the top-k of which is a uniformly random k-subset in random order.
+        Generated task by task, so the transposed view is contiguous for assign_clients
+    '''
+    return np.random.random_sample((task_num, num_of_client)).T
+
+def my_select_clients(ask_table, client_feature_list, task_list, bid_table, solver="greedy",
+        explore_rate=EXPLORE_RATE, verbose=False):
     ''' client_feature_list: list
             a list of (cost, idlecost)
         task_list: list
             a list of class: Task
         bid_table: numpy array
             shape = (client_num, task_num)
+        solver: str
+            greedy: tasks with larger total bid select clients first, each task takes
+                the clients with the largest values for it
+            optimal: maximize the total value of all tasks, see solve_assignment
+        verbose: print the AssignmentResult, i.e., the objective and solve time
     '''
-    expore_rate = 0.3
-    if random.random() < expore_rate:
+    if random.random() < explore_rate:
         return random_select_clients(len(client_feature_list), task_list)
         
-    ### shape of task_bid_list = (task_num)
-    task_bid_list = np.sum(bid_table, axis=0)
+    task_order = descending_task_order(np.sum(bid_table, axis=0))
+    result = ASSIGNMENT_SOLVERS[solver](ask_table, task_quotas(task_list), task_order=task_order)
+    if verbose:
+        print(result)
+    succ_cnt = apply_assignment(task_list, result.assignment, task_order=task_order)
+    return succ_cnt, None
 
-    sorted_task_with_index = sorted(enumerate(task_bid_list), key=lambda x: x[1], reverse=True)
-    free_client = [True] * len(client_feature_list)
+def optimal_select_clients(ask_table, client_feature_list, task_list, bid_table, verbose=False):
+    ''' The nmfli market with the optimal assignment and without random exploration '''
+    return my_select_clients(ask_table, client_feature_list, task_list, bid_table,
+        solver="optimal", explore_rate=0, verbose=verbose)
+
+def mcafee_select_clients(ask_table, client_feature_list, task_list, bid_table, update=True):
+    return mcafee_select_clients_v2(ask_table, client_feature_list, task_list, bid_table, update=update)
+
+class FreeSet:
+    ''' Free flags of n positions in a Fenwick tree, to count the free positions before
+        a position and to find the r-th free position, both in O(log n)
+    '''
+    def __init__(self, n):
+        self.n = n
+        self.tree = np.zeros(n + 1, dtype=np.int64)
+        ### Build the tree of all-ones in O(n): node i covers (i - lowbit(i), i]
+        idxs = np.arange(1, n + 1)
+        self.tree[1:] = idxs & (-idxs)
+        self.free_cnt = n
+        self.top_bit = 1 << max(n.bit_length() - 1, 0)
+
+    def count(self, pos):
+        ''' Number of free positions in [0, pos) '''
+        total = 0
+        while pos > 0:
+            total += self.tree[pos]
+            pos -= pos & (-pos)
+        return int(total)
+
+    def find(self, rank):
+        ''' The position of the rank-th (1-based) free position '''
+        pos, step = 0, self.top_bit
+        while step > 0:
+            if pos + step <= self.n and self.tree[pos + step] < rank:
+                pos += step
+                rank -= self.tree[pos]
+            step >>= 1
+        return pos
+
+    def take(self, pos):
+        self.free_cnt -= 1
+        pos += 1
+        while pos <= self.n:
+            self.tree[pos] -= 1
+            pos += pos & (-pos)
+
+def mcafee_select_clients_v2(ask_table, client_feature_list, task_list, bid_table, update=True):
+    ''' McAfee-style double auction, with the same trades and reward as mcafee_select_clients_v1.
+
+        Tasks (buyers) are sorted by bid in descending order, clients (sellers) by value in
+        ascending order. Except for the task with the lowest bid, which never trades, each task
+        in turn buys the free clients whose values are not larger than its bid, from the most
+        valued one downwards, as long as some free client values more than the bid. A task
+        which can not buy required_client_num clients fails and buys nothing.
+
+        Clients are sorted once, and the free clients are kept in a Fenwick tree over the
+        sorted positions, so the auction runs in O(n log n) instead of rescanning the clients.
+    '''
+    task_bid_list = np.sum(bid_table, axis=0) - 3.5
+    task_order = descending_task_order(task_bid_list)
+    client_value_list = np.sum(ask_table, axis=1)
+    client_order = np.argsort(client_value_list, kind="stable")
+    sorted_values = client_value_list[client_order]
+    client_num, task_num = len(client_value_list), len(task_bid_list)
+    assert client_num > 0
+
+    free = FreeSet(client_num)
+    assignment = [None] * task_num
     succ_cnt = 0
-    for task_idx, _ in sorted_task_with_index:
+    reward = 0
+    for i, task_idx in enumerate(task_order[:-1]):
         _task = task_list[task_idx]
-        
-        client_value_for_this_task = [client_value_list[task_idx] for client_value_list in ask_table]
-        client_value_list_sorted = sorted(enumerate(client_value_for_this_task), key=lambda x: x[1], reverse=True)
+        bid = task_bid_list[task_idx]
+        ### Free clients at sorted positions [0, end) value no more than the bid
+        end = int(np.searchsorted(sorted_values, bid, side="right"))
+        cheap_cnt = free.count(end)
+        reward = 0
+        if free.free_cnt - cheap_cnt == 0 or cheap_cnt < _task.required_client_num:
+            continue
+        ranks = range(cheap_cnt, cheap_cnt - _task.required_client_num, -1)
+        positions = [free.find(rank) for rank in ranks]
+        for pos in positions:
+            free.take(pos)
+        selected_client_index = client_order[positions]
+        assignment[task_idx] = selected_client_index
+
+        ### Cacluate reward and count successful matching
+        refer_bid = task_list[i+1].bid_per_loss_delta
+        refer_ask = util.sigmoid(client_value_list[np.minimum(selected_client_index + 1, client_num - 1)])
+        loss_delta = _task.total_loss_delta if _task.total_loss_delta is not None else _task.delta_accu
+        reward += np.sum((refer_bid + refer_ask) / 2) * loss_delta * 100
+        succ_cnt += _task.required_client_num
 
-        ### Select clients
-        selected_client_index = []
-        for client_idx, _ in client_value_list_sorted:
-            if free_client[client_idx] :
-            # and buyer_give_more_money(client_idx, task_idx, ask_table, bid_table):
-                is_task_ready = select_one_client(client_idx, selected_client_index, free_client, _task)
-                if is_task_ready:
-                    break
-        
-        is_succ = check_trade_success_or_not(selected_client_index, _task, free_client)
-        if is_succ:
-            succ_cnt += _task.required_client_num
-    
-    return succ_cnt, None
+    if update:
+        apply_assignment(task_list, assignment, task_order=task_order)
+    return succ_cnt, reward
 
-def mcafee_select_clients(ask_table, client_feature_list, task_list, bid_table, update=True):
+def mcafee_select_clients_v1(ask_table, client_feature_list, task_list, bid_table, update=True, verbose=False):
     ''' client_feature_list: list
             a list of (cost, idlecost)
         task_list: list
@@ -104,9 +385,10 @@ def mcafee_select_clients(ask_table, client_feature_list, task_list, bid_table,
     client_value_list_sorted = sorted(enumerate(client_value_list), key=lambda x: x[1], reverse=False)
     client_num= len(client_value_list)
     task_num = len(task_bid_list)
-    print("- [mcafee] mb: ", sorted_task_with_index)
-    print("- [mcafee] ma: ", client_value_list_sorted)
-    print("- [mcafee] task#: ", task_num, " client#: ", client_num)
+    if verbose:
+        print("- [mcafee] mb: ", sorted_task_with_index)
+        print("- [mcafee] ma: ", client_value_list_sorted)
+        print("- [mcafee] task#: ", task_num, " client#: ", client_num)
 
     i = 0
     free_client = [True] * len(client_feature_list)
@@ -164,9 +446,10 @@ def mcafee_select_clients(ask_table, client_feature_list, task_list, bid_table,
             refer_bid = task_list[i+1].bid_per_loss_delta
             tmp = 0
             for client_idx in selected_client_index:
-                refer_ask = util.sigmoid(client_value_list[client_idx+1])
+                refer_ask = util.sigmoid(client_value_list[min(client_idx+1, client_num-1)])
                 tmp += (refer_bid + refer_ask) / 2
-                print("- [mcafee] p refer_ask: ", refer_ask)
+                if verbose:
+                    print("- [mcafee] p refer_ask: ", refer_ask)
             reward += tmp * _task.total_loss_delta *100 
             ### count successful matching
             succ_cnt += _task.required_client_num
@@ -207,9 +490,6 @@ def mcafee_select_clients(ask_table, client_feature_list, task_list, bid_table,
     #         raise ValueError("Fail trading")
 
 def simple_select_clients(num_of_client, task_list, reverse=False):
-    free_client = [True] * num_of_client
-    succ_cnt = 0
-    
     optimal = False
     if optimal:
         task_list[0].selected_client_idx = [6, 1]
@@ -217,193 +497,85 @@ def simple_select_clients(num_of_client, task_list, reverse=False):
         # print("Clients {} are assined to task {}".format(selected_client_index, _task.task_id))
         task_list[0].init_select_clients()
         task_list[1].init_select_clients()
-    else:
-        for task_idx, _ in enumerate(task_list):
-            _task = task_list[task_idx]
-
-            ### Select clients
-            selected_client_index = []
-            iterator = range(num_of_client)
-            if reverse:
-                iterator = reversed(iterator)
-            for client_idx in iterator:
-                if free_client[client_idx]:
-                    # and buyer_give_more_money(client_idx, task_idx, ask_table, bid_table):
-                    is_task_ready = select_one_client(client_idx, selected_client_index, free_client, _task)
-                    if is_task_ready:
-                        break
-            is_succ = check_trade_success_or_not(selected_client_index, _task, free_client)
-            if is_succ:
-                succ_cnt += _task.required_client_num
-    return succ_cnt, None
+        return 0, None
+
+    ### Clients are taken in the order of their indexes
+    order = np.arange(num_of_client, dtype=float)
+    scores = np.tile(order if reverse else -order, (len(task_list), 1)).T
+    return select_by_scores(task_list, scores), None
 
 def random_select_clients(num_of_client, task_list):
-    free_client = [True] * num_of_client
-    succ_cnt = 0
-    for task_idx, _ in enumerate(task_list):
-        _task = task_list[task_idx]
-       
-        ### Select clients
-        selected_client_index = []
-        clients_candidates = list(range(num_of_client))
-        while len(clients_candidates) > 0:
-            client_idx= random.choice(clients_candidates)
-            clients_candidates.remove(client_idx)
-            if free_client[client_idx] :
-            # and buyer_give_more_money(client_idx, task_idx, ask_table, bid_table):
-                is_task_ready = select_one_client(client_idx, selected_client_index, free_client, _task)
-                if is_task_ready:
-                    break
-        
-        is_succ = check_trade_success_or_not(selected_client_index, _task, free_client)
-        if is_succ:
-            succ_cnt += _task.required_client_num
-    return succ_cnt, None
+    scores = random_scores(num_of_client, len(task_list))
+    return select_by_scores(task_list, scores), None
 
 def datasize_select_clients(num_of_client, task_list):
-    succ_cnt = 0
-    free_client = {client_id: True for client_id in range(num_of_client)}  # Initialize free_client outside the loop
-
-    for task_idx, _ in enumerate(task_list):
-        _task = task_list[task_idx]
-       
-        ### Select clients
-        selected_client_index = []
-        clients_candidates = list(range(num_of_client))
-        # Sort clients by datasize in descending order
-        clients_candidates.sort(key=lambda x: _task.all_clients[x].datasize, reverse=True)
-        for client_id in clients_candidates:
-            if free_client[client_id]:  # Check if the client is free
-                is_task_ready = select_one_client(client_id, selected_client_index, free_client, _task)
-                if is_task_ready:
-                    break
-        
-        is_succ = check_trade_success_or_not(selected_client_index, _task, free_client)
-        if is_succ:
-            succ_cnt += _task.required_client_num
-            for client_id in selected_client_index:  # Mark selected clients as not free
-                free_client[client_id] = False
-
-    return succ_cnt, None
+    ### Clients with larger datasize first
+    datasize = task_list[0].all_clients.datasize[:num_of_client].astype(float)
+    scores = np.tile(datasize, (len(task_list), 1)).T
+    return select_by_scores(task_list, scores), None
 
 def greedy_select_clients(num_of_client, task_list, bid_table):
-    succ_cnt = 0
-    free_client = {client_id: True for client_id in range(num_of_client)}  # Initialize free_client outside the loop
-
-    for task_idx, _ in enumerate(task_list):
-        _task = task_list[task_idx]
-       
-        ### Select clients
-        selected_client_index = []
-        clients_candidates = list(range(num_of_client))
-        # Sort clients by datasize/bid_price in descending order
-        clients_candidates.sort(key=lambda x: _task.all_clients[x].datasize / bid_table[x][task_idx], reverse=True)
-        for client_id in clients_candidates:
-            if free_client[client_id]:  # Check if the client is freec
-                is_task_ready = select_one_client(client_id, selected_client_index, free_client, _task)
-                if is_task_ready:
-                    break
-        
-        is_succ = check_trade_success_or_not(selected_client_index, _task, free_client)
-        if is_succ:
-            succ_cnt += _task.required_client_num
-            for client_id in selected_client_index:  # Mark selected clients as not free
-                free_client[client_id] = False
-
-    return succ_cnt, None
+    ### Clients with larger datasize/bid_price first
+    datasize = task_list[0].all_clients.datasize[:num_of_client].astype(float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        scores = (datasize / np.asarray(bid_table, dtype=float).T).T
+    ### Undefined ratios, e.g., when no bid has been made, come last instead of being not eligible
+    scores[np.isnan(scores)] = -np.finfo(float).max
+    return select_by_scores(task_list, scores), None
     
 def AFL_select_clients(num_of_client, task_list):
-    succ_cnt = 0
-    alpha1=0.75
-    alpha2=0.01
-    alpha3=0.1
-    free_client = {client_id: True for client_id in range(num_of_client)}  # Initialize free_client outside the loop
+    ''' AFL-based selection: among free clients, drop those with the smallest valuation,
+        sample (1 - alpha3) of the required clients proportionally to exp(alpha2 * valuation)
+        without replacement, by the Gumbel top-k trick, and the rest uniformly at random
+    '''
+    datasize = task_list[0].all_clients.datasize[:num_of_client].astype(float)
+    AFL_Valuation = datasize * AFL_ALPHA2
+    delete_num = int(AFL_ALPHA1 * num_of_client)
+    free = np.ones(num_of_client, dtype=bool)
+    assignment = [None] * len(task_list)
+    for task_idx, _task in enumerate(task_list):
+        selected_num = _task.required_client_num
+        sel_num = int((1 - AFL_ALPHA3) * selected_num)
 
-    for task_idx, _ in enumerate(task_list):
-        _task = task_list[task_idx]
-       
-        # ### Select clients
-        # selected_client_index = []
-        # clients_candidates = list(range(num_of_client))
-        # # set sampling distribution
-        # datasize = [_task.all_clients[client_id].datasize for client_id in clients_candidates]
-        # AFL_Valuation = np.exp(np.array(datasize) * alpha2)
-        # # 1) select 75% of K(total) users
-        # num_drop = len(datasize) - int(alpha1 * len(datasize))
-        # drop_client_idxs = np.argsort(datasize)[:num_drop]
-        # probs = copy.deepcopy(values)
-        # probs[drop_client_idxs] = 0
-        # probs /= sum(probs)
-        # # 2) select 99% of m users using prob.
-        # num_select = int((1 - alpha3) * num_of_client)
-        # selected = np.random.choice(num_of_client, num_select, replace=False)
-        # # 3) select 1% of m users randomly
-        # not_selected = np.array(list(set(np.arange(num_of_client)) - set(selected)))
-        # selected2 = np.random.choice(not_selected, num_of_client - num_select, replace=False)
-        # selected_client_idxs = np.append(selected, selected2, axis=0)
+        ### Keep the free clients except for the delete_num ones with the smallest valuation
+        candidates = np.nonzero(free)[0]
+        kept = candidates[np.argsort(AFL_Valuation[candidates], kind="stable")[delete_num:]]
+        keys = np.full(num_of_client, -np.inf)
+        keys[kept] = AFL_ALPHA2 * AFL_Valuation[kept] + np.random.gumbel(size=len(kept))
+        sel1 = top_k(keys, sel_num)
 
-        selected_num = _task.required_client_num
-        clients_candidates = [client_id for client_id in range(num_of_client)
-                                if free_client[client_id]]
-        delete_num = int(alpha1 * num_of_client)
-        sel_num = int((1 - alpha3) * selected_num)
-        datasize = [_task.all_clients[client_id].datasize for client_id in clients_candidates]
-        AFL_Valuation = np.array(datasize) * alpha2
-        tmp_value = np.vstack([np.array(clients_candidates), AFL_Valuation])
-        tmp_value = tmp_value[:, tmp_value[1, :].argsort()]
-        prob = np.exp(alpha2 * tmp_value[1, delete_num:])
-        prob = prob/np.sum(prob)
-        sel1 = np.random.choice(np.array(tmp_value[0, delete_num:], dtype=np.int64), 
-                                    sel_num, replace=False, p=prob)
-
-        remain = set(clients_candidates) - set(sel1)
-        sel2 = np.random.choice(list(remain), selected_num-sel_num, replace = False)
-        selected_client_index = np.append(sel1, sel2)
-        
-        is_succ = check_trade_success_or_not(selected_client_index, _task, free_client)
-        if is_succ:
-            succ_cnt += _task.required_client_num
-            for client_id in selected_client_index:  # Mark selected clients as not free
-                free_client[client_id] = False
+        keys = np.where(free, np.random.random_sample(num_of_client), -np.inf)
+        keys[sel1] = -np.inf
+        sel2 = top_k(keys, selected_num - sel_num)
 
-    return succ_cnt, None
+        if len(sel1) < sel_num or len(sel2) < selected_num - sel_num:
+            continue
+        assignment[task_idx] = np.append(sel1, sel2)
+        free[assignment[task_idx]] = False
+
+    return apply_assignment(task_list, assignment), None
 
 def even_select_clients(ask_table, client_feature_list, task_list, bid_table, update=True):
     num_of_client = len(client_feature_list)
-    free_client = [True] * num_of_client
-    succ_cnt = 0
-    reward = 0
     task_bid_list = np.sum(bid_table, axis=0)-5
-    for task_idx, _ in enumerate(task_list):
-        _task = task_list[task_idx]
-       
-        ### Select clients
-        selected_client_index = []
-        clients_candidates = list(range(num_of_client))
-        while len(clients_candidates) > 0:
-            client_idx= random.choice(clients_candidates)
-            clients_candidates.remove(client_idx)
-            if free_client[client_idx] and buyer_give_more_money(client_idx, task_idx, ask_table, bid_table):
-                is_task_ready = select_one_client(client_idx, selected_client_index, free_client, _task)
-                if is_task_ready:
-                    break
-        
-        is_succ = check_trade_success_or_not(selected_client_index, _task, free_client, update = update)
-        if is_succ:
-            succ_cnt += _task.required_client_num
-            ### Cacluate reward  and count successful matching
-            refer_bid = task_bid_list[task_idx]
-            for client_idx in selected_client_index:
-                reward += refer_bid / len(selected_client_index)
 
+    ### Random selection among clients whose ask is covered by the bid of the task
+    scores = random_scores(num_of_client, len(task_list))
+    if not IGNORE_BID_ASK:
+        scores[np.asarray(bid_table) < np.asarray(ask_table)] = -np.inf
+    assignment, _ = assign_clients(scores, task_quotas(task_list))
+    succ_cnt = apply_assignment(task_list, assignment, update=update)
+
+    ### Cacluate reward
+    reward = 0
+    for task_idx, selected in enumerate(assignment):
+        if selected is not None:
+            reward += task_bid_list[task_idx]
     return succ_cnt, reward
 
 def momentum_select_clients(num_of_client, task_list):
-    free_client = [True] * num_of_client
-    succ_cnt = 0
-    for task_idx, _ in enumerate(task_list):
-        _task = task_list[task_idx]
-
+    scores = np.empty((num_of_client, len(task_list)))
+    for task_idx, _task in enumerate(task_list):
         _task.update_proj_list()
 
         ### momemtum_based_grad_proj 是一个list，长度等于 总的client数量，挑出momemtum_based_grad_proj最小的num_users client
@@ -413,22 +585,49 @@ def momentum_select_clients(num_of_client, task_list):
         assert isinstance(momemtum_based_grad_proj, list) or isinstance(momemtum_based_grad_proj, np.ndarray)
         assert len(momemtum_based_grad_proj) == num_of_client
 
-        alpha = 0.1
         momemtum_based_grad_proj = np.array(momemtum_based_grad_proj)
-        ucb = momemtum_based_grad_proj + alpha * np.sqrt((2 * np.log(_task.cient_update_cnt))/_task.client_state.client2selected_cnt)
-        # print("ucb", ucb)
-        sorted_client_idxs = ucb.argsort()[::-1]
-
-        ### Select clients
-        selected_client_index = []
-        for client_idx in sorted_client_idxs:
-            if free_client[client_idx] :
-                # and buyer_give_more_money(client_idx, task_idx, ask_table, bid_table):
-                is_task_ready = select_one_client(client_idx, selected_client_index, free_client, _task)
-                if is_task_ready:
-                    break
-                
-        is_succ = check_trade_success_or_not(selected_client_index, _task, free_client)
-        if is_succ:
-            succ_cnt += _task.required_client_num
-    return succ_cnt, None
\ No newline at end of file
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ucb = momemtum_based_grad_proj + UCB_ALPHA * np.sqrt((2 * np.log(_task.cient_update_cnt))/_task.client_state.client2selected_cnt)
+        ### Clients that have never been selected have an undefined UCB, explore them first
+        scores[:, task_idx] = np.where(np.isnan(ucb), np.inf, ucb)
+    return select_by_scores(task_list, scores), None
+
+def select_clients(policy_name, num_of_client, task_list, market, solver="greedy", verbose=False):
+    ''' Select clients for all tasks by the policy named policy_name, see --policy.
+        market is the MarketState read by the greedy and market-based policies
+    '''
+    if policy_name == "random":
+        return random_select_clients(num_of_client, task_list)
+    elif policy_name == "momentum":
+        return momentum_select_clients(num_of_client, task_list)
+    elif policy_name == "simple":
+        return simple_select_clients(num_of_client, task_list)
+    elif policy_name == "simple_reverse":
+        return simple_select_clients(num_of_client, task_list, reverse=True)
+    elif policy_name == "size":
+        return datasize_select_clients(num_of_client, task_list)
+    elif policy_name == "afl":
+        return AFL_select_clients(num_of_client, task_list)
+    elif policy_name == "greedy":
+        norm_bid_table = util.normalize_data(market.bid_table)
+        return greedy_select_clients(num_of_client, task_list, norm_bid_table)
+    elif policy_name in ["nmfli", "optimal", "mcafee", "even"]:
+        if verbose:
+            util.pretty_print_2darray("Value Table [client\\task]", market.value_sum)
+        ask_table = market.ask_table()
+        if verbose:
+            util.pretty_print_2darray("Ask Table [client\\task]", ask_table)
+        norm_ask_table = util.normalize_data(ask_table)
+        norm_bid_table = util.normalize_data(market.bid_table)
+        client_feature_list = market.client_feature_list
+        if policy_name == "mcafee":
+            return mcafee_select_clients(norm_ask_table, client_feature_list, task_list, norm_bid_table)
+        elif policy_name == "optimal":
+            return optimal_select_clients(norm_ask_table, client_feature_list, task_list, norm_bid_table,
+                verbose=verbose)
+        elif policy_name == "even":
+            return even_select_clients(norm_ask_table, client_feature_list, task_list, norm_bid_table)
+        ### EXPLORE_RATE is read at call time, so that it can be changed by the simulator
+        return my_select_clients(norm_ask_table, client_feature_list, task_list, norm_bid_table,
+            solver=solver, explore_rate=EXPLORE_RATE, verbose=verbose)
+    raise ValueError(f"Invalid policy {policy_name}")
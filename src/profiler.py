@@ -0,0 +1,166 @@
+import csv
+import json
+import time
+import threading
+from contextlib import nullcontext
+
+import torch
+
+_NULL_SPAN = nullcontext()
+
+class _Span:
+    __slots__ = ("profiler", "name", "start", "record")
+
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+        self.record = None
+
+    def __enter__(self):
+        if self.profiler.torch_profile is not None:
+            ### Show the span in the trace of the torch.profiler window
+            self.record = torch.profiler.record_function(self.name)
+            self.record.__enter__()
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        elapsed = time.perf_counter_ns() - self.start
+        if self.record is not None:
+            self.record.__exit__(*exc)
+        self.profiler.add(self.name, elapsed)
+        return False
+
+class Profiler:
+    ''' Wall time of the named phases of an epoch, e.g., "train/local" or "shapley/evaluate".
+
+    Spans are timed by perf_counter_ns and summed per epoch with their counts. Spans of
+    concurrent tasks (--task_workers) and of background evaluations (--async_eval) are
+    summed as well, so the phases of an epoch may add up to more than its wall time.
+    Disabled spans cost one attribute lookup. Epochs in [start, end) of torch_epochs are
+    also captured by torch.profiler, whose trace contains the spans.
+    '''
+    def __init__(self):
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.current = {}
+        self.history = []
+        self.torch_epochs = None
+        self.torch_profile = None
+        self.torch_trace = None
+
+    def configure(self, enabled, torch_epochs=None, torch_trace=None):
+        self.enabled = enabled or torch_epochs is not None
+        self.torch_epochs = torch_epochs
+        self.torch_trace = torch_trace
+
+    def span(self, name):
+        if not self.enabled:
+            return _NULL_SPAN
+        return _Span(self, name)
+
+    def add(self, name, elapsed_ns, count=1):
+        with self.lock:
+            record = self.current.get(name)
+            if record is None:
+                self.current[name] = [elapsed_ns, count]
+            else:
+                record[0] += elapsed_ns
+                record[1] += count
+
+    def start_epoch(self, epoch):
+        if self.torch_epochs is not None and epoch == self.torch_epochs[0]:
+            self.torch_profile = torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU])
+            self.torch_profile.__enter__()
+
+    def end_epoch(self, epoch, logger=None):
+        ''' Close the spans of this epoch and log them to TensorBoard in milliseconds '''
+        if not self.enabled:
+            return
+        with self.lock:
+            spans, self.current = self.current, {}
+        self.history.append((epoch, spans))
+        if logger is not None:
+            for name, (elapsed_ns, count) in spans.items():
+                logger.add_scalar(f"Profile/{name}", elapsed_ns / 1e6, global_step=epoch)
+        if self.torch_profile is not None and epoch + 1 >= self.torch_epochs[1]:
+            self._stop_torch_profile(epoch + 1)
+
+    def _stop_torch_profile(self, end_epoch):
+        self.torch_profile.__exit__(None, None, None)
+        if self.torch_trace is not None:
+            self.torch_profile.export_chrome_trace(self.torch_trace)
+            print(f"Save the torch.profiler trace of epochs [{self.torch_epochs[0]}, "
+                f"{end_epoch}) to {self.torch_trace}")
+        self.torch_profile = None
+
+    def flush(self):
+        ''' Add the spans after the last epoch, e.g., its background evaluation, to that epoch,
+            and save the torch.profiler window if the run ends before the window does
+        '''
+        if self.torch_profile is not None:
+            self._stop_torch_profile(self.history[-1][0] + 1 if len(self.history) > 0 else self.torch_epochs[0])
+        with self.lock:
+            spans, self.current = self.current, {}
+        if len(spans) == 0:
+            return
+        if len(self.history) == 0:
+            self.history.append((0, {}))
+        last = self.history[-1][1]
+        for name, (elapsed_ns, count) in spans.items():
+            record = last.setdefault(name, [0, 0])
+            record[0] += elapsed_ns
+            record[1] += count
+
+    def totals(self):
+        ''' {name: (total ms, count)} over all epochs '''
+        totals = {}
+        for _, spans in self.history:
+            for name, (elapsed_ns, count) in spans.items():
+                total = totals.setdefault(name, [0, 0])
+                total[0] += elapsed_ns
+                total[1] += count
+        return dict([(name, (elapsed_ns / 1e6, count)) for name, (elapsed_ns, count) in sorted(totals.items())])
+
+    def summary(self):
+        lines = ["Profile: phase, total ms, count, mean ms"]
+        for name, (total_ms, count) in self.totals().items():
+            lines.append(f"  {name:<20} {total_ms:12.3f} {count:8d} {total_ms / max(count, 1):10.3f}")
+        return "\n".join(lines)
+
+    def save(self, path):
+        ''' One row per (epoch, phase) in a CSV, or the epochs and totals in a JSON file '''
+        if path.endswith(".json"):
+            profile = {
+                "epochs": [{"epoch": epoch, "spans": dict([(name, {"ms": elapsed_ns / 1e6, "count": count})
+                    for name, (elapsed_ns, count) in spans.items()])} for epoch, spans in self.history],
+                "totals": dict([(name, {"ms": total_ms, "count": count})
+                    for name, (total_ms, count) in self.totals().items()])
+            }
+            with open(path, "w") as fp:
+                json.dump(profile, fp, indent=1)
+        else:
+            with open(path, "w", newline="") as fp:
+                writer = csv.writer(fp)
+                writer.writerow(["epoch", "phase", "ms", "count"])
+                for epoch, spans in self.history:
+                    for name, (elapsed_ns, count) in sorted(spans.items()):
+                        writer.writerow([epoch, name, elapsed_ns / 1e6, count])
+
+### Shared by all tasks of this process
+PROFILER = Profiler()
+
+def span(name):
+    ''' with span("train/local"): ... times the block if profiling is enabled '''
+    return PROFILER.span(name)
+
+def parse_epochs(spec):
+    ''' "5,7" -> (5, 7), i.e., epochs [5, 7); "5" -> (5, 6); "" -> None '''
+    if not spec:
+        return None
+    parts = [int(part) for part in spec.split(",")]
+    if len(parts) == 1:
+        parts.append(parts[0] + 1)
+    if len(parts) != 2 or parts[1] <= parts[0]:
+        raise ValueError(f"Invalid epoch window {spec}")
+    return tuple(parts)
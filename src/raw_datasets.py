@@ -0,0 +1,127 @@
+import os
+import gzip
+import pickle
+import numpy as np
+
+import torch
+from torch.utils.data import Dataset
+
+### Normalization of the original transforms, i.e.,
+#   transforms.Compose([transforms.ToTensor(), transforms.Normalize(mean, std)])
+NORMALIZATION = {
+    "mnist": ((0.1307,), (0.3081,)),
+    "fmnist": ((0.1307,), (0.3081,)),
+    "cifar": ((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)),
+}
+
+### Sub-directories used by torchvision, so that downloaded files can be reused
+MNIST_FOLDERS = {"mnist": "MNIST", "fmnist": "FashionMNIST"}
+CIFAR_FOLDERS = ["cifar-10-batches-py", "cifar-10-batches-bin"]
+
+IDX_DTYPES = {0x08: np.uint8, 0x09: np.int8, 0x0B: ">i2", 0x0C: ">i4", 0x0D: ">f4", 0x0E: ">f8"}
+
+class ArrayDataset(Dataset):
+    ''' A dataset whose samples are preloaded into one float32 tensor of shape (N, C, H, W).
+
+    Samples are already normalized, so indexing does not go through PIL or transforms.
+    `targets` is an int64 array, as read by `sampling.get_labels`.
+    '''
+    def __init__(self, data, targets):
+        self.data = data
+        self.targets = np.asarray(targets, dtype=np.int64)
+
+    def __len__(self):
+        return len(self.targets)
+
+    def __getitem__(self, index):
+        return self.data[index], int(self.targets[index])
+
+def _read_bytes(path):
+    ''' Read a raw file, or its gzip-compressed version '''
+    if os.path.exists(path):
+        with open(path, "rb") as fp:
+            return fp.read()
+    with gzip.open(path + ".gz", "rb") as fp:
+        return fp.read()
+
+def _exists(path):
+    return os.path.exists(path) or os.path.exists(path + ".gz")
+
+def read_idx(path):
+    ''' Parse an IDX file (the format of MNIST and Fashion-MNIST) into a numpy array '''
+    buffer = _read_bytes(path)
+    if buffer[0] != 0 or buffer[1] != 0:
+        raise ValueError(f"{path} is not a valid IDX file")
+    dtype, ndim = IDX_DTYPES[buffer[2]], buffer[3]
+    shape = np.frombuffer(buffer, dtype=">i4", count=ndim, offset=4)
+    return np.frombuffer(buffer, dtype=dtype, offset=4 + 4 * ndim).reshape(shape)
+
+def normalize(images, mean, std):
+    ''' Vectorized ToTensor + Normalize: uint8 images of shape (N, C, H, W) -> float32 tensor '''
+    data = torch.from_numpy(np.asarray(images, dtype=np.float32)).div_(255)
+    mean = torch.tensor(mean, dtype=torch.float32).view(1, -1, 1, 1)
+    std = torch.tensor(std, dtype=torch.float32).view(1, -1, 1, 1)
+    return data.sub_(mean).div_(std)
+
+def mnist_raw_dir(dataset, data_dir):
+    return os.path.join(data_dir, MNIST_FOLDERS[dataset], "raw")
+
+def load_mnist(dataset, data_dir, train=True):
+    raw_dir = mnist_raw_dir(dataset, data_dir)
+    prefix = "train" if train else "t10k"
+    images = read_idx(os.path.join(raw_dir, f"{prefix}-images-idx3-ubyte"))
+    labels = read_idx(os.path.join(raw_dir, f"{prefix}-labels-idx1-ubyte"))
+    mean, std = NORMALIZATION[dataset]
+    return ArrayDataset(normalize(images[:, None], mean, std), labels)
+
+def cifar_raw_dir(data_dir):
+    for folder in CIFAR_FOLDERS:
+        if os.path.isdir(os.path.join(data_dir, folder)):
+            return os.path.join(data_dir, folder)
+    return None
+
+def _cifar_batches(train):
+    return [f"data_batch_{i}" for i in range(1, 6)] if train else ["test_batch"]
+
+def read_cifar_batch(path):
+    ''' Returns (images of shape (N, 3, 32, 32), labels) of a python or binary CIFAR-10 batch '''
+    if os.path.exists(path + ".bin"):
+        ### Binary version: each record is <1 x label><3072 x pixel>
+        with open(path + ".bin", "rb") as fp:
+            records = np.frombuffer(fp.read(), dtype=np.uint8).reshape(-1, 3073)
+        return records[:, 1:].reshape(-1, 3, 32, 32), records[:, 0]
+    with open(path, "rb") as fp:
+        entry = pickle.load(fp, encoding="latin1")
+    labels = entry["labels"] if "labels" in entry else entry["fine_labels"]
+    return np.asarray(entry["data"], dtype=np.uint8).reshape(-1, 3, 32, 32), labels
+
+def load_cifar(data_dir, train=True):
+    raw_dir = cifar_raw_dir(data_dir)
+    batches = [read_cifar_batch(os.path.join(raw_dir, name)) for name in _cifar_batches(train)]
+    images = np.concatenate([images for images, _ in batches])
+    labels = np.concatenate([labels for _, labels in batches])
+    mean, std = NORMALIZATION["cifar"]
+    return ArrayDataset(normalize(images, mean, std), labels)
+
+def has_raw_files(dataset, data_dir):
+    ''' Whether both the training and test raw files of a dataset are in data_dir '''
+    if dataset == "cifar":
+        raw_dir = cifar_raw_dir(data_dir)
+        if raw_dir is None:
+            return False
+        return all(os.path.exists(os.path.join(raw_dir, name)) or
+                   os.path.exists(os.path.join(raw_dir, name + ".bin"))
+                   for name in _cifar_batches(True) + _cifar_batches(False))
+    if dataset not in MNIST_FOLDERS:
+        return False
+    raw_dir = mnist_raw_dir(dataset, data_dir)
+    return all(_exists(os.path.join(raw_dir, f"{prefix}-{kind}-idx{ndim}-ubyte"))
+               for prefix in ["train", "t10k"] for kind, ndim in [("images", 3), ("labels", 1)])
+
+def load_raw_dataset(dataset, data_dir):
+    ''' Returns (train_dataset, test_dataset) parsed from the raw files, without network access '''
+    if dataset == "cifar":
+        return load_cifar(data_dir, train=True), load_cifar(data_dir, train=False)
+    elif dataset in MNIST_FOLDERS:
+        return load_mnist(dataset, data_dir, train=True), load_mnist(dataset, data_dir, train=False)
+    raise ValueError(f"Invalid dataset {dataset}")
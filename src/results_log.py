@@ -0,0 +1,112 @@
+import os
+import json
+import queue
+import struct
+import threading
+
+import numpy as np
+
+### File layout:
+#   MAGIC | header length (uint64) | header (JSON, {"columns": [...]}) | chunk | chunk | ...
+#   Each chunk is a row count n (uint64) followed by n float64 values of each column in
+#   turn. Chunks are only appended, so a crash loses at most the chunk being written,
+#   which is shorter than its row count and ignored by read_results.
+MAGIC = b"NMFLIRS1"
+SUFFIX = ".results"
+
+def _chunk(rows, column_num):
+    data = np.asarray(rows, dtype=np.float64).reshape(len(rows), column_num)
+    return struct.pack("<Q", len(rows)) + np.ascontiguousarray(data.T).tobytes()
+
+class ResultsWriter:
+    ''' Append rows of results to a columnar file in chunks of batch_size rows.
+
+    Rows are buffered by append and full chunks are written and fsynced by a
+    background thread, so the training loop never waits for the disk. The file is
+    created with the rows given to the constructor, e.g., those of a resumed run.
+    '''
+    def __init__(self, path, columns, batch_size, rows=()):
+        self.path = path
+        self.columns = list(columns)
+        self.batch_size = max(1, batch_size)
+        self.rows = len(rows)
+        self.pending = []
+        self.error = None
+
+        header = json.dumps({"columns": self.columns}).encode()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = f"{path}.tmp.{os.getpid()}"
+        with open(tmp_path, "wb") as fp:
+            fp.write(MAGIC)
+            fp.write(struct.pack("<Q", len(header)))
+            fp.write(header)
+            if len(rows) > 0:
+                fp.write(_chunk(rows, len(self.columns)))
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, path)
+
+        self.fp = open(path, "ab")
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._write, name="results", daemon=True)
+        self.thread.start()
+
+    def append(self, rows):
+        ''' Buffer rows, returns True if a chunk is submitted '''
+        if self.error is not None:
+            raise self.error
+        self.pending.extend(rows)
+        self.rows += len(rows)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+            return True
+        return False
+
+    def flush(self):
+        if len(self.pending) > 0:
+            self.queue.put(_chunk(self.pending, len(self.columns)))
+            self.pending = []
+
+    def _write(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is None:
+                break
+            try:
+                self.fp.write(chunk)
+                self.fp.flush()
+                os.fsync(self.fp.fileno())
+            except Exception as e:
+                self.error = e
+
+    def close(self):
+        ''' Write the buffered rows and wait for the writer thread '''
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        self.fp.close()
+        if self.error is not None:
+            raise self.error
+
+def read_results(path):
+    ''' Returns {column: float64 array} of all complete chunks of a results file '''
+    with open(path, "rb") as fp:
+        buffer = fp.read()
+    if buffer[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"{path} is not a valid results file")
+    header_len, = struct.unpack_from("<Q", buffer, len(MAGIC))
+    offset = len(MAGIC) + 8 + header_len
+    columns = json.loads(buffer[len(MAGIC) + 8:offset])["columns"]
+
+    chunks = []
+    while offset + 8 <= len(buffer):
+        row_num, = struct.unpack_from("<Q", buffer, offset)
+        nbytes = row_num * len(columns) * 8
+        if offset + 8 + nbytes > len(buffer):
+            ### The chunk being written when the run stopped
+            break
+        chunks.append(np.frombuffer(buffer, dtype=np.float64, count=row_num * len(columns),
+            offset=offset + 8).reshape(len(columns), row_num))
+        offset += 8 + nbytes
+    data = np.concatenate(chunks, axis=1) if len(chunks) > 0 else np.zeros((len(columns), 0))
+    return dict(zip(columns, data))
@@ -2,18 +2,228 @@
 # -*- coding: utf-8 -*-
 # Python version: 3.6
 
+import os
+import json
+import hashlib
 import numpy as np
 from torchvision import datasets, transforms
 from typing import Union, Dict
 from collections import Counter
 
+from exp_utils import DatasetSplit, DatasetRelabel
+from checkpoint import save_arrays, load_arrays
+from raw_datasets import has_raw_files, load_raw_dataset
+from synthetic import load_synthetic_dataset
+
 def check_dist(name, _dataset):
-    _, lables = zip(*list((_dataset)))
-    lables = [int(x) for x in lables]
-    counter = Counter(lables)
+    lables = get_labels(_dataset)
+    counter = Counter(lables.tolist())
     print(f"{name}, distribution: {counter}")
     return counter
 
+#############################################
+######### Vectorized partition engine #########
+# A partition is stored in a CSR-style layout (indices, offsets): the data
+# indexes of client i are indices[offsets[i]:offsets[i+1]], as int32.
+
+def get_labels(dataset):
+    """
+    Returns the labels of all samples of a dataset as an int64 array. Labels are
+    read from `targets` of torchvision datasets, so samples are not decoded.
+    """
+    if isinstance(dataset, DatasetSplit):
+        labels = get_labels(dataset.dataset)[np.asarray(dataset.idxs, dtype=np.int64)]
+        if isinstance(dataset, DatasetRelabel) and dataset.target_labels is not None:
+            ### Map original labels to new labels, others to the minor class
+            lookup = np.full(max(labels.max(), max(dataset.target_labels)) + 1,
+                dataset.minor_class_label, dtype=np.int64)
+            lookup[list(dataset.target_labels)] = np.arange(len(dataset.target_labels))
+            labels = lookup[labels]
+        return labels
+    for attr in ["targets", "labels"]:
+        if hasattr(dataset, attr):
+            labels = getattr(dataset, attr)
+            if hasattr(labels, "numpy"):
+                labels = labels.numpy()
+            return np.asarray(labels, dtype=np.int64)
+    return np.array([int(y) for _, y in dataset], dtype=np.int64)
+
+def partition_to_dict(indices, offsets):
+    """ Convert a partition to a dict of client id -> data indexes """
+    return {i: indices[offsets[i]:offsets[i+1]] for i in range(len(offsets) - 1)}
+
+def partition_from_dict(client2dataidxs, num_users=None):
+    """ Convert a dict of client id -> data indexes to a partition (indices, offsets) """
+    num_users = len(client2dataidxs) if num_users is None else num_users
+    sizes = [len(client2dataidxs[i]) for i in range(num_users)]
+    offsets = _sizes_to_offsets(sizes)
+    if offsets[-1] == 0:
+        return np.zeros(0, dtype=np.int32), offsets
+    indices = np.concatenate([np.asarray(client2dataidxs[i], dtype=np.int32)
+        for i in range(num_users)])
+    return indices, offsets
+
+def _sizes_to_offsets(sizes):
+    offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+    np.cumsum(sizes, out=offsets[1:])
+    return offsets
+
+def _gather_ranges(source, starts, lengths, modulo=None):
+    """
+    Concatenate source[starts[i]:starts[i]+lengths[i]] for all i without a python loop.
+    If modulo is given, the i-th range wraps around within [bases[i], bases[i]+sizes[i]),
+    where modulo = (bases, sizes).
+    """
+    lengths = np.asarray(lengths, dtype=np.int64)
+    offsets = _sizes_to_offsets(lengths)
+    within = np.arange(offsets[-1], dtype=np.int64) - np.repeat(offsets[:-1], lengths)
+    positions = np.repeat(np.asarray(starts, dtype=np.int64), lengths) + within
+    if modulo is not None:
+        bases, sizes = modulo
+        bases = np.repeat(np.asarray(bases, dtype=np.int64), lengths)
+        positions = bases + (positions - bases) % np.repeat(np.asarray(sizes, dtype=np.int64), lengths)
+    return source[positions]
+
+def sort_by_label(labels, num_classes=None, rng=None):
+    """
+    Returns (order, class_starts, class_sizes), where order are the sample indexes
+    grouped by label, and samples of class k are order[class_starts[k]:class_starts[k]+class_sizes[k]].
+    Samples of the same class keep their original order, or are shuffled if rng is given.
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    if rng is None:
+        order = np.argsort(labels, kind="stable")
+    else:
+        perm = rng.permutation(len(labels))
+        order = perm[np.argsort(labels[perm], kind="stable")]
+    class_sizes = np.bincount(labels, minlength=num_classes or 0)
+    class_starts = _sizes_to_offsets(class_sizes)[:-1]
+    return order, class_starts, class_sizes
+
+def partition_iid(num_samples, num_users, rng=np.random):
+    """ Each client gets num_samples // num_users samples drawn without replacement """
+    num_items = num_samples // num_users
+    indices = rng.permutation(num_samples)[:num_items * num_users].astype(np.int32)
+    return indices, np.arange(num_users + 1, dtype=np.int64) * num_items
+
+def partition_shards(labels, shards_per_user, shard_size, rng=np.random):
+    """
+    Cut the label-sorted samples into shards of shard_size samples, and assign
+    shards_per_user[i] random shards to client i. Shards are never shared.
+    """
+    shards_per_user = np.asarray(shards_per_user, dtype=np.int64)
+    num_shards = len(labels) // shard_size
+    assert shards_per_user.sum() <= num_shards, (shards_per_user.sum(), num_shards)
+    order = np.argsort(np.asarray(labels)[:num_shards * shard_size], kind="stable")
+    shard_ids = rng.permutation(num_shards)[:shards_per_user.sum()]
+    indices = _gather_ranges(order, shard_ids * shard_size,
+        np.full(len(shard_ids), shard_size)).astype(np.int32)
+    return indices, _sizes_to_offsets(shards_per_user * shard_size)
+
+def partition_by_counts(labels, counts, rng=None):
+    """
+    Client i gets counts[i][k] samples of class k. Samples of each class are handed
+    out in order (or in a random order if rng is given) and never shared, so if a
+    class runs out of samples, later clients get fewer samples of this class.
+    """
+    counts = np.asarray(counts, dtype=np.int64)
+    num_classes = counts.shape[1]
+    order, class_starts, class_sizes = sort_by_label(labels, num_classes, rng=rng)
+    class_starts, class_sizes = class_starts[:num_classes], class_sizes[:num_classes]
+
+    ends = np.minimum(np.cumsum(counts, axis=0), class_sizes)
+    begins = np.minimum(np.cumsum(counts, axis=0) - counts, class_sizes)
+    lengths = ends - begins
+    indices = _gather_ranges(order, (class_starts + begins).ravel(), lengths.ravel()).astype(np.int32)
+    return indices, _sizes_to_offsets(lengths.sum(axis=1))
+
+def partition_major_minor(labels, is_major, num_per_major, num_per_minor, rng=np.random):
+    """
+    is_major is a bool matrix of shape (#client, #class). Client i draws num_per_major
+    samples of each class k with is_major[i][k], and num_per_minor samples of other classes.
+    Samples are drawn without replacement within one client, but different clients may
+    share samples: each client takes a window at a random offset of one shuffled copy of the class.
+    """
+    is_major = np.asarray(is_major, dtype=bool)
+    num_users, num_classes = is_major.shape
+    order, class_starts, class_sizes = sort_by_label(labels, num_classes, rng=rng)
+    class_starts, class_sizes = class_starts[:num_classes], class_sizes[:num_classes]
+
+    counts = np.where(is_major, num_per_major, num_per_minor)
+    assert np.all(counts <= class_sizes), "Not enough samples in a class"
+    window_offsets = (rng.random((num_users, num_classes)) * class_sizes).astype(np.int64)
+    bases = np.broadcast_to(class_starts, counts.shape).ravel()
+    indices = _gather_ranges(order, (class_starts + window_offsets).ravel(), counts.ravel(),
+        modulo=(bases, np.broadcast_to(class_sizes, counts.shape).ravel())).astype(np.int32)
+    return indices, _sizes_to_offsets(counts.sum(axis=1))
+
+def partition_histogram(labels, indices, offsets, num_classes=None):
+    """ Returns the label histogram of each client, of shape (#client, #class) """
+    num_users = len(offsets) - 1
+    num_classes = num_classes or int(np.max(labels)) + 1
+    client_ids = np.repeat(np.arange(num_users), np.diff(offsets))
+    hist = np.bincount(client_ids * num_classes + np.asarray(labels)[indices],
+        minlength=num_users * num_classes)
+    return hist.reshape(num_users, num_classes)
+
+def datasize_weights(num_users, skew="none", param=1.0, rng=np.random):
+    """
+    Relative data size of each client
+        none: all clients have the same size of data
+        lognormal: log-normal distribution with sigma=param
+        powerlaw: Pareto distribution with shape=param, i.e., a power-law tail
+    """
+    if skew == "none":
+        return np.ones(num_users)
+    elif skew == "lognormal":
+        return rng.lognormal(0, param, num_users)
+    elif skew == "powerlaw":
+        return rng.pareto(param, num_users) + 1
+    else:
+        raise ValueError(f"Invalid data size skew {skew}")
+
+def partition_dirichlet(labels, num_users, alpha, size_weights=None, num_classes=None, rng=np.random):
+    """
+    Label skew: the label distribution of each client follows Dir(alpha), smaller alpha
+    means more skewed labels. Data size skew: client i gets a share of the data
+    proportional to size_weights[i]. Only (#client, #class) matrices are created.
+
+    When a class does not have enough samples for all clients, the number of samples
+    of this class is scaled down for all clients; every client gets at least one sample.
+    Returns (indices, offsets, hist), where hist is the label histogram of each client.
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    num_classes = num_classes or int(labels.max()) + 1
+    class_sizes = np.bincount(labels, minlength=num_classes)
+    if num_users > len(labels):
+        raise ValueError(f"Can not partition {len(labels)} samples among {num_users} clients")
+
+    if size_weights is None:
+        size_weights = np.ones(num_users)
+    size_weights = np.asarray(size_weights, dtype=np.float64)
+    sizes = len(labels) * size_weights / size_weights.sum()
+
+    proportions = rng.dirichlet(np.full(num_classes, alpha), size=num_users)
+    desired = proportions * sizes[:, None]
+    ### Scale down classes that are over-subscribed
+    scale = np.minimum(1, class_sizes / np.maximum(desired.sum(axis=0), 1e-12))
+    counts = np.floor(desired * scale).astype(np.int64)
+
+    ### Give one sample of a class with remaining samples to each empty client
+    empty_clients = np.where(counts.sum(axis=1) == 0)[0]
+    if len(empty_clients) > 0:
+        remain = class_sizes - counts.sum(axis=0)
+        if remain.sum() < len(empty_clients):
+            raise ValueError("Not enough samples to give every client one sample")
+        pool = rng.permutation(np.repeat(np.arange(num_classes), remain))[:len(empty_clients)]
+        counts[empty_clients, pool] = 1
+
+    indices, offsets = partition_by_counts(labels, counts, rng=rng)
+    return indices, offsets, counts
+
+#############################################
+############### Mnist dataset ###############
+
 def mnist_iid(dataset, num_users):
     """
     Sample I.I.D. client data from MNIST dataset
@@ -21,13 +231,7 @@ def mnist_iid(dataset, num_users):
     :param num_users:
     :return: dict of image index
     """
-    num_items = int(len(dataset)/num_users)
-    client2dataidxs, all_idxs = {}, [i for i in range(len(dataset))]
-    for i in range(num_users):
-        client2dataidxs[i] = set(np.random.choice(all_idxs, num_items,
-                                             replace=False))
-        all_idxs = list(set(all_idxs) - client2dataidxs[i])
-    return client2dataidxs
+    return partition_to_dict(*partition_iid(len(dataset), num_users))
 
 
 def mnist_noniid_v1(dataset, num_users):
@@ -38,25 +242,10 @@ def mnist_noniid_v1(dataset, num_users):
     :return:
     """
     # 60,000 training imgs -->  200 imgs/shard X 300 shards
-    num_shards, num_imgs = 200, 300
-    idx_shard = [i for i in range(num_shards)]
-    client2dataidxs = {i: np.array([]) for i in range(num_users)}
-    idxs = np.arange(num_shards*num_imgs)
-    labels = dataset.train_labels.numpy()
-
-    # sort labels
-    idxs_labels = np.vstack((idxs, labels))
-    idxs_labels = idxs_labels[:, idxs_labels[1, :].argsort()]
-    idxs = idxs_labels[0, :]
-
     # divide and assign 2 shards/client
-    for i in range(num_users):
-        rand_set = set(np.random.choice(idx_shard, 2, replace=False))
-        idx_shard = list(set(idx_shard) - rand_set)
-        for rand in rand_set:
-            client2dataidxs[i] = np.concatenate(
-                (client2dataidxs[i], idxs[rand*num_imgs:(rand+1)*num_imgs]), axis=0)
-    return client2dataidxs
+    num_shards, num_imgs = 200, 300
+    labels = get_labels(dataset)[:num_shards*num_imgs]
+    return partition_to_dict(*partition_shards(labels, [2] * num_users, num_imgs))
 
 def mnist_noniid_v2(dataset, num_users):
     """
@@ -65,10 +254,7 @@ def mnist_noniid_v2(dataset, num_users):
     :param num_users:
     :return:
     """
-    # 60,000 training imgs -->  200 imgs/shard X 300 shards
-    client2dataidxs = {i: np.array([]) for i in range(num_users)}
-    # idxs = np.arange(len(dataset))
-    labels = dataset.train_labels.numpy()
+    labels = get_labels(dataset)
 
     CLASS_NUM = 10
     MAJOR2MINOR_SAMPLE_RATIO = 99
@@ -78,43 +264,26 @@ def mnist_noniid_v2(dataset, num_users):
     sample_num_per_major_class = int(MAJOR2MINOR_SAMPLE_RATIO * sample_num_per_client / (MAJOR2MINOR_SAMPLE_RATIO * MAJOR_CLASS_NUM + 1 * (CLASS_NUM - MAJOR_CLASS_NUM)))
     sample_num_per_minor_class = int(1 * sample_num_per_client / (MAJOR2MINOR_SAMPLE_RATIO * MAJOR_CLASS_NUM + 1 * (CLASS_NUM - MAJOR_CLASS_NUM)))
 
-    # Group labels
-    label2idxs = []
-    for digit in range(CLASS_NUM):
-        indexs = [i for i, label in enumerate(labels) if label == digit]
-        # indexs = indexs[0:5421]
-        label2idxs.append(indexs)
-
     ### Construct an imbalanced dataset
-    ### For each client, randomly select 2 labels as the major class
-    for i in range(num_users):
-
-        if i in [0, 1]:
-            major_class = list(range(5))
-        elif i in [2, 3]:
-            major_class = list(range(5, 10))
-        else:
-            ### make sure the major classes do not belong to [0, 5) or [5, 10) at the same time
-            major_class1 = np.random.choice(int(CLASS_NUM/2)-2, 
-                int(MAJOR_CLASS_NUM/2), replace=False)
-            major_class2 = np.random.choice(int(CLASS_NUM/2)-2,
-                MAJOR_CLASS_NUM-int(MAJOR_CLASS_NUM/2), replace=False) + int(CLASS_NUM/2)
-            major_class = list(major_class1) + list(major_class2)
-            
-        # major_class = np.random.choice(CLASS_NUM, MAJOR_CLASS_NUM, replace=False)
-        # major_class = [0, 1]
-
-        for _class in range(CLASS_NUM):
-            sample_idxs_of_this_class = label2idxs[_class]
-            if _class in major_class:
-                client2dataidxs[i] = np.concatenate((client2dataidxs[i],
-                    np.random.choice(sample_idxs_of_this_class, sample_num_per_major_class, replace=False)), axis=0)
-            else:
-                ### In minor class
-                client2dataidxs[i] = np.concatenate((client2dataidxs[i],
-                    np.random.choice(sample_idxs_of_this_class, sample_num_per_minor_class, replace=False)), axis=0)
-
-    return client2dataidxs
+    ### make sure the major classes do not belong to [0, 5) or [5, 10) at the same time
+    half = int(CLASS_NUM/2)
+    candidate_num = half - 2
+    is_major = np.zeros((num_users, CLASS_NUM), dtype=bool)
+    ### Randomly choose int(MAJOR_CLASS_NUM/2) classes from [0, candidate_num) and the
+    # others from [half, half + candidate_num) for each client, by sorting random keys
+    major_class1 = np.argsort(np.random.random((num_users, candidate_num)), axis=1)[:, :int(MAJOR_CLASS_NUM/2)]
+    major_class2 = np.argsort(np.random.random((num_users, candidate_num)), axis=1)[
+        :, :MAJOR_CLASS_NUM-int(MAJOR_CLASS_NUM/2)] + half
+    rows = np.arange(num_users)[:, None]
+    is_major[rows, major_class1] = True
+    is_major[rows, major_class2] = True
+    ### Clients 0, 1 take [0, 5) as major classes, and clients 2, 3 take [5, 10)
+    is_major[:4] = False
+    is_major[:2, :MAJOR_CLASS_NUM] = True
+    is_major[2:4, half:half+MAJOR_CLASS_NUM] = True
+
+    return partition_to_dict(*partition_major_minor(labels, is_major,
+        sample_num_per_major_class, sample_num_per_minor_class))
 
 CLIENT_DATA_DIST = np.array([
     #  0,  1,  2,   3,   4,   5,  6,   7,    8,  9
@@ -140,7 +309,9 @@ def load_custom_dataset(dataset, num_users, is_even_datasize):
     :param num_users:
     :return:
     """
-
+    assert num_users <= CLIENT_NUM, f"The custom dataset supports at most {CLIENT_NUM} clients, " \
+        "use --partition=dirichlet for more clients"
+    labels = get_labels(dataset)
     counter = check_dist("Origin Dataset", dataset)
 
     total_data_size = sum(counter.values())
@@ -155,33 +326,24 @@ def load_custom_dataset(dataset, num_users, is_even_datasize):
         assert CLIENT_NUM == len(CLIENT_DATA_RATIO)
         CLIENT_DATA_NUM = [int(ratio * total_data_size) for ratio in CLIENT_DATA_RATIO]
 
-    client2dataidxs: Dict[int, np.ndarray] = {i: np.array([]) for i in range(num_users)}
-
-    # Group labels
-    label2idxs = {}
-    for idx, (_, y) in enumerate(dataset):
-        if y not in label2idxs:
-            label2idxs[y] = []
-        label2idxs[y].append(idx)
-
-    ### When traversing all data by label, store the current 
-    # position of the idx list of each label
-    label2bias = [0] * CLASS_NUM
-    
-    for client_id in range(num_users):
-
-        _dist: np.ndarray = CLIENT_DATA_DIST[client_id]
-        _data_num: int = CLIENT_DATA_NUM[client_id]
-        _data_num_per_label: np.ndarray = _dist * _data_num / 100
+    ### Number of samples of each label for each client, samples of each label
+    # are handed out to clients in order
+    counts = (CLIENT_DATA_DIST[:num_users] * np.array(CLIENT_DATA_NUM[:num_users])[:, None] / 100).astype(int)
+    return partition_to_dict(*partition_by_counts(labels, counts))
 
-        for _class_id in range(CLASS_NUM):
-            all_data_idxs_of_this_class: list = label2idxs[_class_id]
-            required_data_num_this_class: int = int(_data_num_per_label[_class_id])
-            required_data_idxs = all_data_idxs_of_this_class[label2bias[_class_id]:(label2bias[_class_id]+required_data_num_this_class)]
-            label2bias[_class_id] += required_data_num_this_class
-            client2dataidxs[client_id] = np.concatenate((client2dataidxs[client_id], required_data_idxs), axis=0)
-
-    return client2dataidxs
+def load_dirichlet_dataset(dataset, args):
+    """
+    Sample client data with Dirichlet label skew and parametric data size skew,
+    which supports any number of clients
+    """
+    rng = np.random.default_rng(args.seed)
+    weights = datasize_weights(args.num_users, args.datasize_skew, args.datasize_param, rng=rng)
+    indices, offsets, hist = partition_dirichlet(get_labels(dataset), args.num_users,
+        args.dirichlet_alpha, size_weights=weights, rng=rng)
+    sizes = hist.sum(axis=1)
+    print(f"Dirichlet partition (alpha={args.dirichlet_alpha}, size skew={args.datasize_skew}): "
+        f"{args.num_users} clients, data size min={sizes.min()}, median={int(np.median(sizes))}, max={sizes.max()}")
+    return partition_to_dict(indices, offsets)
 
 def mnist_noniid(dataset, num_users):
     # return mnist_noniid_v1(dataset, num_users)
@@ -209,15 +371,7 @@ def mnist_noniid_unequal(dataset, num_users):
     """
     # 60,000 training imgs --> 50 imgs/shard X 1200 shards
     num_shards, num_imgs = 1200, 50
-    idx_shard = [i for i in range(num_shards)]
-    client2dataidxs = {i: np.array([]) for i in range(num_users)}
-    idxs = np.arange(num_shards*num_imgs)
-    labels = dataset.train_labels.numpy()
-
-    # sort labels
-    idxs_labels = np.vstack((idxs, labels))
-    idxs_labels = idxs_labels[:, idxs_labels[1, :].argsort()]
-    idxs = idxs_labels[0, :]
+    labels = get_labels(dataset)[:num_shards*num_imgs]
 
     # Minimum and maximum shards assigned per client:
     min_shard = 1
@@ -231,61 +385,20 @@ def mnist_noniid_unequal(dataset, num_users):
                                   sum(random_shard_size) * num_shards)
     random_shard_size = random_shard_size.astype(int)
 
-    # Assign the shards randomly to each client
     if sum(random_shard_size) > num_shards:
-
-        for i in range(num_users):
-            # First assign each client 1 shard to ensure every client has
-            # atleast one shard of data
-            rand_set = set(np.random.choice(idx_shard, 1, replace=False))
-            idx_shard = list(set(idx_shard) - rand_set)
-            for rand in rand_set:
-                client2dataidxs[i] = np.concatenate(
-                    (client2dataidxs[i], idxs[rand*num_imgs:(rand+1)*num_imgs]),
-                    axis=0)
-
-        random_shard_size = random_shard_size-1
-
-        # Next, randomly assign the remaining shards
-        for i in range(num_users):
-            if len(idx_shard) == 0:
-                continue
-            shard_size = random_shard_size[i]
-            if shard_size > len(idx_shard):
-                shard_size = len(idx_shard)
-            rand_set = set(np.random.choice(idx_shard, shard_size,
-                                            replace=False))
-            idx_shard = list(set(idx_shard) - rand_set)
-            for rand in rand_set:
-                client2dataidxs[i] = np.concatenate(
-                    (client2dataidxs[i], idxs[rand*num_imgs:(rand+1)*num_imgs]),
-                    axis=0)
+        # First assign each client 1 shard to ensure every client has
+        # atleast one shard of data, then assign the remaining shards
+        # in the order of clients until shards run out
+        extra_shard_size = random_shard_size - 1
+        remain = num_shards - num_users
+        assigned_before = np.cumsum(extra_shard_size) - extra_shard_size
+        shard_size = 1 + np.clip(remain - assigned_before, 0, extra_shard_size)
     else:
+        shard_size = random_shard_size.copy()
+        # Add the leftover shards to the client with minimum images
+        shard_size[np.argmin(shard_size)] += num_shards - sum(random_shard_size)
 
-        for i in range(num_users):
-            shard_size = random_shard_size[i]
-            rand_set = set(np.random.choice(idx_shard, shard_size,
-                                            replace=False))
-            idx_shard = list(set(idx_shard) - rand_set)
-            for rand in rand_set:
-                client2dataidxs[i] = np.concatenate(
-                    (client2dataidxs[i], idxs[rand*num_imgs:(rand+1)*num_imgs]),
-                    axis=0)
-
-        if len(idx_shard) > 0:
-            # Add the leftover shards to the client with minimum images:
-            shard_size = len(idx_shard)
-            # Add the remaining shard to the client with lowest data
-            k = min(client2dataidxs, key=lambda x: len(client2dataidxs.get(x)))
-            rand_set = set(np.random.choice(idx_shard, shard_size,
-                                            replace=False))
-            idx_shard = list(set(idx_shard) - rand_set)
-            for rand in rand_set:
-                client2dataidxs[k] = np.concatenate(
-                    (client2dataidxs[k], idxs[rand*num_imgs:(rand+1)*num_imgs]),
-                    axis=0)
-
-    return client2dataidxs
+    return partition_to_dict(*partition_shards(labels, shard_size, num_imgs))
 
 
 #############################################
@@ -298,13 +411,7 @@ def cifar_iid(dataset, num_users):
     :param num_users:
     :return: dict of image index
     """
-    num_items = int(len(dataset)/num_users)
-    client2dataidxs, all_idxs = {}, [i for i in range(len(dataset))]
-    for i in range(num_users):
-        client2dataidxs[i] = set(np.random.choice(all_idxs, num_items,
-                                             replace=False))
-        all_idxs = list(set(all_idxs) - client2dataidxs[i])
-    return client2dataidxs
+    return partition_to_dict(*partition_iid(len(dataset), num_users))
 
 def cifar_noniid(dataset, num_users):
     """
@@ -314,25 +421,9 @@ def cifar_noniid(dataset, num_users):
     :return:
     """
     num_shards, num_imgs = 200, 250
-    idx_shard = [i for i in range(num_shards)]
-    client2dataidxs = {i: np.array([]) for i in range(num_users)}
-    idxs = np.arange(num_shards*num_imgs)
-    # labels = dataset.train_labels.numpy()
-    labels = np.array(dataset.targets)
-
-    # sort labels
-    idxs_labels = np.vstack((idxs, labels))
-    idxs_labels = idxs_labels[:, idxs_labels[1, :].argsort()]
-    idxs = idxs_labels[0, :]
-
-    # divide and assign
-    for i in range(num_users):
-        rand_set = set(np.random.choice(idx_shard, 2, replace=False))
-        idx_shard = list(set(idx_shard) - rand_set)
-        for rand in rand_set:
-            client2dataidxs[i] = np.concatenate(
-                (client2dataidxs[i], idxs[rand*num_imgs:(rand+1)*num_imgs]), axis=0)
-    return client2dataidxs
+    labels = get_labels(dataset)[:num_shards*num_imgs]
+    # divide and assign 2 shards/client
+    return partition_to_dict(*partition_shards(labels, [2] * num_users, num_imgs))
 
 
 def load_federated_mnist_dataset(dataset, num_users):
@@ -342,7 +433,7 @@ def load_federated_mnist_dataset(dataset, num_users):
     :param num_users:
     :return:
     """
-
+    labels = get_labels(dataset)
     counter = check_dist("Origin Dataset", dataset)
 
     total_data_size = sum(counter.values())
@@ -351,43 +442,148 @@ def load_federated_mnist_dataset(dataset, num_users):
     data_size_per_client = int(total_data_size / CLIENT_NUM)
     CLIENT_DATA_NUM = [data_size_per_client] * CLIENT_NUM
 
-    client2dataidxs: Dict[int, np.ndarray] = {i: np.array([]) for i in range(num_users)}
+    counts = (CLIENT_DATA_DIST[:num_users] * np.array(CLIENT_DATA_NUM[:num_users])[:, None] / 100).astype(int)
+    return partition_to_dict(*partition_by_counts(labels, counts))
 
-    # Group labels
-    label2idxs = {}
-    for idx, (_, y) in enumerate(dataset):
-        if y not in label2idxs:
-            label2idxs[y] = []
-        label2idxs[y].append(idx)
 
-    ### When traversing all data by label, store the current 
-    # position of the idx list of each label
-    label2bias = [0] * CLASS_NUM
-    
-    for client_id in range(num_users):
+def sample_client_data(args, train_dataset):
+    """ Split the training data amongst users according to args """
+    if args.partition == "custom":
+        return load_custom_dataset(
+            dataset=train_dataset,
+            num_users=args.num_users,
+            is_even_datasize=(not args.unequal))
+    elif args.partition == "dirichlet":
+        return load_dirichlet_dataset(train_dataset, args)
+    elif args.partition != "standard":
+        raise ValueError(f"Invalid partition {args.partition}")
 
-        _dist: np.ndarray = CLIENT_DATA_DIST[client_id]
-        _data_num: int = CLIENT_DATA_NUM[client_id]
-        _data_num_per_label: np.ndarray = _dist * _data_num / 100
-
-        for _class_id in range(CLASS_NUM):
-            all_data_idxs_of_this_class: list = label2idxs[_class_id]
-            required_data_num_this_class: int = int(_data_num_per_label[_class_id])
-            required_data_idxs = all_data_idxs_of_this_class[label2bias[_class_id]:(label2bias[_class_id]+required_data_num_this_class)]
-            label2bias[_class_id] += required_data_num_this_class
-            client2dataidxs[client_id] = np.concatenate((client2dataidxs[client_id], required_data_idxs), axis=0)
-
-    return client2dataidxs
+    if args.dataset == 'cifar':
+        if args.iid:
+            # Sample IID user data from Mnist
+            return cifar_iid(train_dataset, args.num_users)
+        else:
+            # Sample Non-IID user data from Mnist
+            if args.unequal:
+                # Chose uneuqal splits for every user
+                raise NotImplementedError()
+            else:
+                # Chose euqal splits for every user
+                return cifar_noniid(train_dataset, args.num_users)
+    else:
+        if args.halfiid:
+            return mnist_iid_noniid(train_dataset, args.num_users)
+        elif args.iid:
+            # Sample IID user data from Mnist
+            return mnist_iid(train_dataset, args.num_users)
+        else:
+            # Sample Non-IID user data from Mnist
+            if args.unequal:
+                # Chose uneuqal splits for every user
+                return mnist_noniid_unequal(train_dataset, args.num_users)
+            else:
+                # Chose euqal splits for every user
+                return mnist_noniid(train_dataset, args.num_users)
+
+def _rng_digest():
+    """ Digest of the global numpy random state, which the partitioners draw from """
+    name, keys, pos, has_gauss, cached_gaussian = np.random.get_state()
+    return hashlib.blake2b(keys.tobytes() + repr((name, pos, has_gauss, cached_gaussian)).encode(),
+        digest_size=16).hexdigest()
+
+def partition_config(args, train_dataset):
+    """ All configurations that determine the partition, including the global numpy random state
+    before partitioning. The dataset is identified by its options and size """
+    config = {
+        "dataset": args.dataset,
+        "data": list(dataset_key(args)),
+        "train_size": len(train_dataset),
+        "num_classes": args.num_classes,
+        "num_users": args.num_users,
+        "partition": args.partition,
+        "iid": args.iid,
+        "unequal": args.unequal,
+        "halfiid": args.halfiid,
+        "seed": args.seed,
+        "synthetic": args.synthetic,
+        "rng": _rng_digest()
+    }
+    if args.partition == "dirichlet":
+        config.update({
+            "dirichlet_alpha": args.dirichlet_alpha,
+            "datasize_skew": args.datasize_skew,
+            "datasize_param": args.datasize_param
+        })
+    return config
+
+def _sample_partition(args, train_dataset):
+    """ Returns the partition (indices, offsets) and label histograms of the clients """
+    client2dataidxs = sample_client_data(args, train_dataset)
+    indices, offsets = partition_from_dict(client2dataidxs, args.num_users)
+    hist = partition_histogram(get_labels(train_dataset), indices, offsets, args.num_classes)
+    return indices, offsets, hist
+
+def partition_dataset(args, train_dataset):
+    """
+    Split the training data amongst users, returns the partition (indices, offsets) and the
+    label histograms of the clients. If args.partition_cache is set, they are stored in one
+    file named by the hash of the partition configuration, and later runs with the same
+    configuration load the memory-mapped file instead, without partitioning or reading the
+    labels, so that they are guaranteed to use the same client data. The global numpy random
+    state after partitioning is stored as well and restored on a hit, so the random draws
+    of the rest of the run do not depend on whether the partition was cached.
+    """
+    if not args.partition_cache:
+        return _sample_partition(args, train_dataset)
+
+    config = partition_config(args, train_dataset)
+    key = hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+    cache_path = os.path.join(args.partition_cache, f"{args.dataset}-{args.num_users}users-{key}.part")
+    if os.path.exists(cache_path):
+        arrays, state = load_arrays(cache_path)
+        np.random.set_state(state["rng"])
+        print(f"Load the partition from {cache_path}")
+        return arrays["indices"], arrays["offsets"], arrays["hist"]
+
+    indices, offsets, hist = _sample_partition(args, train_dataset)
+    save_arrays(cache_path, {"indices": indices, "offsets": offsets, "hist": hist},
+        state={"config": config, "rng": np.random.get_state()})
+    print(f"Save the partition to {cache_path}")
+    return indices, offsets, hist
+
+### Datasets loaded by this process, see load_datasets
+_datasets = {}
+
+def dataset_key(args):
+    ''' Options which decide the content of the train and test datasets '''
+    if args.synthetic:
+        return ("synthetic", args.dataset, args.num_classes, args.synthetic_train,
+            args.synthetic_test, args.synthetic_noise, args.seed)
+    return (args.dataset, args.data_dir)
+
+def load_datasets(args):
+    ''' Returns (train_dataset, test_dataset), which are loaded once per process and
+        shared by all experiments with the same dataset_key, e.g., by the runs of sweep.py
+    '''
+    key = dataset_key(args)
+    if key not in _datasets:
+        _datasets[key] = _load_datasets(args)
+    return _datasets[key]
+
+def _load_datasets(args):
+    if args.data_dir is not None:
+        data_dir = args.data_dir
+    else:
+        data_dir = f'../data/{args.dataset}/'
 
+    if args.synthetic:
+        train_dataset, test_dataset = load_synthetic_dataset(args)
 
-def get_dataset(args):
-    """ Returns train and test datasets and a user group which is a dict where
-    the keys are the user index and the values are the corresponding data for
-    each of those users.
-    """
+    elif has_raw_files(args.dataset, data_dir):
+        ### Parse the raw files directly, without network access or per-sample transforms
+        train_dataset, test_dataset = load_raw_dataset(args.dataset, data_dir)
 
-    if args.dataset == 'cifar':
-        data_dir = '../data/cifar/'
+    elif args.dataset == 'cifar':
         apply_transform = transforms.Compose(
             [transforms.ToTensor(),
              transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))])
@@ -401,61 +597,36 @@ def get_dataset(args):
         # check_dist("Cifar Train", train_dataset)
         # check_dist("Cifar Test", test_dataset)           
 
-        # sample training data amongst users
-        if True:
-            client2dataidxs = load_custom_dataset(
-                dataset=train_dataset,
-                num_users=args.num_users,
-                is_even_datasize=(not args.unequal))
-        elif args.iid:
-            # Sample IID user data from Mnist
-            client2dataidxs = cifar_iid(train_dataset, args.num_users)
-        else:
-            # Sample Non-IID user data from Mnist
-            if args.unequal:
-                # Chose uneuqal splits for every user
-                raise NotImplementedError()
-            else:
-                # Chose euqal splits for every user
-                client2dataidxs = cifar_noniid(train_dataset, args.num_users)
-
-    elif args.dataset == 'mnist' or 'fmnist':
+    elif args.dataset in ['mnist', 'fmnist']:
         if args.dataset == 'mnist':
-            data_dir = '../data/mnist/'
+            dataset_cls = datasets.MNIST
         else:
-            data_dir = '../data/fmnist/'
+            dataset_cls = datasets.FashionMNIST
 
         apply_transform = transforms.Compose([
             transforms.ToTensor(),
             transforms.Normalize((0.1307,), (0.3081,))])
 
-        train_dataset = datasets.MNIST(data_dir, train=True, download=True,
+        train_dataset = dataset_cls(data_dir, train=True, download=True,
                                        transform=apply_transform)
 
-        test_dataset = datasets.MNIST(data_dir, train=False, download=True,
+        test_dataset = dataset_cls(data_dir, train=False, download=True,
                                       transform=apply_transform)
+    else:
+        raise ValueError(f"Invalid dataset {args.dataset}")
+    return train_dataset, test_dataset
 
-        # sample training data amongst users
-        if True:
-            client2dataidxs = load_custom_dataset(
-                dataset=train_dataset,
-                num_users=args.num_users,
-                is_even_datasize=(not args.unequal))
-        elif args.halfiid:
-            client2dataidxs = mnist_iid_noniid(train_dataset, args.num_users)
-        elif args.iid:
-            # Sample IID user data from Mnist
-            client2dataidxs = mnist_iid(train_dataset, args.num_users)
-        else:
-            # Sample Non-IID user data from Mnist
-            if args.unequal:
-                # Chose uneuqal splits for every user
-                client2dataidxs = mnist_noniid_unequal(train_dataset, args.num_users)
-            else:
-                # Chose euqal splits for every user
-                client2dataidxs = mnist_noniid(train_dataset, args.num_users)
+def get_dataset(args):
+    """ Returns train and test datasets and the partition of the training data, i.e.,
+    (indices, offsets, label histograms) where the data indexes of user i are
+    indices[offsets[i]:offsets[i+1]].
+    """
+    train_dataset, test_dataset = load_datasets(args)
+
+    # sample training data amongst users
+    partition = partition_dataset(args, train_dataset)
 
-    return train_dataset, test_dataset, client2dataidxs
+    return train_dataset, test_dataset, partition
 
 
 if __name__ == '__main__':
@@ -0,0 +1,302 @@
+import io
+import time
+import random
+import argparse
+import itertools
+import contextlib
+import numpy as np
+
+import policy
+from market import MarketState, MARKET_POLICIES, normalize_shapley
+from task import ClientState, accuracy_improvement
+from checkpoint import save_arrays, load_arrays
+
+### Per-(epoch, task, client) signals of the selected clients in a trace
+SIGNALS = ["shapley", "projection"]
+
+class TraceRecorder:
+    ''' Record the signals of a real run, which are replayed by PolicySimulator.
+
+    At each epoch, the accuracy, loss and accuracy delta of every task are recorded,
+    together with the clients which trained the task and, for each of them, its
+    Shapley value (only when the policy computes them) and the projection of its
+    local update on the global update. The projections are cheap, so they are
+    recorded for every policy.
+    '''
+    def __init__(self, num_users, task_list, policy_name):
+        self.num_users = num_users
+        self.policy_name = policy_name
+        self.task_config = [{"required_client_num": task.required_client_num,
+            "bid_per_loss_delta": task.bid_per_loss_delta} for task in task_list]
+        self.datasize = np.asarray(task_list[0].all_clients.datasize[:num_users])
+        self.init_accu = [task.accu for task in task_list]
+        self.init_loss = [task.loss for task in task_list]
+        self.init_selected = [task.selected_client_idx for task in task_list]
+        self.epochs, self.accu, self.loss, self.delta_accu = [], [], [], []
+        self.columns = dict([(name, []) for name in ["row", "task", "client"] + SIGNALS])
+
+    def record_epoch(self, epoch, task_list, shapley_table=None):
+        ''' Called at the end of an epoch, before the clients of the next epoch are selected '''
+        row = len(self.epochs)
+        self.epochs.append(epoch)
+        self.accu.append([task.accu for task in task_list])
+        self.loss.append([task.loss for task in task_list])
+        self.delta_accu.append([task.delta_accu for task in task_list])
+        for task_idx, task in enumerate(task_list):
+            if not task.selected_client_idx:
+                continue
+            num = len(task.selected_client_idx)
+            self.columns["row"].append(np.full(num, row))
+            self.columns["task"].append(np.full(num, task_idx))
+            self.columns["client"].append(np.asarray(task.selected_client_idx))
+            if shapley_table is None or len(shapley_table[task_idx]) == 0:
+                self.columns["shapley"].append(np.full(num, np.nan))
+            else:
+                self.columns["shapley"].append(np.asarray(shapley_table[task_idx], dtype=float))
+            self.columns["projection"].append(np.asarray(task.client_projections(), dtype=float))
+
+    def save(self, path):
+        arrays = {
+            "epoch": np.asarray(self.epochs, dtype=np.int64),
+            "accu": np.asarray(self.accu, dtype=float).reshape(-1, len(self.task_config)),
+            "loss": np.asarray(self.loss, dtype=float).reshape(-1, len(self.task_config)),
+            "delta_accu": np.asarray(self.delta_accu, dtype=float).reshape(-1, len(self.task_config)),
+            "datasize": self.datasize,
+        }
+        for name, column in self.columns.items():
+            dtype = float if name in SIGNALS else np.int64
+            arrays[f"signal/{name}"] = np.concatenate(column).astype(dtype) if column else np.zeros(0, dtype)
+        state = {
+            "num_users": self.num_users,
+            "policy": self.policy_name,
+            "tasks": self.task_config,
+            "init_accu": self.init_accu,
+            "init_loss": self.init_loss,
+            "init_selected": self.init_selected,
+        }
+        save_arrays(path, arrays, state)
+        print(f"Record a trace of {len(self.epochs)} epochs and "
+            f"{len(arrays['signal/row'])} client signals to {path}")
+
+class SignalTable:
+    ''' A sparse signal observed at some (row, task, client) of a trace.
+
+    The signal of a pair at a row is its latest observation at or before the row,
+    otherwise its earliest observation after the row, and the mean of the task
+    if the pair was never observed. Observations are sorted by a combined key,
+    so a lookup is two binary searches.
+    '''
+    def __init__(self, row, task, client, value, num_rows, num_tasks, num_users):
+        self.num_rows, self.num_users = num_rows, num_users
+        valid = ~np.isnan(value)
+        keys = (task[valid] * num_users + client[valid]) * num_rows + row[valid]
+        order = np.argsort(keys, kind="stable")
+        self.keys, self.values = keys[order], value[valid][order]
+
+        counts = np.bincount(task[valid], minlength=num_tasks)
+        sums = np.bincount(task[valid], weights=value[valid], minlength=num_tasks)
+        self.task_mean = np.divide(sums, counts, out=np.zeros(num_tasks), where=counts > 0)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def lookup(self, row, task_idx, clients):
+        pairs = task_idx * self.num_users + np.asarray(clients, dtype=np.int64)
+        if len(self.keys) == 0:
+            return np.full(len(pairs), self.task_mean[task_idx])
+        last = len(self.keys) - 1
+        before = np.searchsorted(self.keys, pairs * self.num_rows + row, side="right") - 1
+        has_before = (before >= 0) & (self.keys[np.maximum(before, 0)] // self.num_rows == pairs)
+        after = np.searchsorted(self.keys, pairs * self.num_rows, side="left")
+        has_after = (after <= last) & (self.keys[np.minimum(after, last)] // self.num_rows == pairs)
+        return np.where(has_before, self.values[np.maximum(before, 0)],
+            np.where(has_after, self.values[np.minimum(after, last)], self.task_mean[task_idx]))
+
+def load_trace(path):
+    ''' Returns (arrays, state) of a trace, and the SignalTable of each signal '''
+    arrays, state = load_arrays(path)
+    num_rows, num_tasks = arrays["accu"].shape
+    signals = {}
+    for name in SIGNALS:
+        signals[name] = SignalTable(np.asarray(arrays["signal/row"]), np.asarray(arrays["signal/task"]),
+            np.asarray(arrays["signal/client"]), np.asarray(arrays[f"signal/{name}"]),
+            num_rows, num_tasks, state["num_users"])
+    return arrays, state, signals
+
+class SimClients:
+    ''' Stand-in of ClientRegistry, only the datasize is read by the policies '''
+    def __init__(self, datasize):
+        self.datasize = datasize
+
+class SimTask:
+    ''' Stand-in of Task with the attributes read by the selection policies, whose
+        accuracy and client signals are taken from a trace instead of training
+    '''
+    def __init__(self, task_id, num_users, required_client_num, bid_per_loss_delta,
+            datasize, projections, selected_client_idx):
+        self.task_id = task_id
+        self.required_client_num = required_client_num
+        self.bid_per_loss_delta = bid_per_loss_delta
+        self.all_clients = SimClients(datasize)
+        self.client_state = ClientState(num_users)
+        self.projections = projections
+        self.total_loss_delta = None
+        self.cient_update_cnt = 0
+        self.row, self.delta_accu, self.improved = 0, 0, 1
+        self.selected_client_idx = selected_client_idx
+        self.init_select_clients()
+
+    def init_select_clients(self):
+        if self.selected_client_idx is None:
+            return
+        self.cient_update_cnt += 1
+        self.client_state.client2selected_cnt[list(self.selected_client_idx)] += 1
+
+    def update_proj_list(self):
+        if not self.selected_client_idx:
+            return
+        idxs_proj = self.projections.lookup(self.row, self.task_id, self.selected_client_idx)
+        self.client_state.add_projections(self.selected_client_idx, idxs_proj, improved=self.improved)
+
+@contextlib.contextmanager
+def policy_params(**params):
+    ''' Temporarily override module-level parameters of policy, e.g., EXPLORE_RATE '''
+    old = dict([(name, getattr(policy, name)) for name in params])
+    for name, value in params.items():
+        setattr(policy, name, value)
+    try:
+        yield
+    finally:
+        for name, value in old.items():
+            setattr(policy, name, value)
+
+class PolicySimulator:
+    ''' Replay a trace through a selection policy and the market.
+
+    Epoch e of the simulation uses row e % #rows of the trace: the accuracy of each
+    task is the recorded one, and the signals of the clients selected by the simulated
+    policy are looked up in the trace (see SignalTable). The recorded accuracy does
+    not react to the simulated selection, so the simulation compares how policies and
+    market parameters select clients given the same signals, not the final accuracy.
+    '''
+    def __init__(self, trace, policy_name, solver="greedy", decay=1.0, history_len=0, seed=0, verbose=False):
+        self.arrays, self.state, self.signals = load_trace(trace) if isinstance(trace, str) else trace
+        self.policy_name = policy_name
+        self.solver = solver
+        self.verbose = verbose
+        self.num_users = self.state["num_users"]
+        self.num_rows, self.num_tasks = self.arrays["accu"].shape
+        if self.num_rows == 0:
+            raise ValueError("Empty trace")
+        self.delta_accu = np.asarray(self.arrays["delta_accu"])
+
+        ### Signs of the accuracy changes, as used to reward projections by Task.update_proj_list
+        accu = np.vstack([self.state["init_accu"], self.arrays["accu"]])
+        loss = np.vstack([self.state["init_loss"], self.arrays["loss"]])
+        self.improved = np.array([[accuracy_improvement(accu[row, task_idx], accu[row+1, task_idx],
+            loss[row, task_idx], loss[row+1, task_idx]) for task_idx in range(self.num_tasks)]
+            for row in range(self.num_rows)])
+
+        random.seed(seed)
+        np.random.seed(seed)
+        self.market = MarketState(self.num_users, self.num_tasks, decay=decay, history_len=history_len)
+        datasize = np.asarray(self.arrays["datasize"])
+        self.task_list = [SimTask(task_idx, self.num_users, config["required_client_num"],
+                config["bid_per_loss_delta"], datasize, self.signals["projection"],
+                self.state["init_selected"][task_idx])
+            for task_idx, config in enumerate(self.state["tasks"])]
+        self.epoch = 0
+
+    def step(self):
+        ''' Simulate one epoch, returns (succ_cnt, reward) of the selection '''
+        row = self.epoch % self.num_rows
+        for task_idx, task in enumerate(self.task_list):
+            task.row = row
+            task.delta_accu = self.delta_accu[row, task_idx]
+            task.improved = self.improved[row, task_idx]
+
+        if self.policy_name in MARKET_POLICIES:
+            shapley_table = [np.array([]) if not task.selected_client_idx else
+                self.signals["shapley"].lookup(row, task.task_id, task.selected_client_idx)
+                for task in self.task_list]
+            self.market.update_from_shapley(self.epoch, self.task_list, normalize_shapley(shapley_table))
+
+        succ_cnt, reward = policy.select_clients(self.policy_name, self.num_users, self.task_list,
+            self.market, solver=self.solver, verbose=self.verbose)
+        self.epoch += 1
+        return succ_cnt, reward
+
+    def run(self, epochs):
+        ''' Simulate epochs and return a dict of summary metrics '''
+        succ_cnt = np.zeros(epochs)
+        reward = np.full(epochs, np.nan)
+        shapley = np.zeros(epochs)
+        selected_cnt = np.zeros((self.num_users, self.num_tasks), dtype=np.int64)
+        ts = time.time()
+        with contextlib.redirect_stdout(None if self.verbose else io.StringIO()):
+            for epoch in range(epochs):
+                succ_cnt[epoch], _reward = self.step()
+                if _reward is not None:
+                    reward[epoch] = _reward
+                ### Recorded Shapley values of the clients selected for the next epoch
+                row = (self.epoch) % self.num_rows
+                for task_idx, task in enumerate(self.task_list):
+                    if task.selected_client_idx:
+                        shapley[epoch] += np.sum(self.signals["shapley"].lookup(
+                            row, task_idx, task.selected_client_idx))
+                        selected_cnt[task.selected_client_idx, task_idx] += 1
+        elapsed = time.time() - ts
+
+        total_selected = selected_cnt.sum(axis=1)
+        quota = sum(config["required_client_num"] for config in self.state["tasks"])
+        return {
+            "policy": self.policy_name,
+            "epochs": epochs,
+            "epochs_per_sec": epochs / max(elapsed, 1e-9),
+            "succ_rate": np.mean(succ_cnt) / max(quota, 1),
+            "reward": np.nanmean(reward) if np.any(~np.isnan(reward)) else np.nan,
+            "shapley": np.mean(shapley) if len(self.signals["shapley"]) > 0 else np.nan,
+            "coverage": np.mean(total_selected > 0),
+            ### Jain's fairness index of the number of selections of each client
+            "fairness": np.sum(total_selected) ** 2 / max(self.num_users * np.sum(total_selected ** 2), 1),
+        }
+
+def format_result(result, params=None):
+    items = [f"{name}={value}" for name, value in (params or {}).items()]
+    items += [f"{name}={value:.4g}" if isinstance(value, float) else f"{name}={value}"
+        for name, value in result.items()]
+    return ", ".join(items)
+
+def run_simulation(trace, policy_name, epochs, solver="greedy", decay=1.0, seed=0):
+    ''' Simulate one policy over a trace with the default parameters and print the result '''
+    result = PolicySimulator(trace, policy_name, solver=solver, decay=decay, seed=seed).run(epochs)
+    print(f"Simulate {trace}: " + format_result(result))
+    return result
+
+def sweep(trace, policies, epochs, explore_rates, ucb_alphas, ignore_bid_asks, solver="greedy", decay=1.0, seed=0):
+    ''' Simulate all combinations of policies and parameters, returns a list of (params, result) '''
+    trace = load_trace(trace)
+    results = []
+    for policy_name, explore_rate, ucb_alpha, ignore_bid_ask in itertools.product(
+            policies, explore_rates, ucb_alphas, ignore_bid_asks):
+        params = {"EXPLORE_RATE": explore_rate, "UCB_ALPHA": ucb_alpha, "IGNORE_BID_ASK": bool(ignore_bid_ask)}
+        with policy_params(**params):
+            result = PolicySimulator(trace, policy_name, solver=solver, decay=decay, seed=seed).run(epochs)
+        print(format_result(result, params))
+        results.append((params, result))
+    return results
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sweep selection policies and market parameters over a trace")
+    parser.add_argument('trace', type=str, help="trace recorded by federated_main.py --trace")
+    parser.add_argument('--policy', type=str, nargs="+", default=["nmfli"])
+    parser.add_argument('--epochs', type=int, default=1000)
+    parser.add_argument('--explore_rate', type=float, nargs="+", default=[policy.EXPLORE_RATE])
+    parser.add_argument('--ucb_alpha', type=float, nargs="+", default=[policy.UCB_ALPHA])
+    parser.add_argument('--ignore_bid_ask', type=int, nargs="+", default=[int(policy.IGNORE_BID_ASK)])
+    parser.add_argument('--market_solver', type=str, default="greedy")
+    parser.add_argument('--price_decay', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    sweep(args.trace, args.policy, args.epochs, args.explore_rate, args.ucb_alpha, args.ignore_bid_ask,
+        solver=args.market_solver, decay=args.price_decay, seed=args.seed)
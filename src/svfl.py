@@ -4,6 +4,9 @@ import time
 from tqdm import tqdm
 from scipy.special import comb
 
+from profiler import span
+from memtrack import MEMORY
+
 def calculate_sv_v1(models, model_evaluation_func, averaging_func):
     """
     Computes the Shapley Value for clients
@@ -98,8 +101,11 @@ def calculate_sv_v2(models, model_evaluation_func, averaging_func):
             current_value = 0
         else:
             local_models = dict([(client_id, models[client_id]) for client_id in s])
-            model = averaging_func(local_models)
-            current_value = model_evaluation_func(model)
+            with span("shapley/aggregate"):
+                model = averaging_func(local_models)
+            MEMORY.note_peak("shapley/scratch", model)
+            with span("shapley/evaluate"):
+                current_value = model_evaluation_func(model)
         group_shapley_value.append(current_value)
 
     agent_shapley = []
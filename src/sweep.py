@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+''' Run a grid of experiments in parallel processes which share the loaded datasets.
+
+    python src/sweep.py --sweep_grid='{"target_label": ["overlap", "identical"], "policy": ["nmfli", "random"]}' \
+        --sweep_cores=4 [options of federated_main.py]
+
+The grid maps option names to lists of values (a JSON string or the path of a JSON
+file), and one run is started for each combination, with the other options taken
+from the command line. Each dataset of the grid is loaded once before the runs are
+forked, so the runs share its memory instead of loading it again. At most
+--sweep_workers runs, each limited to --sweep_cores threads, run at the same time.
+Each run writes {dataset}-{target_label}_label-{model}-{policy}_policy.{csv,log}
+to --sweep_dir as script/test_all.sh does. The results of each run are streamed to
+its .results log (--results_batch), and the CSV is written at the end, or every
+--results_every epochs if given. Progress and ETA of the whole sweep are printed.
+'''
+import os
+import copy
+import json
+import time
+import queue
+import itertools
+import traceback
+import multiprocessing
+
+import torch
+
+import federated_main
+from federated_main import Experiment, args, EPOCH_NUM, result_name, init_seeds
+from sampling import load_datasets
+from raw_datasets import ArrayDataset
+from util import redirect_output
+
+REPORT_INTERVAL = 30
+
+def load_grid(spec):
+    ''' Returns an ordered list of (option name, values) '''
+    if os.path.exists(spec):
+        with open(spec) as fp:
+            grid = json.load(fp)
+    else:
+        grid = json.loads(spec)
+    for name, values in grid.items():
+        if not hasattr(args, name):
+            raise ValueError(f"Invalid option {name} in the sweep grid")
+        if not isinstance(values, list):
+            grid[name] = [values]
+    return list(grid.items())
+
+def grid_runs(base_args, grid):
+    ''' One copy of base_args for each combination of the grid '''
+    names = [name for name, _ in grid]
+    runs = []
+    for values in itertools.product(*[values for _, values in grid]):
+        run_args = copy.deepcopy(base_args)
+        for name, value in zip(names, values):
+            setattr(run_args, name, value)
+        runs.append(run_args)
+    return runs
+
+def run_name(sweep_dir, run_args):
+    return result_name(sweep_dir, run_args.dataset, run_args.target_label, run_args.model, run_args.policy)
+
+def share_datasets(runs):
+    ''' Load the datasets of all runs in the parent, their tensors are then shared by the forked runs '''
+    for run_args in runs:
+        for dataset in load_datasets(run_args):
+            if isinstance(dataset, ArrayDataset):
+                dataset.data.share_memory_()
+
+def run_one(run_idx, run_args, exp_name, cores, progress):
+    ''' Entry of a run in a forked process '''
+    redirect_output(exp_name + ".log")
+    try:
+        torch.set_num_threads(cores)
+        if run_args.task_workers > 1 and run_args.task_cores <= 0:
+            run_args.task_cores = max(1, cores // run_args.task_workers)
+        os.environ["NMFLI_EXP_NAME"] = exp_name
+        federated_main.args = run_args
+        init_seeds()
+        experiment = Experiment(run_args, time.time())
+        experiment.on_epoch_end = lambda epoch: progress.put((run_idx, epoch + 1))
+        experiment.run(0, EPOCH_NUM)
+        experiment.finish()
+    except BaseException:
+        traceback.print_exc()
+        raise
+
+def format_seconds(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+class SweepProgress:
+    ''' Epochs done by every run, and the ETA of the sweep by the overall epoch throughput '''
+    def __init__(self, run_num, epoch_num):
+        self.run_num, self.epoch_num = run_num, epoch_num
+        self.epochs = [0] * run_num
+        self.exit_codes = {}
+        self.start_time = time.time()
+
+    def report(self, running):
+        done = sum(self.epochs)
+        total = self.run_num * self.epoch_num
+        elapsed = time.time() - self.start_time
+        eta = elapsed / done * (total - done) if done > 0 else float("nan")
+        failed = sum(code != 0 for code in self.exit_codes.values())
+        print(f"[Sweep] runs: {len(self.exit_codes)}/{self.run_num} done ({failed} failed), "
+            f"{running} running; epochs: {done}/{total} ({100 * done / max(total, 1):.1f}%); "
+            f"elapsed {format_seconds(elapsed)}, "
+            f"ETA {format_seconds(eta) if done > 0 else 'unknown'}", flush=True)
+
+def sweep(runs, sweep_dir, workers, cores):
+    ''' Run all runs, at most workers at a time, returns the exit code of each run '''
+    context = multiprocessing.get_context("fork")
+    progress_queue = context.Queue()
+    progress = SweepProgress(len(runs), EPOCH_NUM)
+    pending = list(enumerate(runs))
+    running = {}
+    last_report = time.time()
+    while pending or running:
+        while pending and len(running) < workers:
+            run_idx, run_args = pending.pop(0)
+            exp_name = run_name(sweep_dir, run_args)
+            process = context.Process(target=run_one, name=f"run{run_idx}",
+                args=(run_idx, run_args, exp_name, cores, progress_queue))
+            process.start()
+            running[run_idx] = process
+            print(f"[Sweep] start run {run_idx}: {exp_name}", flush=True)
+
+        try:
+            run_idx, epoch = progress_queue.get(timeout=1)
+            progress.epochs[run_idx] = epoch
+        except queue.Empty:
+            pass
+
+        for run_idx, process in list(running.items()):
+            if process.exitcode is not None:
+                process.join()
+                del running[run_idx]
+                progress.exit_codes[run_idx] = process.exitcode
+                if process.exitcode == 0:
+                    progress.epochs[run_idx] = EPOCH_NUM
+                print(f"[Sweep] run {run_idx} exits with {process.exitcode}", flush=True)
+                progress.report(len(running))
+                last_report = time.time()
+        if time.time() - last_report > REPORT_INTERVAL:
+            progress.report(len(running))
+            last_report = time.time()
+    return [progress.exit_codes[run_idx] for run_idx in range(len(runs))]
+
+if __name__ == '__main__':
+    if not args.sweep_grid:
+        raise ValueError("No grid is given by --sweep_grid")
+    runs = grid_runs(args, load_grid(args.sweep_grid))
+    cores = max(1, args.sweep_cores)
+    workers = args.sweep_workers if args.sweep_workers > 0 else max(1, (os.cpu_count() or 1) // cores)
+    sweep_dir = args.sweep_dir or f"save/results/{time.strftime('%Y%m%d-%H%M%S')}-sweep"
+    os.makedirs(sweep_dir, exist_ok=True)
+    for run_args in runs:
+        ### Stream the results of each run by the CSV only without a results log, as rewriting
+        # the CSV waits for the pending evaluations
+        if run_args.results_batch <= 0 and run_args.results_every <= 0:
+            run_args.results_every = 1
+
+    ts = time.time()
+    share_datasets(runs)
+    print(f"[Sweep] {len(runs)} runs, {workers} workers with {cores} cores each, "
+        f"datasets loaded in {time.time() - ts:.3f} s, results in {sweep_dir}", flush=True)
+    exit_codes = sweep(runs, sweep_dir, workers, cores)
+    exit(int(any(code != 0 for code in exit_codes)))
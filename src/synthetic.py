@@ -0,0 +1,62 @@
+import numpy as np
+
+import torch
+
+from raw_datasets import ArrayDataset
+
+### Shape (C, H, W) of the samples, following the real dataset given by --dataset
+SAMPLE_SHAPES = {
+    "mnist": (1, 28, 28),
+    "fmnist": (1, 28, 28),
+    "cifar": (3, 32, 32),
+}
+### Class prototypes are drawn at a low resolution and upsampled, so that they are
+#   spatially smooth like images and can be learnt by the CNNs
+PROTOTYPE_RESOLUTION = 7
+CHUNK_SIZE = 8192
+
+def class_prototypes(num_classes, shape, seed):
+    ''' One smooth random pattern per class, of shape (num_classes, C, H, W) '''
+    channels, height, width = shape
+    rng = np.random.default_rng(seed)
+    low = rng.standard_normal((num_classes, channels, PROTOTYPE_RESOLUTION, PROTOTYPE_RESOLUTION))
+    low = torch.from_numpy(low.astype(np.float32))
+    return torch.nn.functional.interpolate(low, size=(height, width), mode="bilinear", align_corners=False)
+
+def generate_samples(prototypes, labels, noise, seed):
+    ''' Samples of class y are prototypes[y] plus Gaussian noise, written chunk by chunk
+        into one preallocated tensor of shape (N, C, H, W)
+    '''
+    generator = torch.Generator().manual_seed(seed)
+    labels = torch.from_numpy(np.asarray(labels, dtype=np.int64))
+    data = torch.empty((len(labels),) + tuple(prototypes.shape[1:]), dtype=torch.float32)
+    for start in range(0, len(labels), CHUNK_SIZE):
+        chunk = data[start:start+CHUNK_SIZE]
+        torch.randn(chunk.shape, generator=generator, out=chunk)
+        chunk.mul_(noise).add_(prototypes[labels[start:start+CHUNK_SIZE]])
+    return data
+
+def balanced_labels(num_samples, num_classes, rng):
+    return rng.permutation(np.arange(num_samples) % num_classes)
+
+def load_synthetic_dataset(args):
+    ''' Returns (train_dataset, test_dataset) of seeded class-conditional synthetic data,
+        with the sample shape of args.dataset and args.num_classes classes
+    '''
+    if args.dataset not in SAMPLE_SHAPES:
+        raise ValueError(f"Invalid dataset {args.dataset}")
+    shape = SAMPLE_SHAPES[args.dataset]
+
+    ### Seeds of the prototypes, train and test data are derived from args.seed
+    seeds = np.random.SeedSequence(args.seed).generate_state(4)
+    prototypes = class_prototypes(args.num_classes, shape, int(seeds[0]))
+    rng = np.random.default_rng(int(seeds[1]))
+    train_labels = balanced_labels(args.synthetic_train, args.num_classes, rng)
+    test_labels = balanced_labels(args.synthetic_test, args.num_classes, rng)
+    train_dataset = ArrayDataset(generate_samples(prototypes, train_labels,
+        args.synthetic_noise, int(seeds[2])), train_labels)
+    test_dataset = ArrayDataset(generate_samples(prototypes, test_labels,
+        args.synthetic_noise, int(seeds[3])), test_labels)
+    print(f"Synthetic {args.dataset}-shaped data: {args.num_classes} classes, "
+        f"{len(train_dataset)} train and {len(test_dataset)} test samples")
+    return train_dataset, test_dataset
@@ -2,6 +2,7 @@ import os
 import copy
 import time
 import pickle
+import threading
 import numpy as np
 from tqdm import tqdm
 import math
@@ -14,9 +15,13 @@ import torch.backends.cudnn as cudnn
 from options import args_parser
 from client import test_inference
 from nets import MLP, CNNMnist, CNNFashion_Mnist, CNNCifar, find_models
-from exp_utils import average_weights, exp_details
+from exp_utils import average_weights, exp_details, weights_fingerprint
 from client import VirtualClient
 from svfl import calculate_sv
+from profiler import span
+from memtrack import MEMORY
+from evaluator import EvalCache
+from update_cache import open_update_cache
 from util import PRINT_EVERY
 
 from client import check_dist
@@ -34,44 +39,91 @@ class ClientState:
         self.client2rewards = []
         for _ in range(num_users):
             self.client2rewards.append([0])
+        self._sum_rewards()
     
-    def update_proj_list(self, idxs_users, global_weights, global_weights_before, local_weights, update_cnt, improved=1):
-        #calculate projection of client local gradient on global gradient
-        global_grad={}
-        for key in global_weights.keys():
-            global_grad[key] = (global_weights[key]- global_weights_before[key]).data.cpu().numpy()
-
-        clientid_to_grad = {}
-        for i, idx in enumerate(idxs_users):
-            clientid_to_grad[idx] = {}
-            for key in local_weights[i].keys():
-                clientid_to_grad[idx][key] = (local_weights[i][key]- global_weights_before[key]).data.cpu().numpy()
+    def _sum_rewards(self):
+        ### Running sum and number of the rewards of each client, so that client2proj,
+        # the mean reward, is updated without rescanning the rewards
+        self.reward_sum = np.array([float(np.sum(rewards)) for rewards in self.client2rewards])
+        self.reward_cnt = np.array([len(rewards) for rewards in self.client2rewards])
+
+    def state_dict(self):
+        ''' Returns (arrays, state) used for checkpointing '''
+        arrays = {
+            "client2proj": self.client2proj,
+            "sv": self.sv,
+            "client2selected_cnt": self.client2selected_cnt
+        }
+        state = {"client2rewards": [[float(reward) for reward in rewards] for rewards in self.client2rewards]}
+        return arrays, state
+
+    def load_state_dict(self, arrays, state):
+        self.client2proj = np.array(arrays["client2proj"])
+        self.sv = np.array(arrays["sv"])
+        self.client2selected_cnt = np.array(arrays["client2selected_cnt"])
+        self.client2rewards = [list(rewards) for rewards in state["client2rewards"]]
+        self._sum_rewards()
 
+    def update_proj_list(self, idxs_users, global_weights, global_weights_before, local_weights, update_cnt, improved=1):
         assert update_cnt > 0
         # print(f"The {update_cnt}-th update to the projection list")
-        idxs_proj = []
-        for idx in idxs_users:
-            #### Method 2
-            proj_dict = {}
-            for key in global_weights.keys():
-                _global_grad = global_grad[key].flatten()
-                g_norm = np.sqrt(sum(_global_grad**2))
-                # print(type(g_norm), g_norm.shape)
-                local_grad = clientid_to_grad[idx][key].flatten()
-                proj_dict[key]= np.dot(local_grad, _global_grad) / g_norm
-            
-            idxs_proj.append(np.array(list(proj_dict.values())).mean())
-        
+        idxs_proj = gradient_projections(idxs_users, global_weights, global_weights_before, local_weights)
+        self.add_projections(idxs_users, idxs_proj, improved=improved)
+
+    def add_projections(self, idxs_users, idxs_proj, improved=1):
+        ''' Reward the clients by the softmax of their projections, signed by improved '''
         # print("Imporved ?", improved, "projection", idxs_proj)
-        # import pdb; pdb.set_trace()
         final_reward = torch.nn.Softmax(dim=0)(torch.Tensor(idxs_proj)) * improved
         # print("projection after softmax", final_reward)
+        final_reward = final_reward.tolist()
         for client_idx, reward in zip(idxs_users, (final_reward)):
             self.client2rewards[client_idx].append((reward))
-
-        for client_idx in range(len(self.client2proj)):
-            self.client2proj[client_idx] = np.mean(self.client2rewards[client_idx])
-    
+        np.add.at(self.reward_sum, list(idxs_users), final_reward)
+        np.add.at(self.reward_cnt, list(idxs_users), 1)
+
+        self.client2proj = self.reward_sum / self.reward_cnt
+
+def gradient_projections(idxs_users, global_weights, global_weights_before, local_weights):
+    ''' Projection of the local gradient of each client on the global gradient, averaged over layers '''
+    global_grad={}
+    for key in global_weights.keys():
+        global_grad[key] = (global_weights[key]- global_weights_before[key]).data.cpu().numpy()
+
+    clientid_to_grad = {}
+    for i, idx in enumerate(idxs_users):
+        clientid_to_grad[idx] = {}
+        for key in local_weights[i].keys():
+            clientid_to_grad[idx][key] = (local_weights[i][key]- global_weights_before[key]).data.cpu().numpy()
+
+    idxs_proj = []
+    for idx in idxs_users:
+        #### Method 2
+        proj_dict = {}
+        for key in global_weights.keys():
+            _global_grad = global_grad[key].flatten()
+            g_norm = np.sqrt(sum(_global_grad**2))
+            # print(type(g_norm), g_norm.shape)
+            local_grad = clientid_to_grad[idx][key].flatten()
+            proj_dict[key]= np.dot(local_grad, _global_grad) / g_norm
+        
+        idxs_proj.append(np.array(list(proj_dict.values())).mean())
+    return idxs_proj
+
+def accuracy_improvement(accu_before, accu, loss_before, loss):
+    ''' 1 if the accuracy increases, -1 if it decreases, otherwise decided by the loss '''
+    if accu > accu_before:
+        ### Better accuracy, larger projection is better
+        return 1
+    elif accu == accu_before:
+        if loss < loss_before:
+            return 0.5
+        elif loss > loss_before:
+            return -0.5
+        else: 
+            return 0
+    else:
+        ### Worse accuracy, smaller projection is better
+        return -1
 
 def fed_avg(client2weights):
     # function to merge the model updates into one model for evaluation, ex: FedAvg, FedProx
@@ -79,6 +131,11 @@ def fed_avg(client2weights):
     return average_weights(list(client2weights.values()))
 
 class Task:
+    ### Attributes saved to and restored from checkpoints, besides the model weights
+    CHECKPOINT_ATTRS = ["epoch", "selected_client_idx", "cient_update_cnt", "accu", "loss",
+        "round_train_loss", "train_loss", "test_accuracy", "epoch_num", "timestamp",
+        "accuracy_per_update", "loss_per_update", "weights_version"]
+
     def __init__(self, args, start_time,
             logger, train_dataset, test_client, all_clients,
             task_id, selected_client_idx,
@@ -145,10 +202,23 @@ class Task:
 
         self.cient_update_cnt = 0
         self.init_test_model(args, logger)
+
+        ### Memo of evaluation results, the version of global weights is increased
+        # whenever the global weights change, so that their fingerprint is only
+        # computed once for each version
+        self.eval_cache = EvalCache()
+        self.eval_set = ("test", self.task_id)
+        self.weights_version = 0
+        self._fingerprint = (None, None)
     
         self.args = args
         self.logger = logger
         self.selected_clients = None
+        ### VirtualClients of the selected clients, kept across epochs while the client is selected
+        self.client2virtual = {}
+        self._weights_before_version = None
+        ### Memo of local updates shared by all tasks and runs, None if --update_cache is not set
+        self.update_cache = open_update_cache(args)
         self.client_state = ClientState(args.num_users)
         self.local_weights = []
 
@@ -168,6 +238,8 @@ class Task:
 
         self.train_loss, self.test_accuracy = [], []
         self.epoch_num, self.timestamp = [], []
+        ### Held while a round is recorded, which is done by the eval thread with --async_eval
+        self.record_lock = threading.Lock()
 
         self.accuracy_per_update = [self.accu]
         self.loss_per_update = [self.loss]
@@ -175,46 +247,91 @@ class Task:
 
         self.start_time = start_time
 
-    def train_one_round(self):   
+    def train_one_round(self, evaluate=True):
+        ''' Train one round. If evaluate is False, the caller is responsible to
+            evaluate the global model and call `record_round` (e.g., MultiTaskEvaluator)
+        '''
         self.local_weights, local_losses = [], []
         self.global_model.train()
 
+        if not self.selected_client_idx:
+            ### The task failed to trade, keep its model (and its training loss)
+            self.round_train_loss = self.train_loss[-1] if len(self.train_loss) > 0 else float('nan')
+            if evaluate and (self.epoch+1) % PRINT_EVERY == 0:
+                with span("eval"):
+                    result = self.evaluate_model(self.global_weights)
+                self.record_round(*result)
+            return
+
+        weights_key = None
+        if self.update_cache is not None:
+            ### The global model holds the global weights of this version
+            weights_key = self.eval_cache_key(self.global_weights)[0]
         for idx in range(len(self.selected_client_idx)):
             ### Here idx is NOT the client idx
             client = self.selected_clients[idx]
-            _weight, loss = client.train_step(self.global_model, self.epoch)
-            self.local_weights.append(copy.deepcopy(_weight))
+            with span("train/local"):
+                _weight, loss = client.train_step(self.global_model, self.epoch, weights_key=weights_key)
+            MEMORY.check(f"the local update of client {self.selected_client_idx[idx]} of task {self.task_id}")
+            with span("train/copy"):
+                self.local_weights.append(copy.deepcopy(_weight))
             local_losses.append(copy.deepcopy(loss))
         
         ### Update global weights
-        self.global_weights = average_weights(self.local_weights)
-        # Load global weights to the global model
-        self.global_model.load_state_dict(self.global_weights)
+        with span("train/aggregate"):
+            self.global_weights = average_weights(self.local_weights)
+            # Load global weights to the global model
+            self.global_model.load_state_dict(self.global_weights)
+        self.weights_version += 1
+
+        self.round_train_loss = sum(local_losses) / len(local_losses)
 
         # print global training loss after every 'i' rounds
         if (self.epoch+1) % PRINT_EVERY == 0:
-            loss_avg = sum(local_losses) / len(local_losses)
-            self.train_loss.append(loss_avg)
-
-            # Calculate avg training accuracy over all users at every epoch
-            self.global_model.eval()
-            self.accu, self.loss = self.evaluate_model(self.global_weights)
+            if evaluate:
+                # Calculate avg training accuracy over all users at every epoch
+                self.global_model.eval()
+                with span("eval"):
+                    accu, loss = self.evaluate_model(self.global_weights)
+                self.record_round(accu, loss)
+
+    def record_round(self, accu, loss, epoch=None, train_loss=None,
+            timestamp=None, selected_client_idx=None):
+        ''' Record the test accuracy and loss of the global model of one round.
+            The round information defaults to the current state of this task, and
+            is given explicitly if the evaluation is done asynchronously (EvalScheduler)
+        '''
+        epoch = self.epoch if epoch is None else epoch
+        train_loss = self.round_train_loss if train_loss is None else train_loss
+        timestamp = time.time() - self.start_time if timestamp is None else timestamp
+        if selected_client_idx is None:
+            selected_client_idx = self.selected_client_idx
+
+        with self.record_lock:
+            self.accu, self.loss = accu, loss
+            self.train_loss.append(train_loss)
             self.test_accuracy.append(self.accu)
-            
-            self.epoch_num.append(self.epoch)
-            self.timestamp.append(time.time() - self.start_time)
-            
-            # log
-            self.logger.add_scalar(f'Task{self.task_id}/Loss', self.train_loss[-1], global_step=self.epoch)
-            self.logger.add_scalar(f'Task{self.task_id}/Accu.', self.test_accuracy[-1], global_step=self.epoch)
-            self.logger.flush()
-            print(f"[{datetime.datetime.now().__format__('%H:%M:%S')} "
-                f"({self.timestamp[-1]:.3f})s] Task {self.task_id}, "
-                f"Avg Training Stats after {self.epoch+1} global rounds: "
-                f"Training Loss : {self.train_loss[-1]:.3f}, "
-                f"Test Accuracy: {100*self.test_accuracy[-1]:.2f}%, "
-                f"selected idxs {self.selected_client_idx}")
+
+            self.epoch_num.append(epoch)
+            self.timestamp.append(timestamp)
+        
+        # log
+        self.logger.add_scalar(f'Task{self.task_id}/Loss', self.train_loss[-1], global_step=epoch)
+        self.logger.add_scalar(f'Task{self.task_id}/Accu.', self.test_accuracy[-1], global_step=epoch)
+        self.logger.add_scalar(f'Task{self.task_id}/EvalCacheHitRate', self.eval_cache.hit_rate, global_step=epoch)
+        print(f"[{datetime.datetime.now().__format__('%H:%M:%S')} "
+            f"({self.timestamp[-1]:.3f})s] Task {self.task_id}, "
+            f"Avg Training Stats after {epoch+1} global rounds: "
+            f"Training Loss : {self.train_loss[-1]:.3f}, "
+            f"Test Accuracy: {100*self.test_accuracy[-1]:.2f}%, "
+            f"selected idxs {selected_client_idx}")
     
+    def recorded_rounds(self, start=0):
+        ''' Snapshot of (epoch_num, timestamp, train_loss, test_accuracy) of the rounds from start on '''
+        with self.record_lock:
+            return (self.epoch_num[start:], self.timestamp[start:],
+                self.train_loss[start:], self.test_accuracy[start:])
+
     def init_test_model(self, args, logger):
         self.test_model = VirtualClient(
             args=args,
@@ -225,14 +342,27 @@ class Task:
             shuffle=False,
             required_dist=self.test_required_dist)
 
+    def eval_cache_key(self, weights):
+        if weights is self.global_weights:
+            version, fingerprint = self._fingerprint
+            if version != self.weights_version:
+                fingerprint = weights_fingerprint(weights)
+                self._fingerprint = (self.weights_version, fingerprint)
+        else:
+            fingerprint = weights_fingerprint(weights)
+        return (fingerprint, self.eval_set)
+
     def evaluate_model(self, weights=None):
         # function to compute evaluation metric, ex: accuracy, precision
         if weights is None:
-            self.test_model.load_weights(self.global_model.state_dict())
-        else:
+            weights = self.global_model.state_dict()
+        key = self.eval_cache_key(weights)
+        result = self.eval_cache.get(key)
+        if result is None:
             self.test_model.load_weights(weights)
-        accu, loss = self.test_model.inference(self.test_model.dataset)
-        return accu, loss
+            result = self.test_model.inference(self.test_model.dataset)
+            self.eval_cache.put(key, result)
+        return result
 
     def evaluate_model_accu(self, weights=None):
         return self.evaluate_model(weights = weights)[0]
@@ -276,11 +406,18 @@ class Task:
         # ### TODO used for debug
         # return [1] * len(self.selected_client_idx)
 
+        if not self.selected_client_idx:
+            return []
         client2weights = dict([(self.selected_client_idx[i], self.local_weights[i]) for i in range(len(self.selected_client_idx))])
         print(f"Calculate shaple value for {len(self.selected_client_idx)} clients")
         sv = calculate_sv(client2weights, self.evaluate_model_accu, fed_avg)
         return sv
 
+    def client_projections(self):
+        ''' Projections of the local updates of the selected clients on the global update '''
+        return gradient_projections(self.selected_client_idx, self.global_weights,
+            self.global_weights_before, self.local_weights)
+
     def end_train( self, args, test_client, start_time):
         # Test inference after completion of training
         test_acc, test_loss = test_inference(args, self.global_model, test_client)
@@ -292,13 +429,22 @@ class Task:
         print('Total Run Time: {0:0.4f}\n'.format(time.time()-start_time))
 
     def init_select_clients(self):
+        ''' Apply the selection in self.selected_client_idx. Only newly selected clients get
+            a new VirtualClient; the clients selected again keep theirs, including the
+            position of the data loader and the optimizer state, and the others are released.
+        '''
+        selected_client_idx = [] if self.selected_client_idx is None else list(self.selected_client_idx)
+        for client_idx in set(self.client2virtual) - set(selected_client_idx):
+            del self.client2virtual[client_idx]
         self.selected_clients = []
         if self.selected_client_idx is None:
             return
-        for client_idx in self.selected_client_idx:
-            self.selected_clients.append(
-                VirtualClient(self.args, self.all_clients[client_idx],
-                    self.logger, self.global_model, target_labels=self.target_labels))
+        for client_idx in selected_client_idx:
+            if client_idx not in self.client2virtual:
+                self.client2virtual[client_idx] = VirtualClient(self.args, self.all_clients[client_idx],
+                    self.logger, self.global_model, target_labels=self.target_labels,
+                    update_cache=self.update_cache)
+            self.selected_clients.append(self.client2virtual[client_idx])
             
             ### Check the distribution of the virtual client
             # from client import check_dist
@@ -306,31 +452,71 @@ class Task:
             # check_dist(f"task {self.task_id}, client:{client_idx}, Target labels {self.target_labels}",
             #     self.selected_clients[-1].dataset)
         
-        ### NOTE: deepcopy must be used here, or global_weights_before would change according to the weights in global_model
-        self.global_weights_before = copy.deepcopy(self.global_model.state_dict())
+        ### NOTE: the weights must be copied here, or global_weights_before would change according to
+        # the weights in global_model. The copy is skipped if the global weights have not changed.
+        if self._weights_before_version != self.weights_version:
+            with span("train/copy"):
+                self.global_weights_before = dict([(key, value.detach().clone())
+                    for key, value in self.global_model.state_dict().items()])
+            self._weights_before_version = self.weights_version
 
         self.cient_update_cnt += 1
 
         _selected_clients = list(self.selected_client_idx)
         self.client_state.client2selected_cnt[_selected_clients] += 1
 
+    def checkpoint_state(self, prefix=""):
+        ''' Returns (arrays, state), where arrays contains all tensors of this task '''
+        arrays = {}
+        for key, value in self.global_weights.items():
+            arrays[f"{prefix}global/{key}"] = value
+        for key, value in self.global_weights_before.items():
+            arrays[f"{prefix}before/{key}"] = value
+        client_arrays, client_state = self.client_state.state_dict()
+        for key, value in client_arrays.items():
+            arrays[f"{prefix}client_state/{key}"] = value
+
+        state = dict([(attr, getattr(self, attr, None)) for attr in self.CHECKPOINT_ATTRS])
+        state["client_state"] = client_state
+        return arrays, state
+
+    def restore_checkpoint(self, arrays, state, prefix=""):
+        ''' Restore a task created with the same configuration from a checkpoint.
+            NOTE: the VirtualClients of selected clients are re-created, so their
+            data loaders and optimizer states restart, while they are kept in an
+            uninterrupted run if the clients are selected again.
+        '''
+        def _load(name, like):
+            return torch.from_numpy(np.array(arrays[name])).to(like.device)
+
+        model_state = self.global_model.state_dict()
+        self.global_weights = dict([(key, _load(f"{prefix}global/{key}", value))
+            for key, value in model_state.items()])
+        self.global_model.load_state_dict(self.global_weights)
+
+        self.selected_client_idx = state["selected_client_idx"]
+        self.init_select_clients()
+
+        ### Overwrite the statistics updated by init_select_clients
+        for attr in self.CHECKPOINT_ATTRS:
+            setattr(self, attr, state[attr])
+        self.global_weights_before = dict([(key, _load(f"{prefix}before/{key}", value))
+            for key, value in model_state.items()])
+        self._weights_before_version = self.weights_version
+        client_arrays = dict([(name[len(f"{prefix}client_state/"):], value)
+            for name, value in arrays.items() if name.startswith(f"{prefix}client_state/")])
+        self.client_state.load_state_dict(client_arrays, state["client_state"])
+
+        ### Continue the timestamps of the checkpointed run
+        if len(self.timestamp) > 0:
+            self.start_time -= self.timestamp[-1]
+
     def update_proj_list(self):
         self.accuracy_per_update.append(self.accu)
         self.loss_per_update.append(self.loss)
 
-        if self.accuracy_per_update[-1] > self.accuracy_per_update[-2]:
-            ### Better accuracy, larger projection is better
-            improved = 1
-        elif self.accuracy_per_update[-1] == self.accuracy_per_update[-2]:
-            if self.loss_per_update[-1] < self.loss_per_update[-2]:
-                improved = 0.5
-            elif self.loss_per_update[-1] > self.loss_per_update[-2]:
-                improved = -0.5
-            else: 
-                improved = 0
-        else:
-            ### Worse accuracy, smaller projection is better
-            improved = -1
+        improved = accuracy_improvement(self.accuracy_per_update[-2], self.accuracy_per_update[-1],
+            self.loss_per_update[-2], self.loss_per_update[-1])
 
         self.client_state.update_proj_list(self.selected_client_idx, self.global_weights,
                 self.global_weights_before, self.local_weights, self.cient_update_cnt, improved=improved)
@@ -0,0 +1,126 @@
+import os
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from checkpoint import save_arrays, load_arrays
+
+SUFFIX = ".upd"
+
+class UpdateCache:
+    ''' An on-disk memo of local updates: key -> (weights and optimizer state after the
+        update, training loss).
+
+    A local update is a deterministic function of the global weights, the data of the
+    client, the random stream it draws, the optimizer state and the local
+    hyperparameters, which together form the key (see VirtualClient.train_step). Runs
+    with the same seed, e.g., the runs of different policies in test_all.sh, often train
+    the same client from the same global weights in early epochs and share the updates.
+
+    Each entry is one file in the checkpoint format, named by its key, so concurrent
+    runs can share a directory. When the total size of the entries exceeds max_bytes,
+    the least recently used entries of this process are removed.
+    '''
+    def __init__(self, cache_dir, max_bytes):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_dir, exist_ok=True)
+
+        ### Entries left by previous runs, from the least recently used one
+        self.entries = OrderedDict()
+        names = [name for name in os.listdir(cache_dir) if name.endswith(SUFFIX)]
+        paths = [os.path.join(cache_dir, name) for name in names]
+        for name, path in sorted(zip(names, paths), key=lambda item: os.path.getmtime(item[1])):
+            self.entries[name[:-len(SUFFIX)]] = os.path.getsize(path)
+        self.total_bytes = sum(self.entries.values())
+        self._writing = set()
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key + SUFFIX)
+
+    def get(self, key):
+        ''' Returns (arrays, state) of the entry, or None '''
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+            else:
+                ### Written by another run sharing the directory since this cache was opened
+                try:
+                    size = os.path.getsize(self.path(key))
+                except FileNotFoundError:
+                    self.misses += 1
+                    return None
+                self.entries[key] = size
+                self.total_bytes += size
+        try:
+            arrays, state = load_arrays(self.path(key), mmap=False)
+            os.utime(self.path(key))
+        except (FileNotFoundError, ValueError):
+            ### Removed by another run sharing the directory
+            with self.lock:
+                self.total_bytes -= self.entries.pop(key, 0)
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits += 1
+        return arrays, state
+
+    def put(self, key, arrays, state=None):
+        with self.lock:
+            if key in self.entries or key in self._writing:
+                return
+            self._writing.add(key)
+        try:
+            save_arrays(self.path(key), arrays, state)
+            size = os.path.getsize(self.path(key))
+        finally:
+            with self.lock:
+                self._writing.discard(key)
+        with self.lock:
+            self.entries[key] = size
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+                old_key, old_size = self.entries.popitem(last=False)
+                self.total_bytes -= old_size
+                try:
+                    os.remove(self.path(old_key))
+                except FileNotFoundError:
+                    pass
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0
+
+    def __repr__(self):
+        return (f"UpdateCache(hits={self.hits}, misses={self.misses}, hit rate={100*self.hit_rate:.2f}%, "
+            f"{len(self.entries)} entries, {self.total_bytes / 2**20:.1f} MB)")
+
+### Caches opened by this process, shared by all tasks
+_caches = {}
+
+### Held while a local update draws from the seeded global torch RNG, so that the
+### updates of concurrent tasks (--task_workers) do not interleave their random draws
+SEEDED_RNG_LOCK = threading.Lock()
+
+def open_update_cache(args):
+    ''' The UpdateCache given by args.update_cache, or None if it is disabled '''
+    if not args.update_cache:
+        return None
+    cache_dir = os.path.abspath(args.update_cache)
+    if cache_dir not in _caches:
+        _caches[cache_dir] = UpdateCache(cache_dir, int(args.update_cache_size * 2**20))
+    return _caches[cache_dir]
+
+def client_seed(seed, client_id, epoch):
+    ''' Seed of the random stream of a client at an epoch, independent of other clients '''
+    return int(np.random.SeedSequence([seed, client_id, epoch]).generate_state(1, dtype=np.uint64)[0] >> 1)
@@ -1,3 +1,5 @@
+import os
+import sys
 import numpy as np
 import random
 import pandas as pd
@@ -20,26 +22,6 @@ def normalize_data(data, method="max_min"):
     else:
         raise ValueError(method)
 
-def calcualte_client_value(price_table, client_feature_list):
-    ''' price_table is a 2-D list, shape=(#client, #task)
-    price_table[client_id][task_id] is a list of (epoch, price of client_id for task_id)
-    '''
-    idle_cost_list = [feature[1] for feature in client_feature_list]
-    value_table = []
-    for client_idx in range(len(client_feature_list)):
-        # shape = #task
-        client_price_list = price_table[client_idx]
-        value_list = []
-        for epoch_price_list in client_price_list:
-            # Take the median, instead of mean, to reduce the effect of marginal values
-            # price = np.median([price for epoch, price in epoch_price_list])
-            price = np.sum([price * delta_accu for epoch, price, delta_accu in epoch_price_list])
-            # The larger idle cost is, the smaller price is
-            value_list.append(price / (idle_cost_list[client_idx]+1))
-        value_table.append(value_list)
-    return value_table
-
-
 def pretty_print_2darray(name, a, columns=None):
     print(name)
     df = pd.DataFrame(a, columns=columns)
@@ -88,6 +70,25 @@ def sample_config(l, id, use_random=True):
     else:
         return l[id%len(l)]
 
+def redirect_output(path, mode="w"):
+    ''' Redirect stdout and stderr of this process, including output of native code, to path '''
+    sys.stdout.flush()
+    sys.stderr.flush()
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | (os.O_APPEND if mode == "a" else os.O_TRUNC), 0o644)
+    saved = os.dup(1), os.dup(2)
+    os.dup2(fd, 1)
+    os.dup2(fd, 2)
+    os.close(fd)
+    return saved
+
+def restore_output(saved):
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os.dup2(saved[0], 1)
+    os.dup2(saved[1], 2)
+    os.close(saved[0])
+    os.close(saved[1])
+
 class bcolors:
     ENDC = '\033[0m'
     BOLD = '\033[1m'